@@ -52,7 +52,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "backend.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "backend.middleware.ReplicaRoutingMiddleware",
+    "backend.middleware.QueryPatternMiddleware",
 
     "corsheaders.middleware.CorsMiddleware", #corsheaders middleware
     
@@ -88,13 +91,61 @@ WSGI_APPLICATION = "Blogzilla.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+#backend.db.sqlite3 is the django sqlite backend applying SQLITE_PRAGMAS to new connections. Connections are kept open
+#for CONN_MAX_AGE seconds (checked before reuse) instead of being opened on every request
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
+        "ENGINE": "backend.db.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "CONN_MAX_AGE": int(os.environ.get("CONN_MAX_AGE", 600)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+#read replicas: comma separated sqlite files, copies of db.sqlite3 refreshed outside of django (see README). The reads of
+#GET requests go to them, except for REPLICA_STICKY_SECONDS after a client writes (see backend.middleware.ReplicaRoutingMiddleware)
+DATABASE_REPLICAS = []
+for i, name in enumerate(name for name in os.environ.get("REPLICA_DATABASES", "").split(",") if name.strip()):
+    DATABASES[f"replica_{i}"] = {**DATABASES["default"], "NAME": name.strip(), "TEST": {"MIRROR": "default"}}
+    DATABASE_REPLICAS.append(f"replica_{i}")
+
+DATABASE_ROUTERS = ["backend.db.routers.ReplicaRouter"]
+REPLICA_STICKY_SECONDS = 10
+
+#wal: readers don't block on writers, normal sync is safe in wal mode, 256MB memory mapped reads, 64MB page cache
+#and writers wait up to 5s for the write lock instead of failing right away
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "mmap_size": 256*1024*1024,
+    "cache_size": -64*1024,
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+    "temp_store": "memory",
+}
+
+#writes of views are retried while the database is locked, after a random delay of up to DB_WRITE_RETRY_DELAY seconds
+#doubling on every retry (at most DB_WRITE_RETRY_MAX_DELAY), for at most DB_WRITE_MAX_WAIT seconds
+DB_WRITE_RETRY_DELAY = 0.05
+DB_WRITE_RETRY_MAX_DELAY = 1
+DB_WRITE_MAX_WAIT = 10
+
+#max rows deleted per statement and write transaction when a blog is deleted with its comments, replies and likes
+DELETE_CHUNK_SIZE = 500
+
+#n+1 detector: share of requests whose queries are grouped by shape, 0 disables it. A shape run more than NPLUSONE_THRESHOLD
+#times in one request is logged with its call site, or raised with NPLUSONE_RAISE=1 (see backend.middleware.QueryPatternMiddleware)
+NPLUSONE_SAMPLE_RATE = float(os.environ.get("NPLUSONE_SAMPLE_RATE", 0))
+NPLUSONE_THRESHOLD = int(os.environ.get("NPLUSONE_THRESHOLD", 5))
+NPLUSONE_RAISE = os.environ.get("NPLUSONE_RAISE", "").lower() in ("1", "true", "yes", "on")
+
+#metrics served at /metrics (see backend.metrics): every process writes its counts to METRICS_DIR at most every
+#METRICS_FLUSH_INTERVAL seconds and /metrics sums them, the counts of exited processes are kept in one exited.json file.
+#Without METRICS_DIR only the process answering is reported. /metrics is only served with METRICS_TOKEN set, required as a bearer token
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = 5
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -136,6 +187,25 @@ STATIC_URL = "static/"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+#media files are stored once per content, see backend.storage
+STORAGES = {
+    "default": {"BACKEND": "backend.storage.ContentAddressedStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
+#media serving: max-age of files without a content hashed name, and offload of the file transfer to the web server:
+#'' (django streams the file), 'x-accel-redirect' (nginx, internal location at MEDIA_SENDFILE_PREFIX) or 'x-sendfile' (apache, lighttpd)
+MEDIA_CACHE_MAX_AGE = 60*60
+MEDIA_SENDFILE = os.environ.get('MEDIA_SENDFILE', '')
+MEDIA_SENDFILE_PREFIX = os.environ.get('MEDIA_SENDFILE_PREFIX', '/protected-media/')
+
+#uploaded images are validated while streamed, before the default handlers spool them to memory or disk
+FILE_UPLOAD_HANDLERS = [
+    "backend.api.uploads.ImageUploadHandler",
+    "django.core.files.uploadhandler.MemoryFileUploadHandler",
+    "django.core.files.uploadhandler.TemporaryFileUploadHandler",
+]
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -146,6 +216,28 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 AUTH_USER_MODEL = "backend.User"
 
 
+#Cache: redis when REDIS_URL is set, else per process local memory
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+#seconds a user row is cached for token authenticated requests (0 disables the cache)
+USER_CACHE_TIMEOUT = int(os.environ.get("USER_CACHE_TIMEOUT", 60))
+
+#seconds the last_logout of a user is cached for token revocation checks. Without a shared cache a logout reaches other processes after at most this long
+LOGOUT_CACHE_TIMEOUT = int(os.environ.get("LOGOUT_CACHE_TIMEOUT", 300))
+
+
 
 #settings for sending mail
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -155,6 +247,32 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD') 
 
+#email worker pool: worker threads (0 delivers in the request thread), queued mails, seconds to wait on a full queue and seconds before an idle smtp connection is closed
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', 4))
+EMAIL_QUEUE_SIZE = int(os.environ.get('EMAIL_QUEUE_SIZE', 1000))
+EMAIL_QUEUE_TIMEOUT = 5
+EMAIL_IDLE_TIMEOUT = 30
+
+#email outbox: seconds a claimed mail is reserved for its worker, first retry delay in seconds (doubled on every attempt), attempts before giving up
+#and how long sent mails are kept before manage.py compact_tokens deletes them
+EMAIL_OUTBOX_LEASE = 300
+EMAIL_OUTBOX_RETRY_DELAY = 60
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETENTION = timedelta(days=int(os.environ.get('EMAIL_OUTBOX_RETENTION_DAYS', 7)))
+
+#new posts digests: minimum seconds between two digests to a user, max age in seconds of posts included and followers handled per chunk
+DIGEST_INTERVAL = 24*60*60
+DIGEST_LOOKBACK = 7*24*60*60
+DIGEST_CHUNK_SIZE = 500
+
+#resized variants generated for uploaded images (name: max width in px), encoder quality, background workers rendering them (0 renders
+#in the request thread), images waiting for a worker and seconds to wait on a full queue
+IMAGE_VARIANTS = {"thumb": 320, "medium": 960}
+IMAGE_QUALITY = 80
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_SIZE = int(os.environ.get('IMAGE_QUEUE_SIZE', 100))
+IMAGE_QUEUE_TIMEOUT = 5
+
 
 # Only allow requests from specific origins
 CORS_ORIGIN_WHITELIST = [
@@ -172,12 +290,18 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
 
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle'
+        'backend.api.throttling.AnonSlidingRateThrottle',
+        'backend.api.throttling.UserSlidingRateThrottle',
+        'backend.api.throttling.ScopedSlidingRateThrottle',
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '15000/day',
-        'user': '50000/day'
+        'user': '50000/day',
+
+        #scopes of views with throttle_scope
+        'login': '10/min',
+        'signup': '5/min',
+        'email': '5/min',
     },
 }
 
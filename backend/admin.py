@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import User, UserProfile, Tokens, Blog, BlogComments, BlogLikes, ReplyComments, LikeComments
+from .models import User, UserProfile, Tokens, Blog, BlogComments, BlogLikes, ReplyComments, LikeComments, EmailOutbox
 
 # Register your models here.
 
@@ -152,6 +152,11 @@ class LikeCommentsAdmin(admin.ModelAdmin):
     ]
 
 
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ('to_email', 'subject', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+
+
 #Registering user model   
 admin.site.register(User, UserAdmin)
 admin.site.register(UserProfile, UserProfileAdmin)
@@ -160,4 +165,5 @@ admin.site.register(Blog, BlogAdmin)
 admin.site.register(BlogComments, BlogCommentsAdmin)
 admin.site.register(BlogLikes, BlogLikesAdmin)
 admin.site.register(ReplyComments, ReplyCommentsAdmin)
-admin.site.register(LikeComments, LikeCommentsAdmin)
\ No newline at end of file
+admin.site.register(LikeComments, LikeCommentsAdmin)
+admin.site.register(EmailOutbox, EmailOutboxAdmin)
\ No newline at end of file
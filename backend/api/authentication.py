@@ -0,0 +1,58 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+
+from backend.models import User
+
+
+#claims added by MyTokenObtainPairSerializer.get_token -> User field they hold
+CLAIM_FIELDS = {
+    'pk': 'id',
+    'email': 'email',
+    'uuid': 'uuid',
+    'is_verified': 'is_verified',
+}
+
+
+#raise InvalidToken if the token was issued before the user last logged out everywhere, or its user doesn't exist anymore
+def check_token_revoked(token):
+    '''
+    i/p -> validated access or refresh token
+    o/p -> None, raises InvalidToken for revoked tokens. Tokens issued within the same second as the logout are kept
+    '''
+
+    email = token.get(api_settings.USER_ID_CLAIM)
+    if email is None:
+        return
+
+    timestamp = User.get_logout_timestamp(email)
+    if timestamp is None:
+        raise InvalidToken("User not found.")
+
+    if token.get('iat', 0) < timestamp:
+        raise InvalidToken("Token has been revoked.")
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    '''
+    builds request.user from the cached row of the user (see User.get_cached_row) instead of querying the User table on every
+    request, only the password stays deferred. Deleted and deactivated users are rejected like JWTAuthentication does, once
+    their cached row is dropped when the change commits. Tokens issued before these claims existed fall back to the normal
+    db lookup
+    '''
+
+    def get_user(self, validated_token):
+        check_token_revoked(validated_token)
+
+        if any(claim not in validated_token for claim in CLAIM_FIELDS):
+            return super().get_user(validated_token)
+
+        claims = {field: validated_token[claim] for claim, field in CLAIM_FIELDS.items()}
+        row = User.get_cached_row(claims['id'])
+        if row is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+
+        if not row['is_active']:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+
+        return User.from_claims({**claims, **row})
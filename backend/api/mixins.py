@@ -0,0 +1,42 @@
+from rest_framework.permissions import SAFE_METHODS
+
+from backend.db.transaction import write_transaction
+from backend import metrics
+
+
+#for views writing to the database
+class WriteTransactionMixin:
+    '''
+    runs the handler of unsafe methods (post, put, patch, delete) in a write transaction retried while the database is locked.
+    Authentication, permissions and throttling run before it, once per request
+    '''
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        method = request.method.lower()
+        if request.method not in SAFE_METHODS and hasattr(self, method):
+            #view instances are per request, the wrapped handler only shadows the method for this request
+            setattr(self, method, write_transaction(getattr(self, method)))
+
+
+#for the auth views: login, token refresh, signup, email verification, password reset and logout
+class AuthEventMixin:
+    '''
+    counts the responses in metrics.auth_events, as the event auth_events names for the request method ({method: event}), by
+    result: success, rejected (4xx, eg. wrong password or throttled) or error (5xx). Exceptions turned into responses by the
+    view are counted too
+    '''
+
+    auth_events = {}
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        event = self.auth_events.get(request.method)
+        if event is not None:
+            status = response.status_code
+            result = 'success' if status < 400 else 'rejected' if status < 500 else 'error'
+            metrics.auth_events.inc(event=event, result=result)
+
+        return response
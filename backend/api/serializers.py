@@ -2,51 +2,132 @@ from typing import Any, Dict
 from django.utils.encoding import force_str
 from django.utils.http import urlsafe_base64_decode
 from django.utils import timezone
-from rest_framework import serializers
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from django.contrib.auth.signals import user_login_failed
+from django.core.files.storage import default_storage
+from django.db import transaction, IntegrityError
+from rest_framework import serializers, exceptions
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 
 from backend.models import User, UserProfile, Tokens, Blog, BlogComments, BlogLikes, ReplyComments, LikeComments
 from backend.utils import TokenGenerator, EmailSender
+from backend.db.transaction import write_transaction
 
+from .authentication import check_token_revoked
 from .utils import str_to_list, list_to_str, is_valid_sequence, ALLOWED_IMG_TYPES, IMG_MAX_SIZE
 
 
-#serializer for custom claims: access token -> uuid, first_name, last_name
+#for serializers accepting image uploads
+class UploadErrorsMixin:
+    '''
+    reports the uploads aborted by ImageUploadHandler while they were streamed, the aborted files are missing from the data
+    '''
+
+    def to_internal_value(self, data):
+        request = self.context.get('request', None)
+        upload_errors = getattr(request, 'upload_errors', None)
+        if upload_errors:
+            raise serializers.ValidationError(upload_errors)
+
+        return super().to_internal_value(data)
+
+
+#counts annotated by User.objects.with_counts() on listed users, counted with a query otherwise
+def user_count(user, name, count):
+    value = getattr(user, name, None) if user is not None else None
+    return count() if value is None else value
+
+
+#field for the resized variants of an image: {"thumb": {"width", "height", "webp": url, "jpeg": url}, ...}
+class ImageVariantsField(serializers.ReadOnlyField):
+    '''
+    srcset-style map of the variant urls of an image field. Empty until the variants are generated, clients use the original image meanwhile
+    '''
+
+    def to_representation(self, variants):
+        request = self.context.get('request', None)
+        representation = {}
+
+        for label, variant in (variants or {}).items():
+            if label == 'src':
+                continue
+
+            representation[label] = {}
+            for key, value in variant.items():
+                if key not in ('width', 'height'):
+                    value = default_storage.url(value)
+                    if request is not None:
+                        value = request.build_absolute_uri(value)
+                representation[label][key] = value
+
+        return representation
+
+
+#serializer for custom claims: access token -> pk, uuid, is_verified, first_name, last_name
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
 
         # Add custom claims
+        token['pk'] = user.pk
         token['uuid'] = str(user.uuid)
+        token['is_verified'] = user.is_verified
         token['first_name'] = user.first_name
         token['last_name'] = user.last_name
 
         return token
     
     def validate(self, attrs: Dict[str, Any]) -> Dict[str, str]:
-        data = super().validate(attrs)
-        
-        password = attrs.get('password', None)
         email = attrs.get('email', None)
-        if email and password:
-            try:
-                user = User.objects.get(email=email)
-            except User.DoesNotExist:
-                raise serializers.ValidationError({
-                    'email': 'Account with this email does not exists.'
-                })
+        password = attrs.get('password', None)
+
+        #single lookup, unknown emails are rejected without paying for the password hasher. They get the same error as a wrong
+        #password, and only the owner of an unverified account learns it is unverified
+        user = User.objects.filter(email=email).first()
+        if user is None or not user.check_password(password) or not api_settings.USER_AUTHENTICATION_RULE(user):
+            user_login_failed.send(sender=__name__, credentials={'email': email}, request=self.context.get('request'))
+            raise exceptions.AuthenticationFailed(
+                self.error_messages["no_active_account"],
+                "no_active_account",
+            )
+
+        if not user.is_verified:
+            raise serializers.ValidationError({
+                'email': 'Email is not verified.'
+            })
+
+        self.user = user
+        return self.issue_tokens(user)
+
+    #the writes of a login (outstanding token, last_login), in a write transaction taken once the password hasher is done
+    @write_transaction
+    def issue_tokens(self, user):
+        refresh = self.get_token(user)
+        data = {
+            "refresh": str(refresh),
+            "access": str(refresh.access_token),
+        }
+
+        #plain UPDATE of last_login instead of saving the whole user and firing its signals
+        if api_settings.UPDATE_LAST_LOGIN:
+            User.objects.filter(pk=user.pk).update(last_login=timezone.now())
+            User.clear_cached_row(user.pk)
 
-            if not user.is_verified:
-                raise serializers.ValidationError({
-                    'email': 'Email is not verified.'
-                })
-        
-        
         return data
 
 
 
+#serializer for refreshing tokens, rejects refresh tokens revoked by logout everywhere
+class MyTokenRefreshSerializer(TokenRefreshSerializer):
+
+    def validate(self, attrs: Dict[str, Any]) -> Dict[str, str]:
+        check_token_revoked(self.token_class(attrs['refresh']))
+
+        return super().validate(attrs)
+
+
+
 class UserSignupSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -58,13 +139,12 @@ class UserSignupSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         '''
-        Overriding create method since password is not hashed by default 
+        Overriding create method since password is not hashed by default. The password is hashed before the write lock is
+        taken, only the insert of the user (with its profile and verification mail) runs in the write transaction
         '''
-        user = User.objects.create_user(
-            email=validated_data.get("email"), 
-            password = validated_data.get("password")
-        )
-        user.save()
+        user = User(email=User.objects.normalize_email(validated_data.get("email")))
+        user.set_password(validated_data.get("password"))
+        write_transaction(user.save)()
 
         return user
     
@@ -226,18 +306,23 @@ class ResetPasswordSerializer(serializers.Serializer):
 
         uid = force_str(urlsafe_base64_decode(uidb64))
         user = User.objects.get(pk=uid)
+
+        #hashed before the write lock is taken
+        user.set_password(password)
+        self.reset_password(user, token)
+
+        return user
+
+    @write_transaction
+    def reset_password(self, user, token):
         db_token = Tokens.objects.get(token=token, user=user, is_expired=False)
         db_token.is_expired = True
         db_token.save()
 
-        user.set_password(password)
         user.save()
 
         #sending email to notify user
         EmailSender(user.email).reset_password_notify()
-
-
-        return user
         
 
 #serializer for User model for public profile
@@ -247,14 +332,15 @@ class UserPublicSerializer(serializers.ModelSerializer):
     '''
 
     blogs_published = serializers.SerializerMethodField()
+    profile_pic_variants = ImageVariantsField()
 
     class Meta:
         model = User
-        fields = ['uuid', 'first_name', 'last_name', 'profile_pic', 'profession', 'country', 'blogs_published']
+        fields = ['uuid', 'first_name', 'last_name', 'profile_pic', 'profile_pic_variants', 'profile_pic_width', 'profile_pic_height', 'profile_pic_color', 'profile_pic_blurhash', 'profession', 'country', 'blogs_published']
         
     
     def get_blogs_published(self, obj):
-        return Blog.objects.filter(user=obj).count()
+        return user_count(obj, 'blogs_no', lambda: Blog.objects.filter(user=obj).count())
 
 
 #serializer for UserProfile model
@@ -277,32 +363,37 @@ class UserProfileSerializer(serializers.ModelSerializer):
     def get_interests_parsed(self, obj):
         return str_to_list(obj.interests)
     
+    #the user of a profile selected with its user carries the counts
+    def get_user(self, obj):
+        return obj.user if UserProfile.user.is_cached(obj) else None
+
     def get_followers(self, obj):
-            return obj.followers.all().count()
+        return user_count(self.get_user(obj), 'followers_no', lambda: obj.followers.all().count())
     
 
     def get_following(self, obj):
-        return obj.following.all().count()
+        return user_count(self.get_user(obj), 'following_no', lambda: obj.following.all().count())
 
         
 
 #serializer for User model for private profile
-class UserPrivateSerializer(serializers.ModelSerializer):
+class UserPrivateSerializer(UploadErrorsMixin, serializers.ModelSerializer):
     '''
     mainly used for user/me/ endpoint, to get the user's profile when user requests his profile
     '''
 
     user_profile = UserProfileSerializer()
     blogs_published_no = serializers.SerializerMethodField()
+    profile_pic_variants = ImageVariantsField()
 
     class Meta:
         model = User
-        fields = ['uuid', 'email', 'phone', 'is_verified', 'date_joined', 'first_name', 'last_name', 'profile_pic', 'profession', 'country', 'user_profile', 'blogs_published_no']
+        fields = ['uuid', 'email', 'phone', 'is_verified', 'date_joined', 'first_name', 'last_name', 'profile_pic', 'profile_pic_variants', 'profession', 'country', 'user_profile', 'blogs_published_no']
         read_only_fields = ['uuid', 'email', 'is_verified', 'date_joined']
 
 
     def get_blogs_published_no(self, obj):
-        return Blog.objects.filter(user=obj).count()
+        return user_count(obj, 'blogs_no', lambda: Blog.objects.filter(user=obj).count())
 
 
     def validate_phone(self, phone):
@@ -370,14 +461,15 @@ class PeoplePublicSerializer(serializers.ModelSerializer):
 
     user_profile = UserProfileSerializer(read_only=True)
     blogs_published_no = serializers.SerializerMethodField()
+    profile_pic_variants = ImageVariantsField()
 
     class Meta:
         model = User
-        fields = ['uuid', 'first_name', 'last_name', 'profile_pic', 'profession', 'country', 'blogs_published_no', 'user_profile']
+        fields = ['uuid', 'first_name', 'last_name', 'profile_pic', 'profile_pic_variants', 'profession', 'country', 'blogs_published_no', 'user_profile']
 
 
     def get_blogs_published_no(self, obj):
-        return Blog.objects.filter(user=obj).count()
+        return user_count(obj, 'blogs_no', lambda: Blog.objects.filter(user=obj).count())
 
     def update(self, instance, validated_data):
         return None
@@ -387,15 +479,16 @@ class PeoplePublicSerializer(serializers.ModelSerializer):
 
 
 #serializer for blog model --> retrieve, update, delete. Shows detail view of blog
-class BlogDetailSerializer(serializers.ModelSerializer):
+class BlogDetailSerializer(UploadErrorsMixin, serializers.ModelSerializer):
 
     user = UserPublicSerializer(read_only=True)
     tags_parsed = serializers.SerializerMethodField('get_tags_parsed')
     tags = serializers.ListField(child=serializers.CharField(max_length=350), write_only=True, required=True)
+    header_img_variants = ImageVariantsField()
 
     class Meta:
         model = Blog
-        fields = ["uuid", "user", "created_at", "title", "slug", "header_img", "content", "tags", "tags_parsed", "likes_no", "comments_no", "published"]
+        fields = ["uuid", "user", "created_at", "title", "slug", "header_img", "header_img_variants", "header_img_width", "header_img_height", "header_img_color", "header_img_blurhash", "content", "tags", "tags_parsed", "likes_no", "comments_no", "published"]
         read_only_fields = ["uuid", "user", "created_at", "slug", "likes_no", "comments_no", "content_summery", "tags_parsed"]
 
     def tags_validate(self, tags):
@@ -432,17 +525,18 @@ class BlogDetailSerializer(serializers.ModelSerializer):
 
 
 #serializer for blog model --> list and create. Shows minimal view of blog
-class BlogListCreateSerializer(serializers.ModelSerializer):
+class BlogListCreateSerializer(UploadErrorsMixin, serializers.ModelSerializer):
 
     user = UserPublicSerializer(read_only=True)
     truncated_content = serializers.SerializerMethodField('get_truncated_content')
     tags_parsed = serializers.SerializerMethodField('get_tags_parsed')
     tags = serializers.ListField(child=serializers.CharField(max_length=350), write_only=True, required=True)
+    header_img_variants = ImageVariantsField()
 
     
     class Meta:
         model = Blog
-        fields = ["uuid", "user", "created_at", "title", "slug", "header_img", "content", "truncated_content", "tags", "tags_parsed", "likes_no", "comments_no", "published"]
+        fields = ["uuid", "user", "created_at", "title", "slug", "header_img", "header_img_variants", "header_img_width", "header_img_height", "header_img_color", "header_img_blurhash", "content", "truncated_content", "tags", "tags_parsed", "likes_no", "comments_no", "published"]
         read_only_fields = ["uuid", "user", "created_at", "slug", "likes_no", "comments_no", "content_summery", "tags_parsed"]
         extra_kwargs = {
             'content': {'write_only': True},
@@ -567,11 +661,8 @@ class ReplyCommentsSerializer(serializers.ModelSerializer):
 
     user = UserPublicSerializer(read_only=True)
 
-    reply_comments = serializers.SerializerMethodField()
-
-    def get_reply_comments(self, obj):
-        children = ReplyComments.objects.filter(parent_reply_comment=obj)
-        return children.count()
+    #replies of the reply, kept by the signals in comments_no
+    reply_comments = serializers.IntegerField(source='comments_no', read_only=True)
 
     class Meta:
         model = ReplyComments
@@ -599,15 +690,6 @@ class ReplyCommentsSerializer(serializers.ModelSerializer):
 class BlogCommentsSerializer(serializers.ModelSerializer):
 
     user = UserPublicSerializer(read_only=True)
-    
-    comments_no = serializers.SerializerMethodField()
-    likes_no = serializers.SerializerMethodField()
-
-    def get_comments_no(self, obj):
-        return obj.reply_comments.count()
-    
-    def get_likes_no(self, obj):
-        return obj.like_blog_comments.count()
 
     class Meta:
         model = BlogComments
@@ -644,6 +726,17 @@ class BlogLikesSerializer(serializers.ModelSerializer):
         return super().validate(data)
 
 
+    #a concurrent like of the same user is rejected by the unique constraint
+    def create(self, validated_data):
+        try:
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError:
+            raise serializers.ValidationError({
+                'user': 'user has already liked this blog.'
+            })
+
+
 
 #serializer for comment likes
 class CommentsLikeSerializer(serializers.ModelSerializer):
@@ -689,7 +782,15 @@ class CommentsLikeSerializer(serializers.ModelSerializer):
                 like.parent_blog_comment = parent_blog_comment
             else:
                 like.parent_reply_comment = parent_reply_comment
-            like.save()
+
+            #a concurrent like of the same user is rejected by the unique constraint
+            try:
+                with transaction.atomic():
+                    like.save()
+            except IntegrityError:
+                raise serializers.ValidationError({
+                    'user': 'user has already liked this comment.'
+                })
 
             return like
 
@@ -0,0 +1,72 @@
+from rest_framework.throttling import (
+    SimpleRateThrottle,
+    AnonRateThrottle,
+    UserRateThrottle,
+    ScopedRateThrottle,
+)
+
+
+class SlidingWindowRateThrottle(SimpleRateThrottle):
+    '''
+    sliding window counter throttle. Keeps two integer counters per client in the shared cache (current and previous window)
+    instead of a list of request timestamps, so memory and cost per request stay constant whatever the rate is.
+    The request count is estimated as: previous * (unelapsed part of the window) + current. Only allowed requests are counted,
+    so a client retrying while throttled gets through again once its rate drops below the limit.
+    '''
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        window = int(self.now // self.duration)
+        current_key = f"{self.key}_{window}"
+
+        #add is a no-op if the counter exists, incr is atomic on redis and locmem
+        self.cache.add(current_key, 0, self.duration * 2)
+        try:
+            self.current = self.cache.incr(current_key)
+        except ValueError:
+            #counter was evicted between add and incr
+            self.cache.set(current_key, 1, self.duration * 2)
+            self.current = 1
+
+        self.previous = self.cache.get(f"{self.key}_{window - 1}", 0)
+        self.elapsed = self.now % self.duration
+
+        estimate = self.previous * (1 - self.elapsed / self.duration) + self.current
+        if estimate > self.num_requests:
+            #incremented first so concurrent requests can't all pass, taken back as the request is denied
+            try:
+                self.cache.decr(current_key)
+            except ValueError:
+                pass
+            return self.throttle_failure()
+
+        return True
+
+    def wait(self):
+        #time until the previous window's share has dropped enough, else until the next window
+        if self.previous and self.current <= self.num_requests:
+            return max(0, self.duration * (1 - (self.num_requests - self.current) / self.previous) - self.elapsed)
+
+        return self.duration - self.elapsed
+
+
+#limits the requests of anonymous users, keyed by ip
+class AnonSlidingRateThrottle(SlidingWindowRateThrottle, AnonRateThrottle):
+    pass
+
+
+#limits the requests of a user, keyed by user pk (or ip for anonymous users)
+class UserSlidingRateThrottle(SlidingWindowRateThrottle, UserRateThrottle):
+    pass
+
+
+#limits the requests to views with a throttle_scope, eg. the stricter login, signup and email scopes
+class ScopedSlidingRateThrottle(ScopedRateThrottle, SlidingWindowRateThrottle):
+    pass
@@ -0,0 +1,84 @@
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from PIL import Image
+
+from io import BytesIO
+
+from .utils import IMG_MAX_SIZE, IMG_MAX_PIXELS, IMG_HEADER_MAX_SIZE, IMG_MAGIC_BYTES
+
+
+#validates uploaded images while they are streamed, before they are spooled to memory or disk
+class ImageUploadHandler(FileUploadHandler):
+    '''
+    First handler of FILE_UPLOAD_HANDLERS, passes every chunk on to the next handlers unchanged. An upload is aborted as soon as
+    1. it grows over IMG_MAX_SIZE
+    2. its first bytes are not a jpeg or png signature
+    3. its header declares more than IMG_MAX_PIXELS pixels (decompression bomb), checked before anything is decoded
+    The rest of the request body is read and discarded, not stored, so that the client gets the 400 instead of a reset
+    connection. The error is kept in request.upload_errors for the serializers to report
+    '''
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+        self.header = b''
+        self.sniffed = False
+
+        if self.content_length is not None and self.content_length > IMG_MAX_SIZE:
+            self.reject(f'Image size should be less than {IMG_MAX_SIZE/(1024*1024)} MB.')
+
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > IMG_MAX_SIZE:
+            self.reject(f'Image size should be less than {IMG_MAX_SIZE/(1024*1024)} MB.')
+
+        if not self.sniffed:
+            self.header += raw_data[:IMG_HEADER_MAX_SIZE - len(self.header)]
+            self.sniff()
+
+        return raw_data
+
+
+    def file_complete(self, file_size):
+        if not self.sniffed:
+            self.sniff(complete=True)
+
+        #the next handlers build the uploaded file
+        return None
+
+
+    #checks the signature and the declared dimensions, from the header bytes received so far
+    def sniff(self, complete=False):
+        header_complete = complete or len(self.header) >= IMG_HEADER_MAX_SIZE
+
+        signature = self.header[:8]
+        if not any(magic.startswith(signature) or signature.startswith(magic) for magic in IMG_MAGIC_BYTES):
+            self.reject('Only jpg, jpeg, png files are allowed.')
+        if len(signature) < 8 and not header_complete:
+            return
+
+        #only parses the header, no pixel is decoded or allocated
+        try:
+            image = Image.open(BytesIO(self.header), formats=['JPEG', 'PNG'])
+            width, height = image.size
+        except Image.DecompressionBombError:
+            self.reject('Image dimensions are too large.')
+        except Exception:
+            #the dimensions may be further in the file, eg. after a large exif block
+            if header_complete:
+                self.reject('Only jpg, jpeg, png files are allowed.')
+            return
+
+        if width * height > IMG_MAX_PIXELS:
+            self.reject('Image dimensions are too large.')
+
+        self.sniffed = True
+
+
+    def reject(self, message):
+        upload_errors = getattr(self.request, 'upload_errors', {})
+        upload_errors[self.field_name] = [message]
+        self.request.upload_errors = upload_errors
+
+        raise StopUpload(connection_reset=False)
@@ -3,6 +3,9 @@ from rest_framework_simplejwt.tokens import RefreshToken
 
 ALLOWED_IMG_TYPES = ['jpg', 'jpeg', 'png']
 IMG_MAX_SIZE = 6*1024*1024      #6MB
+IMG_MAX_PIXELS = 40*1000*1000    #40 megapixels, eg. 8000x5000
+IMG_HEADER_MAX_SIZE = 256*1024  #bytes read to find the image dimensions
+IMG_MAGIC_BYTES = [b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n']    #jpeg, png
 
 
 #returns access and refresh tokens for a user
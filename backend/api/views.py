@@ -1,5 +1,5 @@
 from django.http import Http404
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -18,11 +18,13 @@ from rest_framework.status import (
     HTTP_500_INTERNAL_SERVER_ERROR
 )
 
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
-from rest_framework_simplejwt.views import TokenObtainPairView
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from rest_framework.filters import OrderingFilter
 
+from .authentication import StatelessJWTAuthentication
+from .mixins import WriteTransactionMixin, AuthEventMixin
+from backend.db.transaction import write_transaction
 from .permission import (
     IsOwner,
     IsOwnerOrReadOnly,
@@ -31,6 +33,7 @@ from .permission import (
 
 from .serializers import (
     MyTokenObtainPairSerializer,
+    MyTokenRefreshSerializer,
 
     UserSignupSerializer,
 
@@ -71,14 +74,50 @@ from .filters import (
 )
 
 
+#authors of the listed rows with their blog counts, fetched in one query for the whole page
+def with_authors(queryset):
+    return queryset.prefetch_related(Prefetch('user', queryset=User.objects.with_counts(follows=False)))
+
+
 # Create your views here.
 
-#view for login. Serializer is customised to custom claims
-class UserLogin(TokenObtainPairView):
+#view for login. Serializer is customised to custom claims. Not a WriteTransactionMixin view: the password hasher runs
+#before the serializer takes the write lock for the token
+class UserLogin(AuthEventMixin, TokenObtainPairView):
     serializer_class = MyTokenObtainPairSerializer
+    auth_events = {'POST': 'login'}
+    throttle_scope = 'login'
+
+
+#view for refreshing tokens. Serializer is customised to reject revoked tokens
+class TokenRefresh(AuthEventMixin, WriteTransactionMixin, TokenRefreshView):
+    serializer_class = MyTokenRefreshSerializer
+    auth_events = {'POST': 'token_refresh'}
+
 
+#revoke every token of the logged in user, on all devices
+class LogoutEverywhere(AuthEventMixin, WriteTransactionMixin, APIView):
+
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    auth_events = {'POST': 'logout_everywhere'}
+
+    def post(self, request):
+        request.user.logout_everywhere()
 
-class UserSignup(APIView):
+        response = {
+            "status": HTTP_200_OK,
+            "message": "Logged out from all devices.",
+            "error": None
+        }
+
+        return Response(response, status=HTTP_200_OK)
+
+
+#the serializer hashes the password before taking the write lock for the insert
+class UserSignup(AuthEventMixin, APIView):
+    throttle_scope = 'signup'
+    auth_events = {'POST': 'signup'}
     
     def post(self, request):
 
@@ -134,7 +173,9 @@ class UserSignup(APIView):
 
 
 
-class EmailVerify(APIView):
+class EmailVerify(AuthEventMixin, WriteTransactionMixin, APIView):
+    throttle_scope = 'email'
+    auth_events = {'GET': 'email_verify_link', 'POST': 'email_verify'}
 
     def get(self, request):
         try:
@@ -207,8 +248,13 @@ class EmailVerify(APIView):
 
 
 
-class ResetPassword(APIView):
+#the reset serializer hashes the new password before taking the write lock for its writes
+class ResetPassword(AuthEventMixin, APIView):
+    throttle_scope = 'email'
+    auth_events = {'GET': 'password_reset_link', 'POST': 'password_reset'}
     
+    #the token and its mail are written in one transaction
+    @write_transaction
     def get(self, request):
         try:
             serializer = ResetPasswordLinkSendSerializer(data=request.query_params)
@@ -282,8 +328,8 @@ class ResetPassword(APIView):
 
 
 
-class UserPrivateProfile(RetrieveUpdateAPIView):
-    authentication_classes = [JWTAuthentication]
+class UserPrivateProfile(WriteTransactionMixin, RetrieveUpdateAPIView):
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated]
 
     serializer_class = UserPrivateSerializer
@@ -299,7 +345,7 @@ class UserPrivateProfile(RetrieveUpdateAPIView):
 #list all people/users with country and name filters
 class PeopleList(ListAPIView):
     serializer_class = PeoplePublicSerializer
-    queryset = User.objects.all()
+    queryset = User.objects.with_counts()
     filter_backends = [CountryFilterBackend, NameFilterBackend, PopularFilterBackend]
 
 
@@ -308,14 +354,14 @@ class PeopleList(ListAPIView):
 class PeopleRetrieve(RetrieveAPIView):
 
     serializer_class = PeoplePublicSerializer
-    queryset = User.objects.all()
+    queryset = User.objects.with_counts()
     lookup_field = 'uuid'
     
 
 #list following of a user who is logged in
 class UserFollowingList(ListAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated]
     filter_backends = [CountryFilterBackend, NameFilterBackend]
     http_method_names = ['get']
@@ -324,13 +370,13 @@ class UserFollowingList(ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        return UserProfile.objects.get(user=user).following.all()
+        return UserProfile.objects.get(user=user).following.with_counts()
     
 
 #list followers of a user who is logged in
 class UserFollowersList(ListAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated]
     filter_backends = [CountryFilterBackend, NameFilterBackend]
     http_method_names = ['get']
@@ -339,7 +385,7 @@ class UserFollowersList(ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        return UserProfile.objects.get(user=user).followers.all()
+        return UserProfile.objects.get(user=user).followers.with_counts()
 
 
 #list followers of a user
@@ -357,14 +403,14 @@ class FollowersList(ListAPIView):
         
     def get_user_profile(self, user):
         try:
-            return UserProfile.objects.prefetch_related('followers').get(user=user)
+            return UserProfile.objects.get(user=user)
         except UserProfile.DoesNotExist:
             raise Http404
         
     def get_followers(self, user):
         try:
             profile = self.get_user_profile(user)
-            return profile.followers.all()
+            return profile.followers.with_counts()
         except UserProfile.DoesNotExist:
             raise Http404
 
@@ -391,14 +437,14 @@ class FollowingList(ListAPIView):
         
     def get_user_profile(self, user):
         try:
-            return UserProfile.objects.prefetch_related('following').get(user=user)
+            return UserProfile.objects.get(user=user)
         except UserProfile.DoesNotExist:
             raise Http404
         
     def get_following(self, user):
         try:
             profile = self.get_user_profile(user)
-            return profile.following.all()
+            return profile.following.with_counts()
         except UserProfile.DoesNotExist:
             raise Http404
 
@@ -411,9 +457,9 @@ class FollowingList(ListAPIView):
 
 
 #check or add or delete following and followers of user
-class FollowUnfollow(APIView):
+class FollowUnfollow(WriteTransactionMixin, APIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get_user(self, uuid):
@@ -481,7 +527,7 @@ class UserBlogsList(ListAPIView):
         2. Filter blog listing based on blog title, author name, author uuid query params
         '''
     
-        authentication_classes = [JWTAuthentication]
+        authentication_classes = [StatelessJWTAuthentication]
         permission_classes = [IsAuthenticated]
         filter_backends = [LatestFilterBackend]
     
@@ -490,23 +536,23 @@ class UserBlogsList(ListAPIView):
     
         def get_queryset(self):
             user = self.request.user
-            return Blog.objects.filter(user=user)
+            return with_authors(Blog.objects.filter(user=user))
 
 
 #list and create blogs
-class BlogListCreate(ListCreateAPIView):
+class BlogListCreate(WriteTransactionMixin, ListCreateAPIView):
     '''
     1. List the published blogs
     2. Create new blogs with logged in user
     3. Filter blog listing based on blog title, author name, author uuid query params
     '''
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [LatestFilterBackend, BlogFilterBackend]
 
     serializer_class = BlogListCreateSerializer
-    queryset = Blog.objects.filter(published = True)
+    queryset = with_authors(Blog.objects.filter(published = True))
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -519,14 +565,14 @@ class BlogListCreate(ListCreateAPIView):
 
 
 #retrieve, update, delete blogs
-class BlogRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
+class BlogRetrieveUpdateDelete(WriteTransactionMixin, RetrieveUpdateDestroyAPIView):
     '''
     1. Retrieve the blogs with uuid
     2. Update the blog if author is logged in
     3. Delete the blog if author is logged in
     '''
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [BlogPermission]
 
     serializer_class = BlogDetailSerializer
@@ -536,9 +582,9 @@ class BlogRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
 
 
 #list and create blog comments of a specific blog post
-class BlogCommentListCreate(ListCreateAPIView):
+class BlogCommentListCreate(WriteTransactionMixin, ListCreateAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticatedOrReadOnly]
     serializer_class = BlogCommentsSerializer
     filter_backends = [LatestFilterBackend]
@@ -551,7 +597,7 @@ class BlogCommentListCreate(ListCreateAPIView):
 
     def get_queryset(self):
         uuid = self.kwargs['uuid']
-        return BlogComments.objects.filter(blog__uuid=uuid).order_by('-created_at')
+        return with_authors(BlogComments.objects.filter(blog__uuid=uuid).order_by('-created_at'))
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -567,9 +613,9 @@ class BlogCommentListCreate(ListCreateAPIView):
     
 
 #retrieve, update and destroy a blog comments
-class BlogCommentRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
+class BlogCommentRetrieveUpdateDelete(WriteTransactionMixin, RetrieveUpdateDestroyAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsOwnerOrReadOnly]
     serializer_class = BlogCommentsSerializer
     queryset = BlogComments.objects.all()
@@ -578,9 +624,9 @@ class BlogCommentRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
 
 
 #list and create reply comments of a specific blog post
-class ReplyCommentListCreate(ListCreateAPIView):
+class ReplyCommentListCreate(WriteTransactionMixin, ListCreateAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticatedOrReadOnly]
     serializer_class = ReplyCommentsSerializer
     filter_backends = [LatestFilterBackend]
@@ -604,11 +650,13 @@ class ReplyCommentListCreate(ListCreateAPIView):
         return obj
 
 
+    #filtering on one parent column at a time lets the (parent, created_at) indexes serve the ordering
     def get_queryset(self):
         uuid = self.kwargs['uuid']
-        return ReplyComments.objects.filter(
-            Q(parent_reply_comment__uuid=uuid) | Q(parent_blog_comment__uuid=uuid)
-        ).order_by('-created_at')
+        if BlogComments.objects.filter(uuid=uuid).exists():
+            return with_authors(ReplyComments.objects.filter(parent_blog_comment__uuid=uuid).order_by('-created_at'))
+
+        return with_authors(ReplyComments.objects.filter(parent_reply_comment__uuid=uuid).order_by('-created_at'))
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -636,9 +684,9 @@ class ReplyCommentListCreate(ListCreateAPIView):
 
 
 #retrieve, update and destroy a reply comments
-class ReplyCommentRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
+class ReplyCommentRetrieveUpdateDelete(WriteTransactionMixin, RetrieveUpdateDestroyAPIView):
     
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsOwnerOrReadOnly]
     serializer_class = ReplyCommentsSerializer
     queryset = ReplyComments.objects.all()
@@ -648,9 +696,9 @@ class ReplyCommentRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
 
 
 #list and create blog likes of a specific blog post
-class BlogLikesListCreate(ListCreateAPIView):
+class BlogLikesListCreate(WriteTransactionMixin, ListCreateAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticatedOrReadOnly]
 
     serializer_class = BlogLikesSerializer
@@ -664,7 +712,7 @@ class BlogLikesListCreate(ListCreateAPIView):
 
     def get_queryset(self):
         uuid = self.kwargs['uuid']
-        return BlogLikes.objects.filter(blog__uuid=uuid).order_by('-created_at')
+        return with_authors(BlogLikes.objects.filter(blog__uuid=uuid).order_by('-created_at'))
 
     def create(self, request, *args, **kwargs):
         blog = self.get_blog(uuid=kwargs['uuid'])
@@ -681,9 +729,9 @@ class BlogLikesListCreate(ListCreateAPIView):
 
 
 #retrieve and destroy a blog likes
-class BlogLikesRetrieveDelete(RetrieveDestroyAPIView):
+class BlogLikesRetrieveDelete(WriteTransactionMixin, RetrieveDestroyAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated, IsOwner]
     serializer_class = BlogLikesSerializer
     lookup_field = "uuid"
@@ -697,9 +745,9 @@ class BlogLikesRetrieveDelete(RetrieveDestroyAPIView):
 
 
 #list and create likes of a specific comment
-class CommentLikesListCreate(ListCreateAPIView):
+class CommentLikesListCreate(WriteTransactionMixin, ListCreateAPIView):
 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticatedOrReadOnly]
     serializer_class = CommentsLikeSerializer
     filter_backends = [LatestFilterBackend]
@@ -724,11 +772,13 @@ class CommentLikesListCreate(ListCreateAPIView):
         return obj
 
 
+    #filtering on one parent column at a time lets the (parent, created_at) indexes serve the ordering
     def get_queryset(self):
         uuid = self.kwargs['uuid']
-        return LikeComments.objects.filter(
-            Q(parent_reply_comment__uuid=uuid) | Q(parent_blog_comment__uuid=uuid)
-        ).order_by('-created_at')
+        if BlogComments.objects.filter(uuid=uuid).exists():
+            return with_authors(LikeComments.objects.filter(parent_blog_comment__uuid=uuid).order_by('-created_at'))
+
+        return with_authors(LikeComments.objects.filter(parent_reply_comment__uuid=uuid).order_by('-created_at'))
     
     def create(self, request, *args, **kwargs):
 
@@ -757,9 +807,9 @@ class CommentLikesListCreate(ListCreateAPIView):
 
 
 #retrieve, update and destroy a like comments
-class CommentLikesRetrieveDelete(RetrieveDestroyAPIView):
+class CommentLikesRetrieveDelete(WriteTransactionMixin, RetrieveDestroyAPIView):
     
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated, IsOwner]
     serializer_class = CommentsLikeSerializer
     lookup_field = "uuid"
@@ -0,0 +1,92 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import router
+from django.db.models.deletion import Collector
+
+from collections import Counter
+
+from backend.db.transaction import write_transaction
+
+
+#splits a list in lists of at most size items
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+#pks of the rows of model whose lookup is in values
+def select_pks(model, lookup, values, using, size):
+    pks = []
+    for chunk in chunked(values, size):
+        pks += model._base_manager.using(using).filter(**{f"{lookup}__in": chunk}).values_list('pk', flat=True)
+    return pks
+
+
+#deletes rows with a plain DELETE: no signals and no cascade, for rows nothing references
+def raw_delete_chunk(model, pks, using):
+    return model._base_manager.using(using).filter(pk__in=pks)._raw_delete(using)
+
+
+#deletes rows through the collector, which also deletes the rows created since their children were deleted
+def collect_delete_chunk(model, pks, using, origin, keep_parents=False):
+    collector = Collector(using, origin=origin)
+    collector.collect(model._base_manager.using(using).filter(pk__in=pks), keep_parents=keep_parents)
+    return collector.delete()[1]
+
+
+#deletes blogs with their comments, replies and likes in bounded chunks
+def delete_blogs(pks, chunk_size=None, using=None, keep_parents=False):
+    '''
+    i/p -> pks of the blogs, max rows deleted per statement (DELETE_CHUNK_SIZE by default), database alias (the write database
+    of Blog by default), keep_parents of Model.delete() for the blogs
+    o/p -> (total deleted, {model label: deleted}) like QuerySet.delete()
+
+    A blog cascade loads every row of its tree and fires pre_delete for each of them, whose counter updates all hit rows being
+    deleted anyway. Instead the tree is deleted bottom up, DELETE_CHUNK_SIZE rows at a time, each chunk in its own write
+    transaction (or in the transaction of the caller): likes with plain DELETEs by pk, then replies deepest level first,
+    comments and the blogs through the collector with the blogs as origin, so the counter handlers know the parents are
+    deleted too and skip them (see backend.signals.parent_is_deleted). Stale counters of the blogs are visible while they are
+    being deleted outside of a transaction.
+    '''
+
+    Blog, BlogComments, BlogLikes, ReplyComments, LikeComments = (
+        apps.get_model('backend', name) for name in ('Blog', 'BlogComments', 'BlogLikes', 'ReplyComments', 'LikeComments')
+    )
+    size = chunk_size or settings.DELETE_CHUNK_SIZE
+    using = using or router.db_for_write(Blog)
+    deleted = Counter()
+
+    #every chunk in a write transaction of the database the blogs are deleted from
+    def raw_delete(model, pks):
+        for chunk in chunked(pks, size):
+            deleted[model._meta.label] += write_transaction(raw_delete_chunk, using)(model, chunk, using)
+
+    def collect_delete(model, pks, origin, keep_parents=False):
+        for chunk in chunked(pks, size):
+            deleted.update(write_transaction(collect_delete_chunk, using)(model, chunk, using, origin, keep_parents))
+
+    for blog_pks in chunked(list(pks), size):
+        origin = Blog._base_manager.using(using).filter(pk__in=blog_pks)
+
+        comment_pks = select_pks(BlogComments, 'blog_id', blog_pks, using, size)
+
+        #replies are a tree under the comments, walked one level at a time
+        levels = []
+        parents = select_pks(ReplyComments, 'parent_blog_comment_id', comment_pks, using, size)
+        while parents:
+            levels.append(parents)
+            parents = select_pks(ReplyComments, 'parent_reply_comment_id', parents, using, size)
+
+        reply_pks = [pk for level in levels for pk in level]
+
+        raw_delete(LikeComments, select_pks(LikeComments, 'parent_reply_comment_id', reply_pks, using, size))
+        raw_delete(LikeComments, select_pks(LikeComments, 'parent_blog_comment_id', comment_pks, using, size))
+        raw_delete(BlogLikes, select_pks(BlogLikes, 'blog_id', blog_pks, using, size))
+
+        for level in reversed(levels):
+            collect_delete(ReplyComments, level, origin)
+        collect_delete(BlogComments, comment_pks, origin)
+        collect_delete(Blog, blog_pks, origin, keep_parents)
+
+    deleted = {label: count for label, count in deleted.items() if count}
+    return sum(deleted.values()), deleted
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.db import connections
+
+import random
+from contextvars import ContextVar
+
+
+#set for the requests whose reads may be served by a replica, see backend.middleware.ReplicaRoutingMiddleware
+read_from_replica = ContextVar('read_from_replica', default=False)
+
+
+#sends the reads of safe requests to the DATABASE_REPLICAS, everything else to the primary (default)
+class ReplicaRouter:
+    '''
+    Only reads explicitly marked with read_from_replica go to a replica, so management commands, background workers and
+    requests writing to the database always read from the primary. Reads inside a transaction of the primary stay on it.
+    '''
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not read_from_replica.get():
+            return None
+        if connections['default'].in_atomic_block:
+            return None
+
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    #replicas hold the same rows as the primary
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    #replicas are copies of the primary, only the primary is migrated
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
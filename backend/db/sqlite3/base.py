@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+#sqlite backend applying SQLITE_PRAGMAS to every new connection
+class DatabaseWrapper(base.DatabaseWrapper):
+    '''
+    The pragmas are run once per connection, so they should be used with CONN_MAX_AGE to keep connections open across requests.
+    With journal_mode = wal readers never wait for a writer and a writer only waits for other writers, up to busy_timeout ms.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #set by backend.db.transaction.write_transaction for the transaction it starts
+        self.begin_immediate = False
+        self.busy_timeout = None
+
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        self.busy_timeout = settings.SQLITE_PRAGMAS.get('busy_timeout')
+
+        return conn
+
+
+    #lowers busy_timeout to the seconds left to a caller, None restores the one of SQLITE_PRAGMAS. The pragma is only run on a change
+    def limit_busy_timeout(self, seconds=None):
+        busy_timeout = settings.SQLITE_PRAGMAS.get('busy_timeout')
+        if busy_timeout is None:
+            return
+
+        self.ensure_connection()
+        if seconds is not None:
+            busy_timeout = max(0, min(busy_timeout, int(seconds * 1000)))
+        if busy_timeout != self.busy_timeout:
+            self.connection.execute(f"PRAGMA busy_timeout = {busy_timeout}")
+            self.busy_timeout = busy_timeout
+
+
+    #BEGIN IMMEDIATE takes the write lock right away, a deferred BEGIN only takes it at the first write
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE" if self.begin_immediate else "BEGIN")
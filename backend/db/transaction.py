@@ -0,0 +1,116 @@
+from django.conf import settings
+from django.db import transaction, OperationalError
+
+import time
+import random
+from functools import wraps
+from threading import Lock
+
+
+#sqlite errors raised when the write lock can't be taken within busy_timeout
+LOCK_ERRORS = ('database is locked', 'database table is locked')
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and any(message in str(error) for message in LOCK_ERRORS)
+
+
+#counters of the write lock contention, for monitoring
+class LockStats:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.transactions = 0
+        self.contended = 0
+        self.retries = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, retries, waited, failed=False):
+        with self.lock:
+            self.transactions += 1
+            self.retries += retries
+            if retries:
+                self.contended += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if failed:
+                self.failed += 1
+
+    def stats(self):
+        return {
+            "transactions": self.transactions,
+            "contended": self.contended,
+            "retries": self.retries,
+            "failed": self.failed,
+            "wait_seconds": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+lock_stats = LockStats()
+
+
+#runs func in a write transaction, retried while the database is locked
+def write_transaction(func=None, using=None):
+    '''
+    The transaction is started with BEGIN IMMEDIATE on sqlite, so the write lock is taken (waiting up to busy_timeout) before
+    anything is read, and a transaction never fails half way when it upgrades from reading to writing. When the lock can't be
+    taken the whole function is run again after a jittered exponential backoff (DB_WRITE_RETRY_DELAY doubling up to
+    DB_WRITE_RETRY_MAX_DELAY), for at most DB_WRITE_MAX_WAIT seconds. The busy_timeout of every attempt is cut to the time
+    left, so that waiting for the lock doesn't run past DB_WRITE_MAX_WAIT either. A transaction which committed is never retried,
+    even when a commit hook fails. Inside an atomic block func just runs, the outermost transaction holds the lock.
+    '''
+
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            connection = transaction.get_connection(using)
+            if connection.in_atomic_block:
+                return func(*args, **kwargs)
+
+            start = time.monotonic()
+            retries = 0
+            limit_busy_timeout = getattr(connection, 'limit_busy_timeout', None)
+            try:
+                while True:
+                    attempt_start = time.monotonic()
+                    committed = []
+                    if limit_busy_timeout is not None:
+                        limit_busy_timeout(settings.DB_WRITE_MAX_WAIT - (attempt_start - start))
+
+                    try:
+                        connection.begin_immediate = True
+                        try:
+                            with transaction.atomic(using=using):
+                                connection.begin_immediate = False
+                                transaction.on_commit(lambda: committed.append(True), using)
+                                result = func(*args, **kwargs)
+                        finally:
+                            connection.begin_immediate = False
+
+                    except OperationalError as e:
+                        if committed or not is_lock_error(e):
+                            raise
+
+                        delay = random.uniform(0, min(settings.DB_WRITE_RETRY_DELAY * 2 ** retries, settings.DB_WRITE_RETRY_MAX_DELAY))
+                        if time.monotonic() + delay - start > settings.DB_WRITE_MAX_WAIT:
+                            lock_stats.record(retries, time.monotonic() - start, failed=True)
+                            raise
+
+                        time.sleep(delay)
+                        retries += 1
+                        continue
+
+                    lock_stats.record(retries, attempt_start - start)
+                    return result
+            finally:
+                if limit_busy_timeout is not None:
+                    limit_busy_timeout()
+
+        return inner
+
+    if func is not None:
+        return decorator(func)
+    return decorator
@@ -0,0 +1,293 @@
+from django.db import close_old_connections
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from PIL import Image, ImageOps
+
+import os
+import math
+import logging
+import posixpath
+import atexit
+from io import BytesIO
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import defer_call
+
+
+logger = logging.getLogger(__name__)
+
+
+#encoder options of the generated variants
+SAVE_OPTIONS = {
+    'jpeg': {'format': 'JPEG', 'optimize': True, 'progressive': True},
+    'png': {'format': 'PNG', 'optimize': True},
+    'webp': {'format': 'WEBP', 'method': 4},
+}
+
+
+#opens an image of the storage, rotated according to its exif orientation and stripped of exif, icc profile and other metadata
+def open_image(name, storage=default_storage):
+    with storage.open(name) as file:
+        image = Image.open(file)
+        image.load()
+
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    image.info = {}
+
+    return image
+
+
+#renders an image into a resized variant for every IMAGE_VARIANTS width, as webp and jpeg (png for transparent images)
+def build_variants(name, image, storage=default_storage):
+    '''
+    i/p -> storage name of the original image, the opened image
+    o/p -> {"src": name, "thumb": {"width", "height", "webp": name, "jpeg": name}, ...}
+    '''
+
+    fallback = 'png' if image.mode == 'RGBA' else 'jpeg'
+    #variants go to a variants/ folder under the upload_to folder of the image
+    directory = posixpath.join(name.split('/')[0], 'variants')
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+
+    variants = {'src': name}
+    for label, max_width in settings.IMAGE_VARIANTS.items():
+        #never upscale
+        if image.width > max_width:
+            size = (max_width, max(1, round(image.height * max_width / image.width)))
+            resized = image.resize(size, Image.LANCZOS)
+        else:
+            resized = image
+
+        variant = {'width': resized.width, 'height': resized.height}
+        for ext in ('webp', fallback):
+            buffer = BytesIO()
+            options = SAVE_OPTIONS[ext]
+            if ext != 'png':
+                options = {**options, 'quality': settings.IMAGE_QUALITY}
+            resized.save(buffer, **options)
+
+            variant[ext] = storage.save(posixpath.join(directory, f"{stem}-{label}.{ext}"), ContentFile(buffer.getvalue()))
+
+        variants[label] = variant
+
+    return variants
+
+
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def base83(value, length):
+    return ''.join(BASE83[value // 83 ** (length - i) % 83] for i in range(1, length + 1))
+
+
+def srgb_to_linear(value):
+    value = value / 255
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+
+def linear_to_srgb(value):
+    value = min(max(value, 0), 1)
+    return int(value * 12.92 * 255 + 0.5) if value <= 0.0031308 else int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+#blurhash (https://blurha.sh) of an image, a ~30 characters string clients decode into a blurred placeholder
+def blurhash(image, x_components=4, y_components=3):
+    small = image.convert('RGB').resize((32, 32), Image.BILINEAR)
+    width, height = small.size
+    pixels = [tuple(srgb_to_linear(channel) for channel in pixel) for pixel in small.getdata()]
+
+    factors = []
+    for j in range(y_components):
+        basis_y = [math.cos(math.pi * j * y / height) for y in range(height)]
+        for i in range(x_components):
+            basis_x = [math.cos(math.pi * i * x / width) for x in range(width)]
+            normalisation = 1 if i == j == 0 else 2
+
+            r = g = b = 0
+            for y in range(height):
+                for x in range(width):
+                    basis = basis_x[x] * basis_y[y]
+                    pixel = pixels[y * width + x]
+                    r += basis * pixel[0]
+                    g += basis * pixel[1]
+                    b += basis * pixel[2]
+
+            scale = normalisation / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = base83((x_components - 1) + (y_components - 1) * 9, 1)
+
+    if ac:
+        quantised_max = max(0, min(82, int(max(abs(value) for factor in ac for value in factor) * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+    else:
+        quantised_max, max_value = 0, 1
+    result += base83(quantised_max, 1)
+
+    result += base83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+
+    def quantise(value):
+        value = value / max_value
+        return max(0, min(18, int(math.copysign(abs(value) ** 0.5, value) * 9 + 9.5)))
+
+    for factor in ac:
+        result += base83(quantise(factor[0]) * 19 * 19 + quantise(factor[1]) * 19 + quantise(factor[2]), 2)
+
+    return result
+
+
+#most common color of an image, as #rrggbb
+def dominant_color(image):
+    palette_image = image.convert('RGB').resize((64, 64), Image.BILINEAR).quantize(colors=5)
+    count, index = max(palette_image.getcolors())
+    r, g, b = palette_image.getpalette()[index * 3:index * 3 + 3]
+
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+#what clients need to lay out an image before loading it: displayed size, dominant color and blurhash placeholder
+def describe_image(image):
+    return {
+        'width': image.width,
+        'height': image.height,
+        'color': dominant_color(image),
+        'blurhash': blurhash(image),
+    }
+
+
+#(re)generates the variants of an image field of a row, stored in the <field>_variants json field, and its <field>_width,
+#<field>_height, <field>_color and <field>_blurhash columns
+def generate_variants(model_label, pk, field_name):
+    model = apps.get_model(model_label)
+    variants_field = f"{field_name}_variants"
+    width_field = f"{field_name}_width"
+
+    row = model._base_manager.filter(pk=pk).values(field_name, variants_field, width_field).first()
+    if row is None:
+        return
+
+    name, old_variants = row[field_name], row[variants_field] or {}
+    if not name or (old_variants.get('src') == name and row[width_field] is not None):
+        return
+
+    image = open_image(name)
+    updates = {f"{field_name}_{key}": value for key, value in describe_image(image).items()}
+    updates[variants_field] = build_variants(name, image)
+
+    #only stored if the image wasn't replaced while the variants were rendered. Files which end up unused are removed by collect_media
+    updated = model._base_manager.filter(pk=pk, **{field_name: name}).update(**updates)
+    if updated and hasattr(model, 'clear_cached_row'):
+        model.clear_cached_row(pk)
+
+
+#queues the variants generation of an image field once the transaction commits, if the image changed
+def queue_variants(instance, field_name):
+    name = getattr(instance, field_name).name
+    variants = getattr(instance, f"{field_name}_variants") or {}
+
+    if name and variants.get('src') != name:
+        defer_call(image_pool.submit, (instance._meta.label, instance.pk, field_name))
+
+
+#for generating image variants
+class ImageWorkerPool:
+    '''
+    Renders image variants in IMAGE_WORKERS background threads, so uploads return as soon as the original is saved.
+    Until a variant is ready clients fall back to the original image. At most IMAGE_QUEUE_SIZE images wait for a worker, when
+    the queue is full the caller waits up to IMAGE_QUEUE_TIMEOUT seconds and then renders the image itself, so a burst of
+    uploads slows requests down instead of piling up in memory. With IMAGE_WORKERS = 0 variants are rendered in the caller's thread.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pid = None
+        self.executor = None
+        self.slots = None
+        self.queued = 0
+        self.rendered = 0
+        self.failed = 0
+        self.rendered_inline = 0
+
+    #started on first use in every process, so forked servers don't share a dead pool
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            #the counts of the parent process are not this process' work
+            self.pid = os.getpid()
+            self.queued = self.rendered = self.failed = self.rendered_inline = 0
+            self.executor = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix="image-worker")
+            self.slots = BoundedSemaphore(settings.IMAGE_QUEUE_SIZE)
+
+        atexit.register(self.shutdown)
+
+
+    def submit(self, jobs):
+        if settings.IMAGE_WORKERS == 0:
+            for job in jobs:
+                self.run(job)
+            return
+
+        self.start()
+        slots = self.slots
+        for job in jobs:
+            if not slots.acquire(timeout=settings.IMAGE_QUEUE_TIMEOUT):
+                with self.lock:
+                    self.rendered_inline += 1
+                self.run(job)
+                continue
+
+            with self.lock:
+                self.queued += 1
+            self.executor.submit(self.run, job, slots)
+
+
+    #slots is the queue slot a worker frees, None when run in the caller's thread
+    def run(self, job, slots=None):
+        failed = False
+        try:
+            generate_variants(*job)
+        except Exception as e:
+            #the original image is still served, generate_image_variants can retry it
+            logger.warning("variants of %s %s %s not rendered: %s", *job, e)
+            failed = True
+        finally:
+            with self.lock:
+                if slots is not None:
+                    self.queued -= 1
+                if failed:
+                    self.failed += 1
+                else:
+                    self.rendered += 1
+            if slots is not None:
+                slots.release()
+                close_old_connections()
+
+
+    def shutdown(self):
+        if self.pid != os.getpid():
+            return
+
+        self.executor.shutdown(wait=True)
+        self.pid = None
+
+
+    def stats(self):
+        return {
+            "workers": settings.IMAGE_WORKERS if self.pid == os.getpid() else 0,
+            "queue_size": self.queued,
+            "rendered": self.rendered,
+            "failed": self.failed,
+            "rendered_inline": self.rendered_inline,
+        }
+
+
+image_pool = ImageWorkerPool()
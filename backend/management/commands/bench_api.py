@@ -0,0 +1,227 @@
+import json
+import time
+import random
+import platform
+from contextlib import ExitStack
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from backend.models import User, Blog, BlogComments, ReplyComments
+
+
+#value below which pct percent of the sorted values are (nearest rank)
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values) + 0.5) - 1))]
+
+
+class Command(BaseCommand):
+    '''
+    Benchmarks the api in process: requests go through the whole middleware stack and the URLconf of backend/api/urls.py
+    with the django test client, against the data of the database (see seed_scale). For every endpoint it reports the
+    p50/p95/p99 latency, the queries per request and the bytes returned, and writes them as json with --json so runs can
+    be compared, --baseline prints the change against such a file.
+
+    Reads are made by a logged in seeded user on the most popular blogs, comments and users, each request from another
+    client address so throttles don't kick in. Login and token refresh write to the database (last_login, outstanding and
+    blacklisted tokens) and pay for the password hasher, they run --auth-iterations times. Run it on a scratch database.
+    '''
+
+    help = "Measures the latency, queries and response size of the api endpoints"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help="timed requests per endpoint")
+        parser.add_argument('--auth-iterations', type=int, default=20, help="timed requests of login and token refresh")
+        parser.add_argument('--warmup', type=int, default=10, help="untimed requests per endpoint before measuring")
+        parser.add_argument('--samples', type=int, default=20, help="popular blogs, comments and users the requests rotate over")
+        parser.add_argument('--endpoints', nargs='*', help="only benchmark these endpoints")
+        parser.add_argument('--email', help="user making the requests, a seeded user by default")
+        parser.add_argument('--password', default='password', help="password of that user")
+        parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+        parser.add_argument('--json', help="write the results to this file")
+        parser.add_argument('--baseline', help="json results of a previous run to compare with")
+
+
+    #most popular rows the requests rotate over
+    def get_samples(self, count):
+        blogs = list(Blog.objects.filter(published=True).order_by('-likes_no').values_list('uuid', flat=True)[:count])
+        comments = list(BlogComments.objects.order_by('-comments_no').values_list('uuid', flat=True)[:count])
+        replies = list(ReplyComments.objects.order_by('-comments_no').values_list('uuid', flat=True)[:count])
+        commented = list(BlogComments.objects.order_by('-likes_no').values_list('uuid', flat=True)[:count])
+        people = list(
+            User.objects.annotate(followers_no=Count('user_profile__followers')).order_by('-followers_no').values_list('uuid', flat=True)[:count]
+        )
+
+        if not (blogs and comments and replies and people):
+            raise CommandError("the database has no published blogs, comments, replies or users, run seed_scale first")
+
+        return {'blog': blogs, 'comment': comments, 'reply': replies, 'commented': commented, 'user': people}
+
+
+    #{name: (method, path or function of the request number returning the path and data)}
+    def get_endpoints(self, samples):
+        def pick(kind, path):
+            return lambda i: (path.format(self.rng.choice(samples[kind])), None)
+
+        return {
+            'blog_list': ('get', pick('blog', '/api/blog/')),
+            'blog_list_latest': ('get', pick('blog', '/api/blog/?latest=true')),
+            'blog_list_popular': ('get', pick('blog', '/api/blog/?popular=true')),
+            'blog_list_rated': ('get', pick('blog', '/api/blog/?rated=true')),
+            'blog_list_tags': ('get', pick('blog', '/api/blog/?tags=python,django')),
+            'blog_list_title': ('get', pick('blog', '/api/blog/?title=django')),
+            'blog_list_name': ('get', pick('blog', '/api/blog/?name=seed1')),
+            'blog_list_user': ('get', pick('user', '/api/blog/?user={}')),
+            'blog_detail': ('get', pick('blog', '/api/blog/{}')),
+            'blog_comments': ('get', pick('blog', '/api/blog/{}/comments/')),
+            'comment_replies': ('get', pick('comment', '/api/blog/comments/{}/reply/')),
+            'reply_replies': ('get', pick('reply', '/api/blog/comments/{}/reply/')),
+            'blog_likes': ('get', pick('blog', '/api/blog/{}/likes/')),
+            'comment_likes': ('get', pick('commented', '/api/blog/comments/{}/likes/')),
+            'people': ('get', pick('user', '/api/people/')),
+            'people_popular': ('get', pick('user', '/api/people/?popular=true')),
+            'people_detail': ('get', pick('user', '/api/people/{}')),
+            'people_followers': ('get', pick('user', '/api/people/followers/{}')),
+            'people_following': ('get', pick('user', '/api/people/following/{}')),
+            'user_blogs': ('get', pick('user', '/api/user/blog/')),
+            'user_followers': ('get', pick('user', '/api/user/followers/')),
+            'user_following': ('get', pick('user', '/api/user/following/')),
+            'login': ('post', lambda i: ('/api/auth/login/', {'email': self.email, 'password': self.password})),
+            'token_refresh': ('post', lambda i: ('/api/auth/token/', {'refresh': self.refresh})),
+        }
+
+
+    def request(self, method, path, data, i):
+        headers = {'REMOTE_ADDR': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"}
+        if method == 'get':
+            return self.client.get(path, HTTP_AUTHORIZATION=f"Bearer {self.access}", **headers)
+
+        response = self.client.post(path, data, content_type='application/json', **headers)
+        if response.status_code == 200 and 'refresh' in response.json():
+            #refresh tokens are rotated, the next refresh needs the new one
+            self.refresh = response.json()['refresh']
+        return response
+
+
+    def run(self, method, build, iterations, warmup):
+        for i in range(warmup):
+            self.request(method, *build(i), self.requests)
+            self.requests += 1
+
+        latencies, sizes, errors = [], [], 0
+        for i in range(iterations):
+            path, data = build(i)
+            start = time.perf_counter()
+            response = self.request(method, path, data, self.requests)
+            latencies.append((time.perf_counter() - start) * 1000)
+            self.requests += 1
+
+            sizes.append(len(response.content))
+            if response.status_code >= 400:
+                errors += 1
+
+        #queries are counted on separate requests, capturing them slows the timed ones down
+        queries = []
+        for i in range(min(iterations, 10)):
+            with ExitStack() as stack:
+                contexts = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in settings.DATABASES]
+                self.request(method, *build(i), self.requests)
+                self.requests += 1
+            queries.append(sum(len(context) for context in contexts))
+
+        latencies.sort()
+        return {
+            'requests': iterations,
+            'errors': errors,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+            'queries': round(sum(queries) / len(queries), 2) if queries else 0,
+            'max_queries': max(queries, default=0),
+            'bytes': round(sum(sizes) / len(sizes)) if sizes else 0,
+        }
+
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.password = options['password']
+        self.email = options['email'] or User.objects.filter(email__startswith='seed-', is_verified=True).order_by('pk').values_list('email', flat=True).first()
+        if self.email is None:
+            raise CommandError("no seeded user found, run seed_scale first or pass --email")
+
+        samples = self.get_samples(options['samples'])
+        endpoints = self.get_endpoints(samples)
+        unknown = set(options['endpoints'] or ()) - set(endpoints)
+        if unknown:
+            raise CommandError(f"unknown endpoints {', '.join(sorted(unknown))}, choose from {', '.join(endpoints)}")
+
+        results = {}
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            self.client = Client()
+            self.requests = 0
+
+            response = self.request('post', '/api/auth/login/', {'email': self.email, 'password': self.password}, 0)
+            if response.status_code != 200:
+                raise CommandError(f"login of {self.email} failed: {response.content.decode()}")
+            self.access = response.json()['access']
+            self.refresh = response.json()['refresh']
+
+            for name, (method, build) in endpoints.items():
+                if options['endpoints'] and name not in options['endpoints']:
+                    continue
+
+                iterations = options['auth_iterations'] if name in ('login', 'token_refresh') else options['iterations']
+                results[name] = self.run(method, build, iterations, min(options['warmup'], iterations))
+                self.stdout.write(self.format_row(name, results[name]))
+
+        report = {
+            'date': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': {alias: connections[alias].vendor for alias in settings.DATABASES},
+            'users': User.objects.count(),
+            'blogs': Blog.objects.count(),
+            'options': {key: options[key] for key in ('iterations', 'auth_iterations', 'warmup', 'samples', 'seed')},
+            'endpoints': results,
+        }
+
+        if options['json']:
+            with open(options['json'], 'w') as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"results written to {options['json']}"))
+
+        if options['baseline']:
+            self.compare(results, options['baseline'])
+
+
+    def format_row(self, name, result):
+        return (
+            f"{name:<20} p50 {result['p50_ms']:>8.2f}ms  p95 {result['p95_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms  "
+            f"{result['queries']:>6.1f} queries  {result['bytes']:>7} bytes  {result['errors']} errors"
+        )
+
+
+    #change of p50, p95 and queries against a previous run
+    def compare(self, results, path):
+        with open(path) as file:
+            baseline = json.load(file)['endpoints']
+
+        self.stdout.write(f"\nchange against {path}")
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before = baseline[name]
+            changes = [
+                f"{key[:3]} {(result[key] - before[key]) / before[key] * 100:+6.1f}%" if before[key] else f"{key[:3]} {'n/a':>7}"
+                for key in ('p50_ms', 'p95_ms')
+            ]
+            self.stdout.write(f"{name:<20} {'  '.join(changes)}  queries {result['queries'] - before['queries']:+.1f}")
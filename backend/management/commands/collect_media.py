@@ -0,0 +1,95 @@
+import posixpath
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from backend.models import User, Blog
+
+
+class Command(BaseCommand):
+    '''
+    Garbage collects media files. The references of every blob are counted from the image and image variants columns of
+    Blog and User rows, then the files of the upload folders with no reference left are deleted: images of deleted blogs and users,
+    replaced images and their variants, and temp files of interrupted uploads. Files younger than --grace seconds are kept,
+    as an upload is saved before its row is committed. As rows can reference a blob again while the folders are walked,
+    the references of every orphan are checked once more right before it's deleted.
+    '''
+
+    help = "Deletes media files which are not referenced by any blog or user anymore"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=60*60, help="seconds a new unreferenced file is kept")
+        parser.add_argument('--dry-run', action='store_true', help="only report the files which would be deleted")
+
+
+    #counts the rows referencing every media name
+    def count_references(self):
+        references = Counter()
+
+        for model, field_name in ((User, 'profile_pic'), (Blog, 'header_img')):
+            rows = model._base_manager.exclude(**{field_name: ''}).values_list(field_name, f"{field_name}_variants")
+
+            for name, variants in rows.iterator():
+                references[name] += 1
+                for label, variant in (variants or {}).items():
+                    if label == 'src':
+                        continue
+                    for key, value in variant.items():
+                        if key not in ('width', 'height'):
+                            references[value] += 1
+
+        return references
+
+
+    #whether a row references the media name now, the counted references may be outdated (names are lower case hex, icontains
+    #is the lookup sqlite has for json text)
+    def is_referenced(self, name):
+        for model, field_name in ((User, 'profile_pic'), (Blog, 'header_img')):
+            rows = model._base_manager.filter(Q(**{field_name: name}) | Q(**{f"{field_name}_variants__icontains": f'"{name}"'}))
+            if rows.exists():
+                return True
+        return False
+
+
+    #yields the names of all files under a folder of the storage
+    def walk(self, directory):
+        if not default_storage.exists(directory):
+            return
+
+        directories, files = default_storage.listdir(directory)
+        for file in files:
+            yield posixpath.join(directory, file)
+        for subdirectory in directories:
+            yield from self.walk(posixpath.join(directory, subdirectory))
+
+
+    def handle(self, *args, **options):
+        references = self.count_references()
+        cutoff = timezone.now() - timezone.timedelta(seconds=options['grace'])
+
+        folders = {
+            User._meta.get_field('profile_pic').upload_to.strip('/'),
+            Blog._meta.get_field('header_img').upload_to.strip('/'),
+        }
+
+        files = deleted = freed = 0
+        for folder in folders:
+            for name in self.walk(folder):
+                files += 1
+                if references[name] or default_storage.get_modified_time(name) > cutoff or self.is_referenced(name):
+                    continue
+
+                deleted += 1
+                freed += default_storage.size(name)
+                if not options['dry_run']:
+                    default_storage.delete(name)
+
+        shared = sum(1 for count in references.values() if count > 1)
+        action = "would delete" if options['dry_run'] else "deleted"
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{files} files, {len(references)} referenced ({shared} shared by several rows), {action} {deleted} orphans ({freed/(1024*1024):.1f} MB)"
+        ))
@@ -0,0 +1,82 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.conf import settings
+
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+from backend.models import EmailOutbox
+
+
+class Command(BaseCommand):
+    '''
+    Deletes expired outstanding tokens and their blacklist rows in bounded batches, so the tables do not grow for a year
+    and no single statement locks them for long. Sent mails older than EMAIL_OUTBOX_RETENTION are deleted from the email
+    outbox the same way. Meant to be run periodically (eg. from cron).
+    '''
+
+    help = "Deletes expired outstanding and blacklisted tokens and old sent mails in bounded batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="rows deleted per transaction")
+        parser.add_argument('--max-batches', type=int, default=0, help="stop after this many batches (0 = until done)")
+        parser.add_argument('--pause', type=float, default=0.1, help="seconds to sleep between batches")
+        parser.add_argument('--stats', action='store_true', help="only print table sizes")
+
+
+    def print_stats(self, now):
+        self.stdout.write(
+            f"outstanding: {OutstandingToken.objects.count()}, "
+            f"expired: {OutstandingToken.objects.filter(expires_at__lte=now).count()}, "
+            f"blacklisted: {BlacklistedToken.objects.count()}, "
+            f"sent mails: {EmailOutbox.objects.filter(status='sent').count()}"
+        )
+
+
+    #deletes the rows of queryset, oldest first, calling delete with the ids of each batch in its own transaction
+    def delete_in_batches(self, queryset, order_by, delete, options):
+        deleted = batches = 0
+        while not options['max_batches'] or batches < options['max_batches']:
+            ids = list(queryset.order_by(order_by).values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+
+            with transaction.atomic():
+                delete(ids)
+
+            deleted += len(ids)
+            batches += 1
+            time.sleep(options['pause'])
+
+        return deleted, batches
+
+
+    def delete_tokens(self, ids):
+        BlacklistedToken.objects.filter(token_id__in=ids).delete()
+        #dependent blacklist rows are already gone, raw delete skips the collector loading every token
+        OutstandingToken.objects.filter(id__in=ids)._raw_delete(OutstandingToken.objects.db)
+
+
+    def delete_mails(self, ids):
+        EmailOutbox.objects.filter(id__in=ids)._raw_delete(EmailOutbox.objects.db)
+
+
+    def handle(self, *args, **options):
+        now = aware_utcnow()
+        self.print_stats(now)
+
+        if options['stats']:
+            return
+
+        deleted, batches = self.delete_in_batches(
+            OutstandingToken.objects.filter(expires_at__lte=now), 'expires_at', self.delete_tokens, options
+        )
+        self.stdout.write(self.style.SUCCESS(f"deleted {deleted} expired tokens in {batches} batches"))
+
+        deleted, batches = self.delete_in_batches(
+            EmailOutbox.objects.filter(status='sent', sent_at__lte=now - settings.EMAIL_OUTBOX_RETENTION), 'sent_at', self.delete_mails, options
+        )
+        self.stdout.write(self.style.SUCCESS(f"deleted {deleted} sent mails in {batches} batches"))
+        self.print_stats(now)
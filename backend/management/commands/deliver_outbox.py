@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from backend.models import EmailOutbox
+from backend.utils import deliver_outbox
+
+
+class Command(BaseCommand):
+    '''
+    Delivers mails left in the outbox: mails whose worker died before sending them and failed mails due for a retry.
+    Run it periodically, or keep it running with --loop.
+    '''
+
+    help = "Delivers due mails of the email outbox in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="mails claimed and sent over one connection")
+        parser.add_argument('--loop', action='store_true', help="keep running, polling for due mails")
+        parser.add_argument('--interval', type=float, default=10, help="seconds to sleep when no mail is due (with --loop)")
+
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+
+        while True:
+            sent, failed = deliver_outbox(batch_size=options['batch_size'])
+            total_sent += sent
+            total_failed += failed
+
+            if sent or failed:
+                continue
+            if not options['loop']:
+                break
+
+            time.sleep(options['interval'])
+
+        pending = EmailOutbox.objects.filter(status='pending').count()
+        retrying = EmailOutbox.objects.filter(status='pending', next_attempt_at__gt=timezone.now()).count()
+
+        self.stdout.write(self.style.SUCCESS(f"sent {total_sent}, failed {total_failed}, pending {pending} ({retrying} waiting for retry)"))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from backend.models import User, Blog
+from backend.images import generate_variants
+
+
+class Command(BaseCommand):
+    '''
+    Renders the resized variants, dimensions and placeholders of images uploaded before they existed, or whose background generation failed.
+    Images whose variants are up to date are skipped, so it is safe to run again.
+    '''
+
+    help = "Generates missing resized variants of profile pics and blog header images"
+
+    def handle(self, *args, **options):
+        generated = failed = 0
+
+        for model, field_name in ((User, 'profile_pic'), (Blog, 'header_img')):
+            rows = model._base_manager.exclude(**{field_name: ''}).values_list('pk', field_name, f"{field_name}_variants", f"{field_name}_width")
+
+            for pk, name, variants, width in rows.iterator():
+                if (variants or {}).get('src') == name and width is not None:
+                    continue
+
+                try:
+                    generate_variants(model._meta.label, pk, field_name)
+                    generated += 1
+                except Exception as e:
+                    self.stderr.write(f"{model._meta.label} {pk}: {e}")
+                    failed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"generated variants of {generated} images, {failed} failed"))
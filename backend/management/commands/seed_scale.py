@@ -0,0 +1,281 @@
+import time
+import uuid
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.constants import OnConflict
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from backend.models import User, UserProfile, Blog, BlogComments, BlogLikes, ReplyComments, LikeComments
+
+
+WORDS = (
+    "the of and to in is that for it as with was on be by this are or from at an but not have they which one you were all "
+    "we when there can more if out so what up about into than them could only other new some time these two may first then "
+    "do any like my now over such our man me even most made after also did many before must through back years where much "
+    "your way well down should because each just those people how too little state good very make world still own see men "
+    "work long get here between both life being under never day same another know while last might us great old year off "
+    "come since against go came right used take three django python sqlite query index cache latency request database "
+    "server model field token blog post comment reply like follow writer reader story design code deploy scale benchmark"
+).split()
+
+TAGS = (
+    "python django web database sqlite performance design travel food life career startup music books writing science "
+    "health fitness photography programming devops security cloud data ai tutorial opinion news"
+).split()
+
+
+#sentence of random words
+def sentence(rng, words):
+    return " ".join(rng.choices(WORDS, k=words)).capitalize() + "."
+
+
+class Command(BaseCommand):
+    '''
+    Generates a synthetic dataset for scale testing: verified users with profiles, follow edges, blogs, comments, reply trees,
+    blog likes and comment likes, created over the last --days days. Followed users, authors and the liked and commented
+    blogs are picked with power law (zipf) weights, so a few users and posts get most of the activity like on a real site.
+    Blog bodies are log normally sized runs of paragraphs, with up to 5 tags. Everything is drawn from one --seed, the same
+    arguments on the same database give the same dataset.
+
+    Rows get their pks up front and are written in chunks of --chunk-size rows per transaction, through the batched insert
+    of bulk_create but raw like loaddata: the slug field would run a uniqueness query per blog and created_at would be
+    overwritten with now. No signals are sent (no mails, image variants or per row counter updates), the counters of all
+    blogs, comments and replies are recounted once at the end. Duplicate follows and likes drawn at random are dropped by
+    the unique constraints, so there are fewer than the averages ask for. Sizes are averages per user, blog and comment,
+    eg. --users 100000 gives about 2M follows, 500k blogs, 5M comments and 15M likes.
+    '''
+
+    help = "Fills the database with a synthetic dataset for scale testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help="users created")
+        parser.add_argument('--follows', type=float, default=20, help="average users followed per user")
+        parser.add_argument('--blogs', type=float, default=5, help="average blogs per user")
+        parser.add_argument('--comments', type=float, default=10, help="average comments per blog")
+        parser.add_argument('--replies', type=float, default=0.5, help="average replies per comment")
+        parser.add_argument('--likes', type=float, default=30, help="average likes per blog")
+        parser.add_argument('--comment-likes', type=float, default=2, help="average likes per comment and reply")
+        parser.add_argument('--published', type=float, default=0.8, help="share of published blogs")
+        parser.add_argument('--zipf', type=float, default=1.0, help="exponent of the power law of popularity")
+        parser.add_argument('--days', type=int, default=365, help="rows are created over the last days")
+        parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+        parser.add_argument('--password', default='password', help="password of every user")
+        parser.add_argument('--chunk-size', type=int, default=5000, help="rows written per transaction")
+
+
+    #cumulative zipf weights of items in a random order, so popularity is not tied to the pks
+    def popularity(self, items):
+        items = list(items)
+        self.rng.shuffle(items)
+        weights = list(accumulate(1 / (rank + 1) ** self.zipf for rank in range(len(items))))
+        return items, weights
+
+
+    #pks of the next count rows of model
+    def next_pks(self, model, count):
+        first = (model._base_manager.aggregate(last=Max('pk'))['last'] or 0) + 1
+        return range(first, first + count)
+
+
+    #random time in the last --days days
+    def timestamp(self):
+        return self.now - timedelta(seconds=self.rng.random() * self.days * 24 * 60 * 60)
+
+
+    #inserts the rows yielded by rows, --chunk-size rows per transaction. Returns the number of rows inserted
+    def insert(self, model, rows, total, ignore_conflicts=False):
+        start = time.monotonic()
+        before = model._base_manager.count()
+
+        fields = model._meta.local_concrete_fields
+        batch_size = connection.ops.bulk_batch_size(fields, [None] * self.chunk_size)
+        on_conflict = OnConflict.IGNORE if ignore_conflicts else None
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.chunk_size:
+                self.insert_chunk(model, chunk, fields, batch_size, on_conflict)
+                chunk = []
+        if chunk:
+            self.insert_chunk(model, chunk, fields, batch_size, on_conflict)
+
+        inserted = model._base_manager.count() - before
+        elapsed = time.monotonic() - start
+        self.stdout.write(f"{model._meta.label}: {inserted} of {total} rows in {elapsed:.1f}s ({inserted/max(elapsed, 0.001):.0f} rows/s)")
+        return inserted
+
+
+    def insert_chunk(self, model, chunk, fields, batch_size, on_conflict):
+        with transaction.atomic():
+            for i in range(0, len(chunk), batch_size):
+                model._base_manager._insert(chunk[i:i + batch_size], fields=fields, raw=True, on_conflict=on_conflict)
+
+
+    #uuid4 drawn from the seeded rng, the default uuid.uuid4 would make every dataset different
+    def uuid(self):
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+
+    def users(self, pks, prefix, password):
+        for i, pk in enumerate(pks):
+            joined = self.timestamp()
+            yield User(
+                pk=pk,
+                uuid=self.uuid(),
+                email=f"{prefix}{i}@blogzilla.test",
+                password=password,
+                first_name=f"Seed{i}",
+                last_name=self.rng.choice(WORDS).capitalize(),
+                profession=self.rng.choice(("developer", "writer", "designer", "student", "engineer", "")),
+                is_verified=True,
+                date_joined=joined,
+            )
+
+
+    #(follower, followed) user pairs: a user follows about --follows users, popular users are followed more
+    def follows(self, profiles, average):
+        followed, weights = self.popularity(profiles)
+
+        for follower_id in profiles:
+            picks = self.rng.choices(followed, cum_weights=weights, k=int(self.rng.expovariate(1 / average)) if average else 0)
+            for user_id in sorted(set(picks) - {follower_id}):
+                yield follower_id, user_id
+
+
+    def blogs(self, pks, authors, paragraphs):
+        authors, weights = self.popularity(authors)
+
+        for pk in pks:
+            created_at = self.timestamp()
+            published = self.rng.random() < self.published
+            yield Blog(
+                pk=pk,
+                uuid=self.uuid(),
+                user_id=self.rng.choices(authors, cum_weights=weights)[0],
+                published=published,
+                published_at=created_at if published else None,
+                title=sentence(self.rng, self.rng.randint(3, 10))[:-1],
+                slug=f"seed-{self.seed}-{pk}",
+                header_img='blog_header_img/seed.png',
+                content="\n\n".join(self.rng.choices(paragraphs, k=max(1, int(self.rng.lognormvariate(2, 0.6))))),
+                tags=",".join(self.rng.sample(TAGS, self.rng.randint(0, 5))),
+                created_at=created_at,
+                updated_at=created_at,
+            )
+
+
+    #rows of model with timestamps, fields is called for the other field values of every row
+    def rows(self, model, count, fields):
+        for i in range(count):
+            created_at = self.timestamp()
+            yield model(uuid=self.uuid(), created_at=created_at, updated_at=created_at, **fields())
+
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.seed = options['seed']
+        self.zipf = options['zipf']
+        self.published = options['published']
+        self.days = options['days']
+        self.chunk_size = options['chunk_size']
+        self.now = timezone.now()
+
+        prefix = f"seed-{self.seed}-"
+        if User.objects.filter(email__startswith=prefix).exists():
+            raise CommandError(f"a dataset with seed {self.seed} already exists, use another --seed")
+
+        start = time.monotonic()
+        rng = self.rng
+        users_no = options['users']
+
+        user_ids = list(self.next_pks(User, users_no))
+        self.insert(User, self.users(user_ids, prefix, make_password(options['password'])), users_no)
+
+        profiles = dict(zip(user_ids, self.next_pks(UserProfile, users_no)))
+        self.insert(UserProfile, (
+            UserProfile(pk=pk, uuid=self.uuid(), user_id=user_id, profile_is_complete=True, created_at=self.now, updated_at=self.now)
+            for user_id, pk in profiles.items()
+        ), users_no)
+
+        #an edge is written on both sides, in the follower's following and in the followed user's followers
+        follows_no = int(users_no * options['follows'])
+        follows = list(self.follows(profiles, options['follows']))
+        Following, Followers = UserProfile.following.through, UserProfile.followers.through
+        self.insert(Following, (Following(userprofile_id=profiles[a], user_id=b) for a, b in follows), follows_no, ignore_conflicts=True)
+        self.insert(Followers, (Followers(userprofile_id=profiles[b], user_id=a) for a, b in follows), follows_no, ignore_conflicts=True)
+
+        paragraphs = [" ".join(sentence(rng, rng.randint(6, 24)) for j in range(rng.randint(2, 8))) for i in range(256)]
+        blogs_no = int(users_no * options['blogs'])
+        blog_ids = list(self.next_pks(Blog, blogs_no))
+        self.insert(Blog, self.blogs(blog_ids, user_ids, paragraphs), blogs_no)
+        blogs, blog_weights = self.popularity(blog_ids)
+
+        comments_no = int(blogs_no * options['comments'])
+        comment_ids = list(self.next_pks(BlogComments, comments_no))
+        pks = iter(comment_ids)
+        self.insert(BlogComments, self.rows(BlogComments, comments_no, lambda: {
+            'pk': next(pks),
+            'user_id': rng.choice(user_ids),
+            'blog_id': rng.choices(blogs, cum_weights=blog_weights)[0],
+            'comment': sentence(rng, rng.randint(3, 40)),
+        }), comments_no)
+
+        #reply trees: a reply answers a comment or any reply drawn before it, 40% of the replies are replies of replies
+        replies_no = int(comments_no * options['replies'])
+        reply_ids = list(self.next_pks(ReplyComments, replies_no))
+        drawn = iter(range(replies_no))
+
+        def reply():
+            i = next(drawn)
+            if i and rng.random() < 0.4:
+                parent = {'parent_reply_comment_id': reply_ids[rng.randrange(i)]}
+            else:
+                parent = {'parent_blog_comment_id': rng.choice(comment_ids)}
+            return {'pk': reply_ids[i], 'user_id': rng.choice(user_ids), 'comment': sentence(rng, rng.randint(3, 30)), **parent}
+
+        self.insert(ReplyComments, self.rows(ReplyComments, replies_no, reply) if comment_ids else (), replies_no)
+
+        likes_no = int(blogs_no * options['likes'])
+        self.insert(BlogLikes, self.rows(BlogLikes, likes_no if blog_ids else 0, lambda: {
+            'user_id': rng.choice(user_ids),
+            'blog_id': rng.choices(blogs, cum_weights=blog_weights)[0],
+        }), likes_no, ignore_conflicts=True)
+
+        comment_likes_no = int((comments_no + replies_no) * options['comment_likes'])
+        self.insert(LikeComments, self.rows(LikeComments, comment_likes_no if comment_ids else 0, lambda: {
+            'user_id': rng.choice(user_ids),
+            **({'parent_reply_comment_id': rng.choice(reply_ids)} if rng.randrange(comments_no + replies_no) < replies_no
+               else {'parent_blog_comment_id': rng.choice(comment_ids)}),
+        }), comment_likes_no, ignore_conflicts=True)
+
+        counted = time.monotonic()
+        self.recount_counters()
+        self.stdout.write(f"counters recounted in {time.monotonic() - counted:.1f}s")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"seeded in {time.monotonic() - start:.1f}s, users log in with {prefix}<n>@blogzilla.test and password {options['password']!r}"
+        ))
+
+
+    #sets the likes and comments counters of every blog, comment and reply from their rows
+    def recount_counters(self):
+        def count(model, field):
+            rows = model._base_manager.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(rows=Count('pk')).values('rows')
+            return Coalesce(Subquery(rows), 0)
+
+        with transaction.atomic():
+            Blog._base_manager.update(likes_no=count(BlogLikes, 'blog'), comments_no=count(BlogComments, 'blog'))
+            BlogComments._base_manager.update(
+                likes_no=count(LikeComments, 'parent_blog_comment'), comments_no=count(ReplyComments, 'parent_blog_comment')
+            )
+            ReplyComments._base_manager.update(
+                likes_no=count(LikeComments, 'parent_reply_comment'), comments_no=count(ReplyComments, 'parent_reply_comment')
+            )
@@ -0,0 +1,114 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from backend.models import Blog, UserProfile, EmailOutbox
+from backend.utils import deliver_outbox, open_connection
+
+
+class Command(BaseCommand):
+    '''
+    Mails every follower one digest of the new posts of the authors they follow. A user gets at most one digest every
+    DIGEST_INTERVAL seconds and posts older than DIGEST_LOOKBACK seconds are never included. Followers are walked in chunks
+    of DIGEST_CHUNK_SIZE users so memory stays flat for authors with many followers, each chunk is written to the outbox
+    in one insert and sent over a single connection. Meant to be run periodically (eg. hourly from cron).
+    '''
+
+    help = "Mails followers a digest of new posts of the authors they follow"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.DIGEST_CHUNK_SIZE, help="followers handled per chunk")
+
+
+    #rendered once per post
+    def render_post(self, post):
+        return f"- {post['title']}\n  http://127.0.0.1:8000/blog/{post['uuid']}"
+
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        interval_start = now - timezone.timedelta(seconds=settings.DIGEST_INTERVAL)
+        lookback_start = now - timezone.timedelta(seconds=settings.DIGEST_LOOKBACK)
+
+        posts = list(
+            Blog.objects.filter(published=True, published_at__gt=lookback_start, published_at__lte=now)
+            .order_by('-published_at')
+            .values('uuid', 'title', 'user_id', 'published_at')
+        )
+        if not posts:
+            self.stdout.write("no new posts")
+            return
+
+        posts_by_author = defaultdict(list)
+        for post in posts:
+            post['rendered'] = self.render_post(post)
+            posts_by_author[post['user_id']].append(post)
+
+        author_profiles = dict(UserProfile.objects.filter(user_id__in=posts_by_author).values_list('id', 'user_id'))
+        follows = UserProfile.followers.through.objects.filter(userprofile_id__in=author_profiles)
+
+        connection = get_connection()
+        open_connection(connection)
+
+        #rendered once per distinct set of posts
+        bodies = {}
+        last_follower = 0
+        total_sent = total_failed = 0
+
+        while True:
+            followers = list(
+                follows.filter(user_id__gt=last_follower).order_by('user_id').values_list('user_id', flat=True).distinct()[:options['chunk_size']]
+            )
+            if not followers:
+                break
+            last_follower = followers[-1]
+
+            followed = defaultdict(list)
+            for follower, profile in follows.filter(user_id__in=followers).values_list('user_id', 'userprofile_id'):
+                followed[follower].append(author_profiles[profile])
+
+            #frequency cap: skip followers mailed within the interval
+            recipients = UserProfile.objects.filter(
+                Q(last_digest_at__isnull=True) | Q(last_digest_at__lte=interval_start),
+                user_id__in=followers,
+                user__is_verified=True,
+            ).values('user_id', 'last_digest_at', 'user__email', 'user__first_name', 'user__last_name')
+
+            emails = []
+            mailed = []
+            for recipient in recipients:
+                since = recipient['last_digest_at'] or lookback_start
+                new_posts = [
+                    post for author in followed[recipient['user_id']] for post in posts_by_author[author] if post['published_at'] > since
+                ]
+                if not new_posts:
+                    continue
+
+                key = tuple(post['uuid'] for post in new_posts)
+                if key not in bodies:
+                    bodies[key] = '\n'.join(post['rendered'] for post in new_posts)
+
+                name = f"{recipient['user__first_name']} {recipient['user__last_name']}".strip()
+                message = f"Hello {name}.\nAuthors you follow on BlogZilla published new posts:\n\n{bodies[key]}\n\nRegards,\nBlogZilla Team"
+                emails.append(EmailOutbox(to_email=recipient['user__email'], subject="New posts from authors you follow", message=message))
+                mailed.append(recipient['user_id'])
+
+            if not emails:
+                continue
+
+            with transaction.atomic():
+                emails = EmailOutbox.objects.bulk_create(emails)
+                UserProfile.objects.filter(user_id__in=mailed).update(last_digest_at=now)
+
+            sent, failed = deliver_outbox(batch_size=len(emails), ids=[email.pk for email in emails], connection=connection)
+            total_sent += sent
+            total_failed += failed
+
+        connection.close()
+
+        self.stdout.write(self.style.SUCCESS(f"{len(posts)} new posts, sent {total_sent} digests, {total_failed} failed (left in the outbox for retry)"))
@@ -1,5 +1,17 @@
+from django.apps import apps
+from django.db import models, router
+from django.db.models import Count, Q, F, Value, OuterRef, Subquery, DateTimeField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.contrib.auth.base_user import BaseUserManager
 
+import uuid
+from datetime import timedelta
+from collections import Counter
+
+from .utils import defer_counter
+from .db.transaction import write_transaction
+
 
 #custom manager
 class Usermanager(BaseUserManager):
@@ -35,4 +47,165 @@ class Usermanager(BaseUserManager):
         if extra_fields.get('is_superuser') is not True:
             raise ValueError('Superuser must have is_superuser=True.')
             
-        return self.create_user(email, password, **extra_fields)
\ No newline at end of file
+        return self.create_user(email, password, **extra_fields)
+
+    def with_counts(self, follows=True):
+        """
+        Users annotated with the counts of their cards and profiles: blogs_no, and with follows the followers_no and
+        following_no of their profile, which is selected with them. One correlated subquery per count instead of one query per user.
+        """
+        Blog = apps.get_model('backend', 'Blog')
+        UserProfile = apps.get_model('backend', 'UserProfile')
+
+        def count(model, field):
+            rows = model._base_manager.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(rows=Count('pk')).values('rows')
+            return Coalesce(Subquery(rows), 0)
+
+        queryset = self.get_queryset().annotate(blogs_no=count(Blog, 'user'))
+        if follows:
+            queryset = queryset.select_related('user_profile').annotate(
+                followers_no=count(UserProfile.followers.through, 'userprofile__user'),
+                following_no=count(UserProfile.following.through, 'userprofile__user'),
+            )
+
+        return queryset
+
+
+class EmailOutboxManager(models.Manager):
+
+    def claim(self, batch_size, ids=None, lease=300):
+        """
+        Take up to batch_size due mails for `lease` seconds and return them.
+        The claiming is a single UPDATE so concurrent workers never get the same mail.
+        """
+        now = timezone.now()
+        due = self.filter(status='pending', next_attempt_at__lte=now)
+        if ids is not None:
+            due = due.filter(pk__in=ids)
+
+        candidates = list(due.order_by('next_attempt_at').values_list('pk', flat=True)[:batch_size])
+        if not candidates:
+            return []
+
+        claim = uuid.uuid4()
+        self.filter(pk__in=candidates, status='pending', next_attempt_at__lte=now).update(
+            claim=claim, 
+            next_attempt_at=now + timedelta(seconds=lease)
+        )
+
+        return list(self.filter(claim=claim))
+
+
+#queryset of likes and comments, keeping the counters of their parents in bulk (model.parent_counters: {fk field: counter field})
+class CounterQuerySet(models.QuerySet):
+    '''
+    bulk_create() and delete() send no per row signals: the rows are counted per parent and the deltas are deferred like the
+    ones of the signals, then applied once the transaction commits as one UPDATE per (parent model, counter, delta).
+    delete() of rows nothing references is a single DELETE, rows with children are deleted through the collector whose
+    signals keep the counters.
+    '''
+
+    #rows of queryset per parent, {(parent model, counter field, parent pk): rows}
+    def count_parents(self, queryset):
+        rows = Counter()
+        for field_name, counter in self.model.parent_counters.items():
+            field = self.model._meta.get_field(field_name)
+            groups = queryset.filter(**{f"{field.attname}__isnull": False}).order_by().values_list(field.attname).annotate(rows=Count('pk'))
+            for pk, count in groups:
+                rows[(field.related_model, counter, pk)] += count
+        return rows
+
+
+    #rows of objs per parent, same keys as count_parents
+    def count_objs_parents(self, objs):
+        rows = Counter()
+        for field_name, counter in self.model.parent_counters.items():
+            field = self.model._meta.get_field(field_name)
+            for obj in objs:
+                pk = getattr(obj, field.attname)
+                if pk is not None:
+                    rows[(field.related_model, counter, pk)] += 1
+        return rows
+
+
+    @staticmethod
+    def defer_counters(deltas):
+        for (model, counter, pk), delta in deltas.items():
+            if delta:
+                defer_counter(model, pk, counter, delta)
+
+
+    @write_transaction
+    def bulk_create(self, objs, *args, ignore_conflicts=False, update_conflicts=False, **kwargs):
+        '''
+        with ignore_conflicts or update_conflicts the inserted rows are unknown, the rows of the parents are counted before and after
+        '''
+
+        objs = list(objs)
+        if not (ignore_conflicts or update_conflicts):
+            created = super().bulk_create(objs, *args, **kwargs)
+            self.defer_counters(self.count_objs_parents(objs))
+            return created
+
+        parents = Q()
+        for field_name in self.model.parent_counters:
+            attname = self.model._meta.get_field(field_name).attname
+            pks = {getattr(obj, attname) for obj in objs} - {None}
+            if pks:
+                parents |= Q(**{f"{attname}__in": pks})
+        related = self.model._base_manager.using(self.db).filter(parents) if parents else self.none()
+
+        before = self.count_parents(related)
+        created = super().bulk_create(objs, *args, ignore_conflicts=ignore_conflicts, update_conflicts=update_conflicts, **kwargs)
+        deltas = self.count_parents(related)
+        deltas.subtract(before)
+
+        self.defer_counters(deltas)
+        return created
+
+
+    @write_transaction
+    def delete(self):
+        if self.model._meta.related_objects or self.query.is_sliced or self.query.distinct or self._fields is not None:
+            return super().delete()
+
+        deltas = self.count_parents(self)
+        deleted = self._raw_delete(router.db_for_write(self.model))
+        self.defer_counters({key: -rows for key, rows in deltas.items()})
+
+        return deleted, {self.model._meta.label: deleted}
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+
+#queryset of blogs, setting published_at on the bulk paths like Blog.save does
+class BlogQuerySet(models.QuerySet):
+    '''
+    published_at is the first time a blog was published, the new posts digests are based on it. update(published=True) sets it
+    on the rows which have none, bulk_update() of published sets it on the published objs which have none.
+    '''
+
+    def update(self, **kwargs):
+        if kwargs.get('published') is True and 'published_at' not in kwargs:
+            kwargs['published_at'] = Coalesce(F('published_at'), Value(timezone.now(), output_field=DateTimeField()))
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        fields = list(fields)
+        if 'published' in fields:
+            objs = list(objs)
+            now = timezone.now()
+            for obj in objs:
+                if obj.published and obj.published_at is None:
+                    obj.published_at = now
+            if 'published_at' not in fields:
+                fields.append('published_at')
+
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    bulk_update.alters_data = True
@@ -0,0 +1,406 @@
+from django.apps import apps
+from django.conf import settings
+
+import os
+import json
+import time
+import atexit
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from backend.utils import email_pool
+from backend.images import image_pool
+from backend.db.transaction import lock_stats
+
+
+#snapshot holding the counts of the processes which exited
+EXITED = "exited"
+
+#seconds, from a fast cached read to a slow page
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+#process wide list of instruments, written to METRICS_DIR for the other processes
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.flushed_at = 0
+        self.flushed_pid = None
+        self.started = None
+        self.name = None
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+
+
+    #{name: {type, help, labels, buckets, values: [[label values, value]]}} of the instruments summed per process
+    def collect(self, shared=False):
+        return {name: metric.collect() for name, metric in self.metrics.items() if metric.shared == shared}
+
+
+    #snapshot of a process, named by its pid and start time so that a later process reusing the pid writes another file
+    def path(self, name):
+        return os.path.join(settings.METRICS_DIR, f"{name}.json")
+
+
+    #writes the instruments of this process, at most every METRICS_FLUSH_INTERVAL seconds unless forced
+    def flush(self, force=False):
+        if not settings.METRICS_DIR:
+            return
+
+        now = time.monotonic()
+        if not force and now - self.flushed_at < settings.METRICS_FLUSH_INTERVAL:
+            return
+        self.flushed_at = now
+
+        pid = os.getpid()
+        if self.flushed_pid != pid:
+            #the last counts of a worker which exits are kept
+            self.flushed_pid = pid
+            self.started = process_started(pid)
+            self.name = f"{pid}-{self.started if self.started is not None else time.time_ns()}"
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            atexit.register(self.flush, force=True)
+
+        self.write(self.name, {'pid': pid, 'started': self.started, 'metrics': self.collect()})
+
+
+    #written aside and renamed, so readers never see half a file
+    def write(self, name, snapshot):
+        temp = f"{self.path(name)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, 'w') as file:
+            json.dump(snapshot, file)
+        os.replace(temp, self.path(name))
+
+
+    def read(self, name):
+        try:
+            with open(self.path(name)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            #removed since it was listed, or not a snapshot: the next scrape reads it again
+            return None
+        return {**snapshot, 'name': name} if isinstance(snapshot, dict) else None
+
+
+    #snapshots of the other processes which wrote one, then the counts folded from the exited ones (pid None)
+    def read_snapshots(self):
+        if not settings.METRICS_DIR or not os.path.isdir(settings.METRICS_DIR):
+            return []
+
+        own = self.name if self.flushed_pid == os.getpid() else None
+        names = [name[:-len('.json')] for name in os.listdir(settings.METRICS_DIR) if name.endswith('.json')]
+        snapshots = [self.read(name) for name in names if name not in (own, EXITED)]
+
+        #read last: a snapshot listed in it was folded into it after it was read above
+        exited = self.read(EXITED) or {'folded': [], 'metrics': {}}
+        snapshots = [snapshot for snapshot in snapshots if snapshot is not None and snapshot['name'] not in exited['folded']]
+        return snapshots + [{**exited, 'pid': None}]
+
+
+    #snapshots of every process which wrote one, this process' own counts are read live
+    def snapshots(self):
+        return [{'pid': os.getpid(), 'metrics': self.collect()}, *self.read_snapshots()]
+
+
+    #adds the counters and histograms of the snapshots of exited processes to the exited file and deletes them, so the
+    #directory doesn't grow with every restarted worker and a later process reusing a pid doesn't make counters go back
+    def fold_exited(self):
+        if not settings.METRICS_DIR or not os.path.isdir(settings.METRICS_DIR):
+            return
+
+        #one process folds at a time, mkdir is atomic everywhere
+        lock = os.path.join(settings.METRICS_DIR, f"{EXITED}.lock")
+        try:
+            os.mkdir(lock)
+        except OSError:
+            try:
+                #left by a process which died while folding
+                if time.time() - os.stat(lock).st_mtime > 60:
+                    os.rmdir(lock)
+            except OSError:
+                pass
+            return
+
+        try:
+            snapshots = self.read_snapshots()
+            exited = snapshots.pop()
+            dead = [snapshot for snapshot in snapshots if not is_alive(snapshot['pid'], snapshot.get('started'))]
+            #left by a process which died between writing the exited file and deleting them
+            folded = [name for name in exited['folded'] if os.path.exists(self.path(name))]
+
+            #written before the snapshots are deleted, which are skipped while they are listed in it
+            if dead:
+                folded += [snapshot['name'] for snapshot in dead]
+                merged = merge([exited, *dead], gauges=False)
+                self.write(EXITED, {
+                    'folded': folded,
+                    'metrics': {name: {**metric, 'values': [[list(key), value] for key, value in metric['values'].items()]}
+                                for name, metric in merged.items()},
+                })
+
+            for name in folded:
+                try:
+                    os.remove(self.path(name))
+                except FileNotFoundError:
+                    pass
+        finally:
+            os.rmdir(lock)
+
+
+    #metrics summed over the processes: counters and histograms of exited processes still count, gauges only of live ones
+    def aggregate(self):
+        self.fold_exited()
+        merged = merge(self.snapshots())
+
+        for name, metric in self.collect(shared=True).items():
+            merged[name] = {**metric, 'values': {tuple(labels): value for labels, value in metric['values']}}
+
+        return merged
+
+
+    #prometheus text exposition format 0.0.4
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.aggregate().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+
+            for key, value in sorted(metric['values'].items()):
+                labels = list(zip(metric['labels'], key))
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                    continue
+
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip([*metric['buckets'], '+Inf'], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels([*labels, ('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+#a process reusing the pid of an exited one has another start time
+def is_alive(pid, started=None):
+    if pid is None:
+        return False
+    if pid != os.getpid():
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    return started is None or process_started(pid) in (started, None)
+
+
+#start time of a process in clock ticks since boot, None where /proc is missing
+def process_started(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            #the command name in parentheses may hold spaces, starttime is the 20th field after it
+            return int(file.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+#sums snapshots per metric and label values, gauges only of live processes and not at all without gauges
+def merge(snapshots, gauges=True):
+    merged = {}
+    for snapshot in snapshots:
+        alive = gauges and is_alive(snapshot['pid'], snapshot.get('started'))
+        for name, metric in snapshot['metrics'].items():
+            if metric['type'] == 'gauge' and not alive:
+                continue
+
+            target = merged.setdefault(name, {**metric, 'values': {}})
+            for labels, value in metric['values']:
+                key = tuple(labels)
+                if metric['type'] == 'histogram':
+                    counts, total = target['values'].get(key, ([0] * len(value[0]), 0))
+                    target['values'][key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+                else:
+                    target['values'][key] = target['values'].get(key, 0) + value
+
+    return merged
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    base of the instruments: values per tuple of label values, guarded by one lock per instrument so an update costs a lock
+    and a dict lookup. With function the values are read from it when collected instead (a number, or {label values: number}).
+    Shared metrics hold a value of the whole site (eg. rows of a table), they are read by the process serving /metrics and
+    never summed over processes.
+    '''
+
+    type = None
+
+    def __init__(self, name, help, labels=(), function=None, shared=False):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.register(self)
+
+    def key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def read(self):
+        if self.function is None:
+            with self.lock:
+                return {key: self.copy(value) for key, value in self.values.items()}
+
+        value = self.function()
+        return value if isinstance(value, dict) else {(): value}
+
+    def copy(self, value):
+        return value
+
+    def collect(self):
+        return {
+            'type': self.type,
+            'help': self.help,
+            'labels': self.labels,
+            'values': [[list(key), value] for key, value in self.read().items()],
+        }
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    '''
+    fixed buckets: an observation increments the count of the first bucket whose upper bound holds it (the last one is +Inf)
+    '''
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bucket] += 1
+            self.values[key] = (counts, total + value)
+
+    def copy(self, value):
+        return [list(value[0]), value[1]]
+
+    def collect(self):
+        return {**super().collect(), 'buckets': self.buckets}
+
+
+#http, recorded by backend.middleware.MetricsMiddleware
+http_requests = Counter('blogzilla_http_requests_total', "Requests by route, method and status", ('route', 'method', 'status'))
+http_latency = Histogram('blogzilla_http_request_duration_seconds', "Request latency by route", ('route', 'method'))
+http_queries = Histogram(
+    'blogzilla_http_request_queries', "Queries per request by route", ('route',), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+http_db_time = Counter('blogzilla_http_db_seconds_total', "Time spent in queries by route", ('route',))
+
+#auth views, see backend.api.mixins.AuthEventMixin
+auth_events = Counter('blogzilla_auth_events_total', "Logins, token refreshes, signups, verifications and resets by result", ('event', 'result'))
+
+#caches of backend.models.User
+cache_lookups = Counter('blogzilla_cache_lookups_total', "Cache lookups by cache and result (hit or miss)", ('cache', 'result'))
+
+
+#blogs, comments, replies and likes, counted once their transaction commits
+CONTENT_KINDS = {
+    'backend.Blog': 'blog',
+    'backend.BlogComments': 'comment',
+    'backend.ReplyComments': 'reply',
+    'backend.BlogLikes': 'blog_like',
+    'backend.LikeComments': 'comment_like',
+}
+
+content_created = Counter('blogzilla_content_created_total', "Blogs, comments, replies and likes created", ('kind',))
+
+
+#counts the (model label, pk) rows deferred with defer_call
+def count_created(rows):
+    kinds = defaultdict(int)
+    for label, pk in rows:
+        kinds[CONTENT_KINDS[label]] += 1
+    for kind, count in kinds.items():
+        content_created.inc(count, kind=kind)
+
+
+#stats of a worker pool or of the write lock as {(stat,): value}
+def pool_stats(pool, keys):
+    def read():
+        stats = pool.stats()
+        return {(key,): stats[key] for key in keys}
+    return read
+
+
+def outbox_size():
+    EmailOutbox = apps.get_model('backend', 'EmailOutbox')
+    return {(status,): EmailOutbox.objects.filter(status=status).count() for status in ('pending', 'failed')}
+
+
+#email
+email_queue = Gauge('blogzilla_email_queue', "Email worker threads and queued mail batches of the process", ('stat',),
+    function=pool_stats(email_pool, ('workers', 'queue_size')))
+email_delivered = Counter('blogzilla_email_delivered_total', "Mails sent and failed by the email workers, and sent in the request on a full queue", ('stat',),
+    function=pool_stats(email_pool, ('sent', 'failed', 'sent_inline')))
+email_outbox = Gauge('blogzilla_email_outbox', "Mails of the outbox waiting for a retry or given up", ('status',), function=outbox_size, shared=True)
+
+#image variants
+image_queue = Gauge('blogzilla_image_queue', "Image worker threads and images waiting for their variants", ('stat',),
+    function=pool_stats(image_pool, ('workers', 'queue_size')))
+image_rendered = Counter('blogzilla_image_rendered_total', "Images whose variants were rendered or failed, and rendered in the request on a full queue", ('stat',),
+    function=pool_stats(image_pool, ('rendered', 'failed', 'rendered_inline')))
+
+#write lock of sqlite, see backend.db.transaction.write_transaction
+db_write_transactions = Counter('blogzilla_db_write_transactions_total', "Write transactions, and the ones contended, retried or failed on the lock", ('stat',),
+    function=pool_stats(lock_stats, ('transactions', 'contended', 'retries', 'failed')))
+db_write_wait = Counter('blogzilla_db_write_wait_seconds_total', "Time write transactions waited for the lock",
+    function=lambda: lock_stats.stats()['wait_seconds'])
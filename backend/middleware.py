@@ -0,0 +1,186 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+import re
+import time
+import random
+import hashlib
+import logging
+import traceback
+from contextlib import ExitStack
+
+from backend.db.routers import read_from_replica
+from backend import metrics
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+logger = logging.getLogger(__name__)
+
+
+#client making the request: its access token, else its ip
+def client_key(request):
+    identity = request.headers.get('Authorization') or request.META.get('REMOTE_ADDR', '')
+    return f"primary-sticky:{hashlib.sha1(identity.encode()).hexdigest()}"
+
+
+class ReplicaRoutingMiddleware:
+    '''
+    Reads of GET, HEAD and OPTIONS requests are served by the read replicas. After a client writes (any other method), its reads
+    stay on the primary for REPLICA_STICKY_SECONDS, so users see their own likes and comments before the replicas catch up.
+    The sticky window is kept in the cache, shared by all workers when REDIS_URL is set.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+
+        key = client_key(request)
+        if request.method not in SAFE_METHODS:
+            response = self.get_response(request)
+            cache.set(key, True, settings.REPLICA_STICKY_SECONDS)
+            return response
+
+        token = read_from_replica.set(not cache.get(key, False))
+        try:
+            return self.get_response(request)
+        finally:
+            read_from_replica.reset(token)
+
+
+
+#raised by QueryPatternMiddleware with NPLUSONE_RAISE
+class RepeatedQueriesError(Exception):
+    pass
+
+
+#shape of a statement: parameters are already placeholders, IN lists of any length are one shape
+def fingerprint(sql):
+    sql = re.sub(r"\(\s*%s(?:\s*,\s*%s)*\s*\)", "(...)", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+#innermost frames of the project code running a query, eg. serializers.py:335 in get_blogs_published
+def call_site(limit=6):
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(str(settings.BASE_DIR)) and frame.filename != __file__ and 'site-packages' not in frame.filename
+    ]
+    return "".join(traceback.format_list(frames[-limit:]))
+
+
+#queries of one request grouped by shape
+class QueryRecorder:
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.patterns = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            pattern = self.patterns.setdefault(fingerprint(sql), {'count': 0, 'seconds': 0.0, 'stack': None})
+            pattern['count'] += 1
+            pattern['seconds'] += elapsed
+            #the stack is only walked once per pattern, when it crosses the threshold
+            if pattern['count'] == self.threshold + 1:
+                pattern['stack'] = call_site()
+
+    def repeated(self):
+        return {sql: pattern for sql, pattern in self.patterns.items() if pattern['count'] > self.threshold}
+
+
+class QueryPatternMiddleware:
+    '''
+    N+1 detector. The queries of a sampled request (NPLUSONE_SAMPLE_RATE, 0 disables it) are grouped by statement shape through
+    the execute wrappers of every database connection. A shape run more than NPLUSONE_THRESHOLD times in one request is
+    logged as a warning with its count, time and the project frames which ran it, or raised as RepeatedQueriesError with
+    NPLUSONE_RAISE (for development and ci). Requests which are not sampled only pay for a random number.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.NPLUSONE_SAMPLE_RATE or random.random() >= settings.NPLUSONE_SAMPLE_RATE:
+            return self.get_response(request)
+
+        recorder = QueryRecorder(settings.NPLUSONE_THRESHOLD)
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            response = self.get_response(request)
+
+        repeated = recorder.repeated()
+        if repeated:
+            report = f"{request.method} {request.path} repeated queries:\n" + "\n".join(
+                f"{pattern['count']}x {pattern['seconds'] * 1000:.1f}ms {sql}\n{pattern['stack']}"
+                for sql, pattern in sorted(repeated.items(), key=lambda item: -item[1]['count'])
+            )
+            if settings.NPLUSONE_RAISE:
+                raise RepeatedQueriesError(report)
+            logger.warning(report)
+
+        return response
+
+
+
+#counts and times the queries of a request
+class QueryTimer:
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+class MetricsMiddleware:
+    '''
+    Records the latency, status, query count and query time of every request in backend.metrics, labelled with the route
+    pattern of the url (eg. api/blog/<uuid>) so the number of series stays bounded, "unmatched" for urls no route matched.
+    The counts of the process are written to METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds, for /metrics.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(timer))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else 'unmatched'
+
+        metrics.http_requests.inc(route=route, method=request.method, status=response.status_code)
+        metrics.http_latency.observe(elapsed, route=route, method=request.method)
+        metrics.http_queries.observe(timer.queries, route=route)
+        metrics.http_db_time.inc(timer.seconds, route=route)
+
+        try:
+            metrics.registry.flush()
+        except OSError as e:
+            print(e)
+
+        return response
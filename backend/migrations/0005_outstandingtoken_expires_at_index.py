@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    '''
+    The blacklist check joins BlacklistedToken.token (unique) on OutstandingToken.jti (unique), both already indexed.
+    compact_tokens scans OutstandingToken by expires_at, which simplejwt leaves unindexed.
+    '''
+
+    dependencies = [
+        ("backend", "0004_alter_userprofile_bio"),
+        ("token_blacklist", "0012_alter_outstandingtoken_user"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="CREATE INDEX token_blacklist_outstandingtoken_expires_at_idx ON token_blacklist_outstandingtoken (expires_at);",
+            reverse_sql="DROP INDEX token_blacklist_outstandingtoken_expires_at_idx;",
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.6 on 2026-10-19 19:01
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+# already published blogs must not show up as new posts in digests
+def backfill_published_at(apps, schema_editor):
+    Blog = apps.get_model("backend", "Blog")
+    Blog.objects.filter(published=True).update(published_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backend", "0006_emailoutbox"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="blog",
+            name="published_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="userprofile",
+            name="last_digest_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_published_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.6 on 2026-10-19 19:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backend", "0007_blog_published_at_userprofile_last_digest_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="blog",
+            name="header_img_variants",
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="profile_pic_variants",
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
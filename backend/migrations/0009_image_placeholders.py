@@ -0,0 +1,53 @@
+# Generated by Django 4.2.6 on 2026-10-19 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backend", "0008_image_variants"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="blog",
+            name="header_img_blurhash",
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name="blog",
+            name="header_img_color",
+            field=models.CharField(blank=True, editable=False, max_length=7),
+        ),
+        migrations.AddField(
+            model_name="blog",
+            name="header_img_height",
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="blog",
+            name="header_img_width",
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="profile_pic_blurhash",
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="profile_pic_color",
+            field=models.CharField(blank=True, editable=False, max_length=7),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="profile_pic_height",
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="profile_pic_width",
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,148 @@
+# Generated by Django 4.2.6 on 2026-10-19 19:11
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_likes(apps, schema_editor):
+    """
+    keeps the first like of a user for a blog or comment so that the unique constraints can be created, and recounts likes_no of the liked rows
+    """
+
+    for like_model, parent_field, parent_model in (
+        ("BlogLikes", "blog", "Blog"),
+        ("LikeComments", "parent_blog_comment", "BlogComments"),
+        ("LikeComments", "parent_reply_comment", "ReplyComments"),
+    ):
+        Like = apps.get_model("backend", like_model)
+        Parent = apps.get_model("backend", parent_model)
+
+        duplicates = (
+            Like.objects.filter(**{f"{parent_field}__isnull": False})
+            .values("user", parent_field)
+            .annotate(first=Min("id"), count=Count("id"))
+            .filter(count__gt=1)
+        )
+
+        parents = set()
+        for duplicate in duplicates:
+            Like.objects.filter(
+                user=duplicate["user"], **{parent_field: duplicate[parent_field]}
+            ).exclude(id=duplicate["first"]).delete()
+            parents.add(duplicate[parent_field])
+
+        for pk in parents:
+            Parent.objects.filter(pk=pk).update(
+                likes_no=Like.objects.filter(**{parent_field: pk}).count()
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backend", "0009_image_placeholders"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="blog",
+            index=models.Index(
+                condition=models.Q(("published", True)),
+                fields=["-created_at"],
+                name="blog_published_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="blog",
+            index=models.Index(
+                condition=models.Q(("published", True)),
+                fields=["-likes_no"],
+                name="blog_published_likes_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="blog",
+            index=models.Index(
+                condition=models.Q(("published", True)),
+                fields=["-comments_no"],
+                name="blog_published_comments_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="blog",
+            index=models.Index(
+                condition=models.Q(("published", True)),
+                fields=["published_at"],
+                name="blog_published_at_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="blog",
+            index=models.Index(
+                fields=["user", "-created_at"], name="blog_user_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="blogcomments",
+            index=models.Index(
+                fields=["blog", "-created_at"], name="blogcomment_blog_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="bloglikes",
+            index=models.Index(
+                fields=["blog", "-created_at"], name="bloglike_blog_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="likecomments",
+            index=models.Index(
+                fields=["parent_blog_comment", "-created_at"],
+                name="like_blogcomment_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="likecomments",
+            index=models.Index(
+                fields=["parent_reply_comment", "-created_at"],
+                name="like_reply_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="replycomments",
+            index=models.Index(
+                fields=["parent_blog_comment", "-created_at"],
+                name="reply_blogcomment_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="replycomments",
+            index=models.Index(
+                fields=["parent_reply_comment", "-created_at"],
+                name="reply_reply_created_idx",
+            ),
+        ),
+        migrations.RunPython(remove_duplicate_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="bloglikes",
+            constraint=models.UniqueConstraint(
+                fields=("user", "blog"), name="unique_blog_like"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="likecomments",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("parent_blog_comment__isnull", False)),
+                fields=("user", "parent_blog_comment"),
+                name="unique_blog_comment_like",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="likecomments",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("parent_reply_comment__isnull", False)),
+                fields=("user", "parent_reply_comment"),
+                name="unique_reply_comment_like",
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.6 on 2026-10-20 09:12
+
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def recount_comment_counters(apps, schema_editor):
+    """
+    sets likes_no and comments_no of every comment and reply from the like and reply rows. The api reads the stored counters,
+    which signals kept wrong before (likes were added to a like_no field which doesn't exist)
+    """
+
+    LikeComments = apps.get_model("backend", "LikeComments")
+    ReplyComments = apps.get_model("backend", "ReplyComments")
+    BlogComments = apps.get_model("backend", "BlogComments")
+
+    def count(model, field):
+        rows = model._base_manager.filter(**{field: OuterRef("pk")}).order_by().values(field).annotate(rows=Count("pk")).values("rows")
+        return Coalesce(Subquery(rows), 0)
+
+    BlogComments._base_manager.update(
+        likes_no=count(LikeComments, "parent_blog_comment"), comments_no=count(ReplyComments, "parent_blog_comment")
+    )
+    ReplyComments._base_manager.update(
+        likes_no=count(LikeComments, "parent_reply_comment"), comments_no=count(ReplyComments, "parent_reply_comment")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("backend", "0010_query_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(recount_comment_counters, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,13 @@
-from django.db import models
+from django.db import models, router
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 
-from .manager import Usermanager
+from .manager import Usermanager, EmailOutboxManager, CounterQuerySet, BlogQuerySet
 from .utils import BaseModel
+from .db.deletion import delete_blogs
+from . import metrics
 
 import uuid
 
@@ -22,6 +27,11 @@ class User(AbstractUser):
     last_name = models.CharField(max_length=100, blank=True)
     profession = models.CharField(max_length=300, blank=True)
     profile_pic = models.ImageField(upload_to='profile_pic/', blank=True)
+    profile_pic_variants = models.JSONField(default=dict, blank=True, editable=False)
+    profile_pic_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    profile_pic_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    profile_pic_color = models.CharField(max_length=7, blank=True, editable=False)
+    profile_pic_blurhash = models.CharField(max_length=100, blank=True, editable=False)
     country = models.CharField(max_length=80, blank=True)
 
     objects = Usermanager()
@@ -39,6 +49,97 @@ class User(AbstractUser):
     
     def __str__(self):
         return self.email
+
+
+    #builds a user from jwt claims without touching the db
+    @classmethod
+    def from_claims(cls, claims):
+        '''
+        i/p -> dict of field attname: claim value
+        o/p -> User object with every field missing from claims deferred
+        '''
+        fields = [field for field in cls._meta.concrete_fields if field.attname in claims]
+        user = cls.from_db(None, [field.attname for field in fields], [field.to_python(claims[field.attname]) for field in fields])
+        user._from_claims = True
+
+        return user
+
+
+    #returns the column values of a user, cached for USER_CACHE_TIMEOUT seconds. password hash is never cached
+    @classmethod
+    def get_cached_row(cls, pk):
+        key = f"user-row:{pk}"
+        row = cache.get(key) if settings.USER_CACHE_TIMEOUT else None
+        metrics.cache_lookups.inc(cache='user_row', result='miss' if row is None else 'hit')
+
+        if row is None:
+            fields = [field.attname for field in cls._meta.concrete_fields if field.attname != 'password']
+            row = cls._base_manager.filter(pk=pk).values(*fields).first()
+            if row is not None and settings.USER_CACHE_TIMEOUT:
+                cache.set(key, row, settings.USER_CACHE_TIMEOUT)
+
+        return row
+
+
+    @classmethod
+    def clear_cached_row(cls, pk):
+        cache.delete(f"user-row:{pk}")
+
+
+    @classmethod
+    def clear_cached_rows(cls, pks):
+        cache.delete_many([f"user-row:{pk}" for pk in pks])
+
+
+    #returns last_logout of a user as an epoch timestamp (0 if never logged out, None if there is no such user), cached for LOGOUT_CACHE_TIMEOUT seconds
+    @classmethod
+    def get_logout_timestamp(cls, email):
+        key = f"user-logout:{email}"
+        timestamp = cache.get(key)
+        metrics.cache_lookups.inc(cache='user_logout', result='miss' if timestamp is None else 'hit')
+
+        if timestamp is None:
+            users = cls._base_manager.filter(email=email).values_list('last_logout', flat=True)
+            if not users:
+                return None
+
+            timestamp = int(users[0].timestamp()) if users[0] else 0
+            cache.set(key, timestamp, settings.LOGOUT_CACHE_TIMEOUT)
+
+        return timestamp
+
+
+    @classmethod
+    def clear_logout_timestamps(cls, emails):
+        cache.delete_many([f"user-logout:{email}" for email in emails])
+
+
+    #revokes every token issued to the user before now with a single UPDATE
+    def logout_everywhere(self):
+        now = timezone.now()
+        User._base_manager.filter(pk=self.pk).update(last_logout=now)
+
+        cache.set(f"user-logout:{self.email}", int(now.timestamp()), settings.LOGOUT_CACHE_TIMEOUT)
+        User.clear_cached_row(self.pk)
+
+
+    def refresh_from_db(self, using=None, fields=None):
+        '''
+        users built from claims load all of their deferred fields at once when one of them is first accessed, instead of one query per attribute
+        '''
+        if fields is not None and getattr(self, '_from_claims', False):
+            deferred_fields = self.get_deferred_fields()
+            if set(fields) <= deferred_fields and 'password' not in fields:
+                row = self.get_cached_row(self.pk)
+                if row is None:
+                    raise self.DoesNotExist("User matching token claims does not exist.")
+
+                for attname in deferred_fields:
+                    if attname in row:
+                        setattr(self, attname, row[attname])
+                return
+
+        super().refresh_from_db(using=using, fields=fields)
     
 
 
@@ -49,6 +150,9 @@ class UserProfile(BaseModel):
     bio = models.CharField(max_length=255, blank=True, null=True)
     website = models.URLField(max_length=200, blank=True)
     interests = models.CharField(max_length=500, blank=True)
+
+    #when the user was last sent a new posts digest
+    last_digest_at = models.DateTimeField(null=True, blank=True)
     
     followers = models.ManyToManyField(User, related_name='followers', blank=True)
     following = models.ManyToManyField(User, related_name='following', blank=True)
@@ -81,6 +185,40 @@ class Tokens(BaseModel):
 
 
 
+class EmailOutbox(BaseModel):
+    '''
+    mails waiting to be sent. Rows are written inside the request transaction and handed to the email worker pool after commit,
+    mails left behind (process died, smtp down) are retried with backoff by manage.py deliver_outbox
+    '''
+
+    to_email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+
+    status = models.CharField(max_length=20, default='pending', choices=(
+        ('pending', 'pending'),
+        ('sent', 'sent'),
+        ('failed', 'failed'),
+    ))
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claim = models.UUIDField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    objects = EmailOutboxManager()
+
+    class Meta:
+        verbose_name_plural = "Email Outbox"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.to_email} - {self.subject}"
+
+
+
 '''
 class Plans(BaseModel):
     name = models.CharField(max_length=100, blank=False)
@@ -102,23 +240,55 @@ class Blog(BaseModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='blogs')
     
     published = models.BooleanField(default=False)
+    published_at = models.DateTimeField(null=True, blank=True)
     title = models.CharField(max_length=500, blank=False)
     slug = AutoSlugField(populate_from='title', unique=True)
 
     header_img = models.ImageField(upload_to='blog_header_img/', blank=False) 
+    header_img_variants = models.JSONField(default=dict, blank=True, editable=False)
+    header_img_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    header_img_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    header_img_color = models.CharField(max_length=7, blank=True, editable=False)
+    header_img_blurhash = models.CharField(max_length=100, blank=True, editable=False)
     content = models.TextField()
 
     tags = models.CharField(max_length=800, blank=True)
 
     likes_no = models.IntegerField(default=0)
     comments_no = models.IntegerField(default=0)
+
+    objects = BlogQuerySet.as_manager()
     
     class Meta:
         verbose_name_plural = "Blogs"
+        #latest, popular and rated listings of published blogs, new posts of digests and blogs of a user. The published blogs
+        #indexes are partial: they are smaller and sqlite can't use a (published, x) index for a bare boolean WHERE "published"
+        indexes = [
+            models.Index(fields=['-created_at'], condition=models.Q(published=True), name='blog_published_created_idx'),
+            models.Index(fields=['-likes_no'], condition=models.Q(published=True), name='blog_published_likes_idx'),
+            models.Index(fields=['-comments_no'], condition=models.Q(published=True), name='blog_published_comments_idx'),
+            models.Index(fields=['published_at'], condition=models.Q(published=True), name='blog_published_at_idx'),
+            models.Index(fields=['user', '-created_at'], name='blog_user_created_idx'),
+        ]
     
     def __str__(self):
         return self.title
 
+    #published_at holds the first time the blog was published, new posts digests are based on it. Saved along with published
+    #when only some fields are saved, see BlogQuerySet for update() and bulk_update()
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self.published and self.published_at is None and (update_fields is None or 'published' in update_fields):
+            self.published_at = timezone.now()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'published_at'}
+
+        super(Blog, self).save(*args, **kwargs)
+
+    #the comments, replies and likes of the blog are deleted in chunks without a counter update per row
+    def delete(self, using=None, keep_parents=False):
+        return delete_blogs([self.pk], using=using or router.db_for_write(Blog, instance=self), keep_parents=keep_parents)
+
 
     
 
@@ -129,9 +299,16 @@ class BlogComments(BaseModel):
 
     likes_no = models.IntegerField(default=0)
     comments_no = models.IntegerField(default=0)
-    
+
+    #counters of the parents kept by the signals and by the bulk methods of CounterQuerySet
+    parent_counters = {'blog': 'comments_no'}
+    objects = CounterQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Blog Comments"
+        indexes = [
+            models.Index(fields=['blog', '-created_at'], name='blogcomment_blog_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user}"
@@ -142,9 +319,18 @@ class BlogComments(BaseModel):
 class BlogLikes(BaseModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     blog = models.ForeignKey(Blog, on_delete=models.CASCADE, related_name='blog_likes')
-    
+
+    parent_counters = {'blog': 'likes_no'}
+    objects = CounterQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Blog Likes"
+        indexes = [
+            models.Index(fields=['blog', '-created_at'], name='bloglike_blog_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'blog'], name='unique_blog_like'),
+        ]
     
     def __str__(self):
         return f"{self.user} - {self.blog}"
@@ -165,6 +351,9 @@ class ReplyComments(BaseModel):
     likes_no = models.IntegerField(default=0)
     comments_no = models.IntegerField(default=0)
 
+    parent_counters = {'parent_blog_comment': 'comments_no', 'parent_reply_comment': 'comments_no'}
+    objects = CounterQuerySet.as_manager()
+
 
     #overriding save method to make sure parent_blog_comment or parent_reply_comment both are not null
     def save(self, *args, **kwargs):
@@ -177,6 +366,10 @@ class ReplyComments(BaseModel):
 
     class Meta:
         verbose_name_plural = "Comments Reply"
+        indexes = [
+            models.Index(fields=['parent_blog_comment', '-created_at'], name='reply_blogcomment_created_idx'),
+            models.Index(fields=['parent_reply_comment', '-created_at'], name='reply_reply_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user}"
@@ -193,6 +386,9 @@ class LikeComments(BaseModel):
     parent_blog_comment = models.ForeignKey(BlogComments, on_delete=models.CASCADE, related_name='like_blog_comments', blank=True, null=True)
     parent_reply_comment = models.ForeignKey(ReplyComments, on_delete=models.CASCADE, related_name='like_reply_comments', blank=True, null=True)
 
+    parent_counters = {'parent_blog_comment': 'likes_no', 'parent_reply_comment': 'likes_no'}
+    objects = CounterQuerySet.as_manager()
+
     #overriding save method to make sure parent_blog_comment or parent_reply_comment both are not null
     def save(self, *args, **kwargs):
         if self.parent_blog_comment is None and self.parent_reply_comment is None:
@@ -201,6 +397,15 @@ class LikeComments(BaseModel):
     
     class Meta:
         verbose_name_plural = "Comments Like"
+        indexes = [
+            models.Index(fields=['parent_blog_comment', '-created_at'], name='like_blogcomment_created_idx'),
+            models.Index(fields=['parent_reply_comment', '-created_at'], name='like_reply_created_idx'),
+        ]
+        #a user likes a comment once
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'parent_blog_comment'], condition=models.Q(parent_blog_comment__isnull=False), name='unique_blog_comment_like'),
+            models.UniqueConstraint(fields=['user', 'parent_reply_comment'], condition=models.Q(parent_reply_comment__isnull=False), name='unique_reply_comment_like'),
+        ]
     
     def __str__(self):
         return f"{self.user}"
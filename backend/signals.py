@@ -1,11 +1,31 @@
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
+from django.db import DatabaseError
+from django.db.models import QuerySet
 
-from backend.models import User, UserProfile, Tokens, BlogComments, BlogLikes, ReplyComments, LikeComments
-from .utils import EmailSender
+from backend.models import User, UserProfile, Tokens, Blog, BlogComments, BlogLikes, ReplyComments, LikeComments
+from .utils import EmailSender, defer_counter, defer_call
+from .images import queue_variants
+from . import metrics
+
+import logging
+
+
+logger = logging.getLogger(__name__)
 
 
 #signals
+#side effects (emails, counters, cache invalidation) are deferred until the transaction commits and coalesced per transaction
+
+
+#True when instance is deleted by the cascade of a blog, comment or reply (origin of the delete): its parent is deleted
+#with it, so there is no counter to maintain
+def parent_is_deleted(sender, instance, origin):
+    if isinstance(origin, QuerySet):
+        return origin.model in (Blog, BlogComments, ReplyComments) and origin.model is not sender
+
+    return isinstance(origin, (Blog, BlogComments, ReplyComments)) and not (type(origin) is sender and origin.pk == instance.pk)
+
 
 @receiver(post_save, sender=User)
 def user_created_handler(sender, instance, created, *args, **kwargs):
@@ -15,16 +35,60 @@ def user_created_handler(sender, instance, created, *args, **kwargs):
 
     try:
         #execute only if db record is created
-        if created:    
+        if created:
             user_profile = UserProfile(user=instance)
             user_profile.save()
 
             #send email verification link to user
             EmailSender(instance.email).email_verify_link_send(
-                user=instance, 
+                user=instance,
                 name=instance.get_full_name(),
             )
 
+    #a failed write must abort the transaction, not leave it half applied
+    except DatabaseError:
+        raise
+
+    except Exception as e:
+        print(e)
+        pass
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed_handler(sender, instance, *args, **kwargs):
+    '''
+    drop the cached row of a user once an update or delete of it is committed, and its logout timestamp once it is deleted
+    '''
+
+    defer_call(User.clear_cached_rows, instance.pk)
+    if kwargs.get('signal') is post_delete:
+        defer_call(User.clear_logout_timestamps, instance.email)
+
+
+@receiver(post_save, sender=User)
+def profile_pic_changed_handler(sender, instance, *args, **kwargs):
+    '''
+    generate the resized variants of a new profile pic in the background once it is saved
+    '''
+
+    try:
+        queue_variants(instance, 'profile_pic')
+
+    except Exception as e:
+        print(e)
+        pass
+
+
+@receiver(post_save, sender=Blog)
+def header_img_changed_handler(sender, instance, *args, **kwargs):
+    '''
+    generate the resized variants of a new blog header image in the background once it is saved
+    '''
+
+    try:
+        queue_variants(instance, 'header_img')
+
     except Exception as e:
         print(e)
         pass
@@ -38,14 +102,18 @@ def token_created_handler(sender, instance, created, *args, **kwargs):
 
     try:
         #execute only if db record is created
-        if created:    
+        if created:
             if instance.use == "reset-password":
                EmailSender(instance.user.email).reset_password_link_send(
-                   user=instance.user, 
-                   name=instance.user.get_full_name(), 
+                   user=instance.user,
+                   name=instance.user.get_full_name(),
                    token=instance.token
                 )
 
+    #a failed write must abort the transaction, not leave it half applied
+    except DatabaseError:
+        raise
+
     except Exception as e:
         print(e)
         pass
@@ -60,11 +128,8 @@ def blog_comment_create_handler(sender, instance, created, *args, **kwargs):
 
     try:
         #execute only if db record is created
-        if created:    
-            blog = instance.blog
-            if blog.comments_no >= 0:
-                blog.comments_no += 1
-                blog.save()
+        if created:
+            defer_counter(Blog, instance.blog_id, 'comments_no', 1)
 
     except Exception as e:
         print(e)
@@ -79,10 +144,10 @@ def blog_comment_delete_handler(sender, instance, *args, **kwargs):
     '''
 
     try:
-        blog = instance.blog
-        if blog.comments_no >= 1:
-            blog.comments_no -= 1
-            blog.save()
+        if parent_is_deleted(sender, instance, kwargs.get('origin')):
+            return
+
+        defer_counter(Blog, instance.blog_id, 'comments_no', -1)
 
     except Exception as e:
         print(e)
@@ -98,11 +163,8 @@ def blog_like_created_handler(sender, instance, created, *args, **kwargs):
 
     try:
         #execute only if db record is created
-        if created:    
-            blog = instance.blog
-            if blog.likes_no >= 0:
-                blog.likes_no += 1
-                blog.save()
+        if created:
+            defer_counter(Blog, instance.blog_id, 'likes_no', 1)
 
     except Exception as e:
         print(e)
@@ -118,10 +180,10 @@ def blog_like_delete_handler(sender, instance, *args, **kwargs):
     '''
 
     try:
-        blog = instance.blog
-        if blog.likes_no >= 1:
-            blog.likes_no -= 1
-            blog.save()
+        if parent_is_deleted(sender, instance, kwargs.get('origin')):
+            return
+
+        defer_counter(Blog, instance.blog_id, 'likes_no', -1)
 
     except Exception as e:
         print(e)
@@ -132,24 +194,17 @@ def blog_like_delete_handler(sender, instance, *args, **kwargs):
 @receiver(post_save, sender=ReplyComments)
 def reply_comment_created_handler(sender, instance, created, *args, **kwargs):
     '''
-    increase the likes_no of the BlogComment by 1 when a new ReplyComments is created
+    increase the comments_no of the parent comment by 1 when a new ReplyComments is created
     '''
 
     try:
         #execute only if db record is created
-        if created:    
-            parent_blog_comment = instance.parent_blog_comment
-            parent_reply_comment = instance.parent_reply_comment
+        if created:
+            if instance.parent_blog_comment_id is not None:
+                defer_counter(BlogComments, instance.parent_blog_comment_id, 'comments_no', 1)
 
-            if parent_blog_comment is not None:
-                if parent_blog_comment.comments_no >= 0:
-                    parent_blog_comment.comments_no += 1
-                    parent_blog_comment.save()
-
-            elif parent_reply_comment is not None:
-                if parent_reply_comment.comments_no >= 0:
-                    parent_reply_comment.comments_no += 1
-                    parent_reply_comment.save()
+            elif instance.parent_reply_comment_id is not None:
+                defer_counter(ReplyComments, instance.parent_reply_comment_id, 'comments_no', 1)
 
 
     except Exception as e:
@@ -162,22 +217,18 @@ def reply_comment_created_handler(sender, instance, created, *args, **kwargs):
 @receiver(pre_delete, sender=ReplyComments)
 def reply_comment_delete_handler(sender, instance, *args, **kwargs):
     '''
-    increase the likes_no of the BlogComment by 1 when a ReplyComments is deleted
+    decrease the comments_no of the parent comment by 1 when a ReplyComments is deleted
     '''
 
-    try:  
-        parent_blog_comment = instance.parent_blog_comment
-        parent_reply_comment = instance.parent_reply_comment
+    try:
+        if parent_is_deleted(sender, instance, kwargs.get('origin')):
+            return
 
-        if parent_blog_comment is not None:
-            if parent_blog_comment.comments_no >= 1:
-                parent_blog_comment.comments_no -= 1
-                parent_blog_comment.save()
+        if instance.parent_blog_comment_id is not None:
+            defer_counter(BlogComments, instance.parent_blog_comment_id, 'comments_no', -1)
 
-        elif parent_reply_comment is not None:
-            if parent_reply_comment.comments_no >= 1:
-                parent_reply_comment.comments_no -= 1
-                parent_reply_comment.save()
+        elif instance.parent_reply_comment_id is not None:
+            defer_counter(ReplyComments, instance.parent_reply_comment_id, 'comments_no', -1)
 
 
     except Exception as e:
@@ -190,24 +241,17 @@ def reply_comment_delete_handler(sender, instance, *args, **kwargs):
 @receiver(post_save, sender=LikeComments)
 def like_comment_created_handler(sender, instance, created, *args, **kwargs):
     '''
-    increase the likes_no of the BlogComment by 1 when a new LikeComment is created
+    increase the likes_no of the parent comment by 1 when a new LikeComment is created
     '''
 
     try:
         #execute only if db record is created
-        if created:    
-            parent_blog_comment = instance.parent_blog_comment
-            parent_reply_comment = instance.parent_reply_comment
-
-            if parent_blog_comment is not None:
-                if parent_blog_comment.like_no >= 0:
-                    parent_blog_comment.like_no += 1
-                    parent_blog_comment.save()
+        if created:
+            if instance.parent_blog_comment_id is not None:
+                defer_counter(BlogComments, instance.parent_blog_comment_id, 'likes_no', 1)
 
-            elif parent_reply_comment is not None:
-                if parent_reply_comment.like_no >= 0:
-                    parent_reply_comment.like_no += 1
-                    parent_reply_comment.save()
+            elif instance.parent_reply_comment_id is not None:
+                defer_counter(ReplyComments, instance.parent_reply_comment_id, 'likes_no', 1)
 
 
     except Exception as e:
@@ -219,22 +263,18 @@ def like_comment_created_handler(sender, instance, created, *args, **kwargs):
 @receiver(pre_delete, sender=LikeComments)
 def like_comment_delete_handler(sender, instance, *args, **kwargs):
     '''
-    increase the likes_no of the BlogComment by 1 when a LikeComment is deleted
+    decrease the likes_no of the parent comment by 1 when a LikeComment is deleted
     '''
 
     try:
-        parent_blog_comment = instance.parent_blog_comment
-        parent_reply_comment = instance.parent_reply_comment
+        if parent_is_deleted(sender, instance, kwargs.get('origin')):
+            return
 
-        if parent_blog_comment is not None:
-            if parent_blog_comment.like_no >= 1:
-                parent_blog_comment.like_no -= 1
-                parent_blog_comment.save()
+        if instance.parent_blog_comment_id is not None:
+            defer_counter(BlogComments, instance.parent_blog_comment_id, 'likes_no', -1)
 
-        elif parent_reply_comment is not None:
-            if parent_reply_comment.like_no >= 1:
-                parent_reply_comment.like_no -= 1
-                parent_reply_comment.save()
+        elif instance.parent_reply_comment_id is not None:
+            defer_counter(ReplyComments, instance.parent_reply_comment_id, 'likes_no', -1)
 
 
     except Exception as e:
@@ -243,3 +283,19 @@ def like_comment_delete_handler(sender, instance, *args, **kwargs):
 
 
 
+@receiver(post_save, sender=Blog)
+@receiver(post_save, sender=BlogComments)
+@receiver(post_save, sender=ReplyComments)
+@receiver(post_save, sender=BlogLikes)
+@receiver(post_save, sender=LikeComments)
+def content_created_handler(sender, instance, created, *args, **kwargs):
+    '''
+    count new blogs, comments, replies and likes in the metrics once their transaction commits
+    '''
+
+    try:
+        if created:
+            defer_call(metrics.count_created, (sender._meta.label, instance.pk))
+
+    except Exception:
+        logger.exception("%s %s not counted in the metrics", sender._meta.label, instance.pk)
@@ -0,0 +1,58 @@
+from django.core.files.storage import FileSystemStorage
+
+import os
+import hashlib
+import posixpath
+import tempfile
+
+
+#media storage naming every file by the sha256 of its content
+class ContentAddressedStorage(FileSystemStorage):
+    '''
+    A file is written once to a temp file in the target folder while it is hashed, then moved to <folder>/<2 hex>/<sha256><ext>.
+    When that blob already exists the temp file is dropped, so the same image uploaded again, or a variant rendered again, takes no
+    extra space and every row using it points to the same name. Blobs are never deleted with the rows using them,
+    collect_media deletes the blobs no row references anymore; saving the content of an existing blob again touches it,
+    so it's not collected before the row using it is committed.
+    '''
+
+    #blobs are named by their content, an existing name already holds the same bytes
+    def get_available_name(self, name, max_length=None):
+        return name
+
+
+    def _save(self, name, content):
+        directory, filename = posixpath.split(name)
+        extension = posixpath.splitext(filename)[1].lower()
+
+        directory_path = self.path(directory)
+        os.makedirs(directory_path, exist_ok=True)
+
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=directory_path, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    file.write(chunk)
+
+            digest = digest.hexdigest()
+            name = posixpath.join(directory, digest[:2], f"{digest}{extension}")
+            full_path = self.path(name)
+
+            if os.path.exists(full_path):
+                os.remove(temp_path)
+                #the blob is used again, collect_media keeps blobs modified during its grace period
+                os.utime(full_path)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.chmod(temp_path, self.file_permissions_mode or 0o644)
+                #atomic, a concurrent upload of the same content writes the same bytes
+                os.replace(temp_path, full_path)
+
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return name
@@ -1,3 +1,1740 @@
-from django.test import TestCase
+import os
+import sys
+import time
+import sqlite3
+import threading
+import importlib
+import importlib.util
+import json
+import tempfile
+import subprocess
+import collections
+import zlib
+from io import StringIO, BytesIO
+from unittest import skipUnless, mock
+
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core import mail
+from django.contrib.auth import hashers
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.signals import user_login_failed
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import transaction, connection, connections, router, IntegrityError, OperationalError
+from django.utils.connection import ConnectionDoesNotExist
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, multipartparser
+from rest_framework.test import APIClient
+from rest_framework.pagination import PageNumberPagination
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from django.utils import timezone
+from django.apps import apps
+from django.conf import settings
+from PIL import Image
+
+from backend.api.serializers import MyTokenObtainPairSerializer
+from backend.models import User, UserProfile, Blog, BlogLikes, BlogComments, ReplyComments, LikeComments, EmailOutbox
+from backend.utils import EmailSender, EmailWorkerPool, deliver_outbox, defer_call
+from backend.db.sqlite3.base import DatabaseWrapper
+from backend import metrics
+from backend.images import ImageWorkerPool, image_pool, blurhash, dominant_color
+from backend.db.transaction import write_transaction, lock_stats
+from backend.api.utils import IMG_MAX_SIZE
+from backend.api.uploads import ImageUploadHandler
+from backend.api.throttling import AnonSlidingRateThrottle
+from backend.middleware import ReplicaRoutingMiddleware, QueryPatternMiddleware, RepeatedQueriesError, fingerprint
 
 # Create your tests here.
+
+
+#email backend which fails for every mail
+class FailingEmailBackend(EmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError("smtp is down")
+
+
+#email backend which counts the connections opened
+class CountingEmailBackend(EmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+#bytes of a generated image
+def image_bytes(size=(64, 48), format='PNG', color=(200, 30, 60)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+#uploaded file of a generated image
+def image_file(name='header.png', **kwargs):
+    return SimpleUploadedFile(name, image_bytes(**kwargs), content_type='image/png')
+
+
+#points the media storage of a test to an empty temporary MEDIA_ROOT
+#blog fixtures have header_img='blog.png', which is not a file, rendering its variants would only fail with a warning
+def mute_image_variants():
+    return mock.patch('backend.signals.queue_variants')
+
+
+def use_temp_media(test):
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    settings_override = override_settings(MEDIA_ROOT=directory.name)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+    return directory.name
+
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class EmailOutboxTests(TestCase):
+
+    def test_mail_is_delivered_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            EmailSender('user@blogzilla.com').reset_password_notify()
+            self.assertEqual(len(mail.outbox), 0)
+            self.assertEqual(EmailOutbox.objects.get().status, 'pending')
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['user@blogzilla.com'])
+        self.assertEqual(EmailOutbox.objects.get().status, 'sent')
+
+
+    def test_rolled_back_mail_is_not_sent(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    EmailSender('user@blogzilla.com').reset_password_notify()
+                    raise ValueError
+            except ValueError:
+                pass
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(EmailOutbox.objects.exists())
+
+
+    @override_settings(EMAIL_BACKEND='backend.tests.CountingEmailBackend')
+    def test_command_delivers_batches_over_one_connection(self):
+        for i in range(5):
+            EmailSender(f'user{i}@blogzilla.com').email_verify_notify()
+
+        CountingEmailBackend.opened = 0
+        call_command('deliver_outbox', batch_size=10, stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(EmailOutbox.objects.filter(status='sent').count(), 5)
+
+
+    @override_settings(EMAIL_BACKEND='backend.tests.FailingEmailBackend', EMAIL_OUTBOX_RETRY_DELAY=60, EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_failed_mail_is_retried_with_backoff(self):
+        EmailSender('user@blogzilla.com').email_verify_notify()
+
+        self.assertEqual(deliver_outbox(), (0, 1))
+        email = EmailOutbox.objects.get()
+        self.assertEqual((email.status, email.attempts), ('pending', 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+
+        #not due yet
+        self.assertEqual(deliver_outbox(), (0, 0))
+
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_outbox(), (0, 1))
+        self.assertEqual(EmailOutbox.objects.get().status, 'failed')
+
+
+
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class SignalBatchTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True), mute_image_variants():
+            self.user = User.objects.create_user(email='author@blogzilla.com', password='password')
+            self.blog = Blog.objects.create(user=self.user, title='title', content='content', header_img='blog.png')
+
+
+    def test_counters_are_coalesced_per_transaction(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other = User.objects.create_user(email='reader@blogzilla.com', password='password')
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            BlogLikes.objects.create(user=self.user, blog=self.blog)
+            BlogLikes.objects.create(user=other, blog=self.blog)
+            BlogComments.objects.create(user=other, blog=self.blog, comment='comment')
+
+        self.assertEqual(len(callbacks), 1)
+        self.blog.refresh_from_db()
+        self.assertEqual((self.blog.likes_no, self.blog.comments_no), (2, 1))
+
+
+    def test_rolled_back_savepoint_costs_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            BlogComments.objects.create(user=self.user, blog=self.blog, comment='kept')
+            try:
+                with transaction.atomic():
+                    BlogComments.objects.create(user=self.user, blog=self.blog, comment='rolled back')
+                    raise ValueError
+            except ValueError:
+                pass
+
+        self.blog.refresh_from_db()
+        self.assertEqual(self.blog.comments_no, 1)
+
+
+    def test_blog_delete_skips_counters_of_deleted_parents(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            comments = [BlogComments.objects.create(user=self.user, blog=self.blog, comment='comment') for i in range(3)]
+            reply = ReplyComments.objects.create(user=self.user, parent_blog_comment=comments[0], comment='reply')
+            ReplyComments.objects.create(user=self.user, parent_reply_comment=reply, comment='reply of reply')
+            LikeComments.objects.create(user=self.user, parent_reply_comment=reply)
+            BlogLikes.objects.create(user=self.user, blog=self.blog)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks, CaptureQueriesContext(connection) as context:
+            deleted, rows = self.blog.delete()
+
+        self.assertEqual(rows, {'backend.LikeComments': 1, 'backend.BlogLikes': 1, 'backend.ReplyComments': 2, 'backend.BlogComments': 3, 'backend.Blog': 1})
+        self.assertFalse([query for query in context.captured_queries if query['sql'].startswith('UPDATE')])
+        self.assertFalse(callbacks)
+        for model in (Blog, BlogComments, ReplyComments, LikeComments, BlogLikes):
+            self.assertFalse(model.objects.exists())
+
+
+    def test_blog_delete_uses_the_given_database(self):
+        with self.assertRaises(ConnectionDoesNotExist):
+            self.blog.delete(using='missing')
+        self.assertTrue(Blog.objects.filter(pk=self.blog.pk).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deleted, rows = self.blog.delete(using='default', keep_parents=True)
+        self.assertEqual(rows, {'backend.Blog': 1})
+        self.assertFalse(Blog.objects.exists())
+
+
+    def test_bulk_create_and_delete_keep_counters(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            users = [User.objects.create_user(email=f'reader{i}@blogzilla.com', password='password') for i in range(3)]
+            comment = BlogComments.objects.create(user=self.user, blog=self.blog, comment='comment')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BlogLikes.objects.bulk_create([BlogLikes(user=user, blog=self.blog) for user in users[:2]])
+            BlogLikes.objects.bulk_create([BlogLikes(user=user, blog=self.blog) for user in users], ignore_conflicts=True)
+            LikeComments.objects.bulk_create([LikeComments(user=user, parent_blog_comment=comment) for user in users])
+
+        self.blog.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual((self.blog.likes_no, comment.likes_no), (3, 3))
+
+        with CaptureQueriesContext(connection) as context, self.captureOnCommitCallbacks(execute=True):
+            deleted, rows = LikeComments.objects.filter(user__in=users[:2]).delete()
+        self.assertEqual(deleted, 2)
+        self.assertEqual(len([query for query in context.captured_queries if query['sql'].startswith('UPDATE')]), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BlogLikes.objects.filter(blog=self.blog).delete()
+
+        self.blog.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual((self.blog.likes_no, comment.likes_no), (0, 1))
+
+
+    def test_comment_delete_updates_blog_only(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            comment = BlogComments.objects.create(user=self.user, blog=self.blog, comment='comment')
+            ReplyComments.objects.create(user=self.user, parent_blog_comment=comment, comment='reply')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            comment.delete()
+
+        self.blog.refresh_from_db()
+        self.assertEqual(self.blog.comments_no, 0)
+
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN output is sqlite specific")
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class QueryPlanTests(TestCase):
+    '''
+    the paginated query of every list endpoint must be served by an index, not by a scan followed by a temp b-tree sort
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+        with mute_image_variants():
+            cls.blog = Blog.objects.create(user=cls.user, title='title', content='content', header_img='blog.png', published=True)
+        cls.comment = BlogComments.objects.create(user=cls.user, blog=cls.blog, comment='comment')
+        cls.reply = ReplyComments.objects.create(user=cls.user, parent_blog_comment=cls.comment, comment='reply')
+        ReplyComments.objects.create(user=cls.user, parent_reply_comment=cls.reply, comment='reply of reply')
+        BlogLikes.objects.create(user=cls.user, blog=cls.blog)
+        LikeComments.objects.create(user=cls.user, parent_blog_comment=cls.comment)
+        LikeComments.objects.create(user=cls.user, parent_reply_comment=cls.reply)
+
+
+    def assertListUsesIndex(self, url):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        ordered = [query['sql'] for query in context.captured_queries if 'ORDER BY' in query['sql']]
+        self.assertTrue(ordered, f"{url} ran no ordered query")
+
+        for sql in ordered:
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                plan = [row[-1] for row in cursor.fetchall()]
+
+            self.assertFalse([step for step in plan if 'TEMP B-TREE' in step], f"{url}: {plan}")
+            self.assertFalse([step for step in plan if step.startswith('SCAN') and 'INDEX' not in step], f"{url}: {plan}")
+
+
+    def test_blog_listings(self):
+        for ordering in ('latest', 'popular', 'rated'):
+            self.assertListUsesIndex(f'/api/blog/?{ordering}=true')
+
+    def test_user_blogs(self):
+        self.assertListUsesIndex('/api/user/blog/?latest=true')
+
+    def test_blog_comments_and_likes(self):
+        self.assertListUsesIndex(f'/api/blog/{self.blog.uuid}/comments/')
+        self.assertListUsesIndex(f'/api/blog/{self.blog.uuid}/likes/')
+
+    def test_replies_and_comment_likes(self):
+        for parent in (self.comment, self.reply):
+            self.assertListUsesIndex(f'/api/blog/comments/{parent.uuid}/reply/')
+            self.assertListUsesIndex(f'/api/blog/comments/{parent.uuid}/likes/')
+
+
+    def test_likes_are_unique(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            BlogLikes.objects.create(user=self.user, blog=self.blog)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LikeComments.objects.create(user=self.user, parent_reply_comment=self.reply)
+
+
+
+
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class QueryBudgetTests(TestCase):
+    '''
+    every list endpoint must run the same queries for a page of 1, 10 or 50 rows, and no more than its budget: the rows of a
+    page may not query their author, counts or profile one by one (N+1). Raise a budget only along with the query it pays for
+    '''
+
+    PAGE_SIZES = (1, 10, 50)
+    ROWS = 55
+
+    BUDGETS = {
+        'blog_list': 3,
+        'blog_list_latest': 3,
+        'user_blogs': 3,
+        'blog_comments': 3,
+        'comment_replies': 4,
+        'reply_replies': 4,
+        'blog_likes': 3,
+        'comment_likes': 4,
+        'reply_likes': 4,
+        'people': 2,
+        'people_popular': 2,
+        'people_followers': 4,
+        'people_following': 4,
+        'user_followers': 3,
+        'user_following': 3,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create([
+            User(email=f'user{i}@blogzilla.com', password='!', first_name=f'user{i}', is_verified=True) for i in range(cls.ROWS)
+        ])
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+        cls.user = users[0]
+        cls.user.user_profile.followers.add(*users[1:])
+        cls.user.user_profile.following.add(*users[1:])
+
+        blogs = Blog.objects.bulk_create(
+            [Blog(user=user, title=f'title {i}', content='content', header_img='blog.png', published=True) for i, user in enumerate(users)]
+            + [Blog(user=cls.user, title=f'draft {i}', content='content', header_img='blog.png') for i in range(cls.ROWS)]
+        )
+        cls.blog = blogs[0]
+        cls.comment = BlogComments.objects.create(user=cls.user, blog=cls.blog, comment='comment')
+        cls.reply = ReplyComments.objects.create(user=cls.user, parent_blog_comment=cls.comment, comment='reply')
+
+        BlogComments.objects.bulk_create([BlogComments(user=user, blog=cls.blog, comment='comment') for user in users])
+        ReplyComments.objects.bulk_create([ReplyComments(user=user, parent_blog_comment=cls.comment, comment='reply') for user in users])
+        ReplyComments.objects.bulk_create([ReplyComments(user=user, parent_reply_comment=cls.reply, comment='reply') for user in users])
+        BlogLikes.objects.bulk_create([BlogLikes(user=user, blog=cls.blog) for user in users])
+        LikeComments.objects.bulk_create([LikeComments(user=user, parent_blog_comment=cls.comment) for user in users])
+        LikeComments.objects.bulk_create([LikeComments(user=user, parent_reply_comment=cls.reply) for user in users])
+
+
+    def get_endpoints(self):
+        return {
+            'blog_list': '/api/blog/',
+            'blog_list_latest': '/api/blog/?latest=true',
+            'user_blogs': '/api/user/blog/',
+            'blog_comments': f'/api/blog/{self.blog.uuid}/comments/',
+            'comment_replies': f'/api/blog/comments/{self.comment.uuid}/reply/',
+            'reply_replies': f'/api/blog/comments/{self.reply.uuid}/reply/',
+            'blog_likes': f'/api/blog/{self.blog.uuid}/likes/',
+            'comment_likes': f'/api/blog/comments/{self.comment.uuid}/likes/',
+            'reply_likes': f'/api/blog/comments/{self.reply.uuid}/likes/',
+            'people': '/api/people/',
+            'people_popular': '/api/people/?popular=true',
+            'people_followers': f'/api/people/followers/{self.user.uuid}',
+            'people_following': f'/api/people/following/{self.user.uuid}',
+            'user_followers': '/api/user/followers/',
+            'user_following': '/api/user/following/',
+        }
+
+
+    #numbered sql of the queries of a request, for the failure messages
+    def format_queries(self, queries):
+        return "\n".join(f"  {i}. {query['sql']}" for i, query in enumerate(queries, 1))
+
+
+    def test_annotated_counts_are_the_real_counts(self):
+        person = APIClient().get(f'/api/people/{self.user.uuid}').json()
+        self.assertEqual(person['blogs_published_no'], self.ROWS + 1)
+        self.assertEqual((person['user_profile']['followers'], person['user_profile']['following']), (self.ROWS - 1, self.ROWS - 1))
+
+        blog = APIClient().get(f'/api/blog/{self.blog.uuid}').json()
+        self.assertEqual(blog['user']['blogs_published'], self.ROWS + 1)
+
+
+    def test_endpoints_have_declared_budgets(self):
+        self.assertEqual(set(self.get_endpoints()), set(self.BUDGETS))
+
+
+    def test_query_count_is_constant_per_page(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        for name, url in self.get_endpoints().items():
+            with self.subTest(endpoint=name):
+                runs = {}
+                for size in self.PAGE_SIZES:
+                    with mock.patch.object(PageNumberPagination, 'page_size', size), CaptureQueriesContext(connection) as context:
+                        response = client.get(url)
+
+                    self.assertEqual(response.status_code, 200, f"{name}: {response.content[:500]}")
+                    self.assertEqual(len(response.json()['results']), size, f"{name} has too few rows to fill a page of {size}")
+                    runs[size] = context.captured_queries
+
+                counts = {size: len(queries) for size, queries in runs.items()}
+                size = max(runs, key=lambda size: (len(runs[size]), size))
+                message = f"{name} ran {counts} queries per page size, budget {self.BUDGETS.get(name)}. Queries of a page of {size}:\n{self.format_queries(runs[size])}"
+
+                self.assertEqual(len(set(counts.values())), 1, message)
+                self.assertLessEqual(counts[size], self.BUDGETS.get(name, 0), message)
+
+
+#routing decisions only, no query is run: replicas are mirrors of the test database
+@override_settings(DATABASE_REPLICAS=['replica_0'], REPLICA_STICKY_SECONDS=10)
+class ReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = ReplicaRoutingMiddleware(lambda request: HttpResponse(router.db_for_read(Blog)))
+
+    def read_db(self, method='get', **headers):
+        return self.middleware(getattr(self.factory, method)('/api/blogs/', **headers)).content.decode()
+
+
+    def test_safe_requests_read_from_replica(self):
+        self.assertEqual(self.read_db(), 'replica_0')
+        self.assertEqual(router.db_for_read(Blog), 'default')
+        self.assertEqual(router.db_for_write(Blog), 'default')
+
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        self.assertEqual(self.read_db('post', HTTP_AUTHORIZATION='Bearer a'), 'default')
+        self.assertEqual(self.read_db(HTTP_AUTHORIZATION='Bearer a'), 'default')
+        self.assertEqual(self.read_db(HTTP_AUTHORIZATION='Bearer b'), 'replica_0')
+
+
+
+#reads served by a second sqlite file, a copy of the primary which has not caught up with its last write
+@override_settings(DATABASE_REPLICAS=['replica_0'], EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class ReplicaReadsTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+        Blog.objects.create(user=user, title='copied', content='content', published=True)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        replica = sqlite3.connect(os.path.join(directory.name, 'replica.sqlite3'))
+        connection.ensure_connection()
+        connection.connection.backup(replica)
+        replica.close()
+
+        connections.settings['replica_0'] = {**connections.settings['default'], 'NAME': os.path.join(directory.name, 'replica.sqlite3')}
+        self.addCleanup(connections.settings.pop, 'replica_0')
+        self.addCleanup(connections.__delitem__, 'replica_0')
+        self.addCleanup(lambda: connections['replica_0'].close())
+
+        Blog.objects.create(user=user, title='not copied', content='content', published=True)
+
+    def titles(self):
+        response = self.client.get('/api/blog/')
+        self.assertEqual(response.status_code, 200)
+        return sorted(blog['title'] for blog in response.json()['results'])
+
+
+    def test_reads_come_from_the_replica(self):
+        self.assertEqual(self.titles(), ['copied'])
+
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        self.client.post('/api/blog/', {})
+        self.assertEqual(self.titles(), ['copied', 'not copied'])
+
+        cache.clear()
+        self.assertEqual(self.titles(), ['copied'])
+
+
+
+#view running one query per blog of the list
+def blogs_published_view(request):
+    counts = [Blog.objects.filter(user=blog.user_id).count() for blog in Blog.objects.all()]
+    return HttpResponse(str(counts))
+
+
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0, NPLUSONE_SAMPLE_RATE=1, NPLUSONE_THRESHOLD=2, NPLUSONE_RAISE=False)
+class QueryPatternTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(email='author@blogzilla.com', password='password')
+        Blog.objects.bulk_create([Blog(user=user, title=f'title {i}', content='content', header_img='blog.png') for i in range(3)])
+
+    def setUp(self):
+        self.request = RequestFactory().get('/api/blog/')
+
+
+    def test_in_lists_have_one_shape(self):
+        self.assertEqual(fingerprint('SELECT * FROM t WHERE id IN (%s, %s)'), fingerprint('SELECT * FROM t WHERE id IN (%s)'))
+
+
+    def test_repeated_queries_are_logged_with_call_site(self):
+        with self.assertLogs('backend.middleware', 'WARNING') as logs:
+            response = QueryPatternMiddleware(blogs_published_view)(self.request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('3x', logs.output[0])
+        self.assertIn('blogs_published_view', logs.output[0])
+
+
+    def test_raise_and_sampling(self):
+        with override_settings(NPLUSONE_RAISE=True), self.assertRaises(RepeatedQueriesError):
+            QueryPatternMiddleware(blogs_published_view)(self.request)
+
+        with override_settings(NPLUSONE_SAMPLE_RATE=0), self.assertNoLogs('backend.middleware', 'WARNING'):
+            QueryPatternMiddleware(blogs_published_view)(self.request)
+
+
+    def test_raise_setting_parsing(self):
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Blogzilla', 'settings.py')
+
+        def parse(value):
+            spec = importlib.util.spec_from_file_location('settings_of_test', path)
+            module = importlib.util.module_from_spec(spec)
+            with mock.patch.dict(os.environ, {'NPLUSONE_RAISE': value}):
+                spec.loader.exec_module(module)
+            return module.NPLUSONE_RAISE
+
+        self.assertEqual([parse(value) for value in ('1', 'true', 'Yes', 'on')], [True] * 4)
+        self.assertEqual([parse(value) for value in ('', '0', 'false', 'no', 'off')], [False] * 5)
+
+
+
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0, METRICS_ENABLED=True, METRICS_DIR='', METRICS_TOKEN='secret')
+class MetricsTests(TestCase):
+
+    #value of a series of an instrument of this process
+    def value(self, metric, *labels):
+        return metric.read().get(labels, 0)
+
+
+    def test_requests_are_recorded_per_route(self):
+        user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+        route = 'api/auth/login/'
+        before = (self.value(metrics.http_requests, route, 'POST', '401'), self.value(metrics.auth_events, 'login', 'rejected'))
+        observed = self.value(metrics.http_latency, route, 'POST') or [[0], 0]
+
+        response = APIClient().post('/api/auth/login/', {'email': user.email, 'password': 'wrong'}, format='json')
+
+        self.assertEqual(response.status_code, 401)
+        after = (self.value(metrics.http_requests, route, 'POST', '401'), self.value(metrics.auth_events, 'login', 'rejected'))
+        self.assertEqual(after, (before[0] + 1, before[1] + 1))
+        self.assertEqual(sum(self.value(metrics.http_latency, route, 'POST')[0]), sum(observed[0]) + 1)
+
+
+    def test_content_is_counted_on_commit(self):
+        before = self.value(metrics.content_created, 'blog')
+        with self.captureOnCommitCallbacks(execute=True), mute_image_variants():
+            user = User.objects.create_user(email='author@blogzilla.com', password='password')
+            Blog.objects.create(user=user, title='title', content='content', header_img='blog.png')
+            self.assertEqual(self.value(metrics.content_created, 'blog'), before)
+
+        self.assertEqual(self.value(metrics.content_created, 'blog'), before + 1)
+
+
+    def test_exposition_sums_processes(self):
+        #pid of a process which exited
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+
+        dead = {'pid': process.pid, 'metrics': {
+            'blogzilla_content_created_total': {'type': 'counter', 'help': 'h', 'labels': ['kind'], 'values': [[['reply'], 1000]]},
+            'blogzilla_email_queue': {'type': 'gauge', 'help': 'h', 'labels': ['stat'], 'values': [[['queue_size'], 1000]]},
+        }}
+        replies = self.value(metrics.content_created, 'reply')
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            with open(os.path.join(directory, f"{process.pid}-1.json"), 'w') as file:
+                json.dump({**dead, 'started': 1}, file)
+
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertTrue(os.path.exists(metrics.registry.path(metrics.registry.name)))
+
+            #the dead process' counts are folded into the exited file, and still counted by the next scrapes
+            self.assertEqual(sorted(os.listdir(directory)), sorted(['exited.json', f"{metrics.registry.name}.json"]))
+            again = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').content.decode()
+            self.assertIn(f'blogzilla_content_created_total{{kind="reply"}} {replies + 1000}', again)
+
+        text = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'blogzilla_content_created_total{{kind="reply"}} {replies + 1000}', text)
+        self.assertIn('blogzilla_email_queue{stat="queue_size"} 0', text)
+        self.assertIn('blogzilla_http_request_duration_seconds_bucket{route="metrics",method="GET",le="+Inf"}', text)
+        self.assertIn('blogzilla_email_outbox{status="pending"} 0', text)
+
+
+    def test_reused_pid_is_not_alive(self):
+        #a snapshot of an exited process whose pid is now this process'
+        old = {'pid': os.getpid(), 'started': metrics.process_started(os.getpid()) - 1, 'metrics': {
+            'blogzilla_content_created_total': {'type': 'counter', 'help': 'h', 'labels': ['kind'], 'values': [[['reply'], 1000]]},
+            'blogzilla_email_queue': {'type': 'gauge', 'help': 'h', 'labels': ['stat'], 'values': [[['queue_size'], 1000]]},
+        }}
+        replies = self.value(metrics.content_created, 'reply')
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            with open(os.path.join(directory, f"{os.getpid()}-{old['started']}.json"), 'w') as file:
+                json.dump(old, file)
+
+            merged = metrics.registry.aggregate()
+            self.assertFalse(os.path.exists(os.path.join(directory, f"{os.getpid()}-{old['started']}.json")))
+
+        self.assertEqual(merged['blogzilla_content_created_total']['values'][('reply',)], replies + 1000)
+        self.assertEqual(merged['blogzilla_email_queue']['values'][('queue_size',)], 0)
+
+
+    def test_interrupted_fold_is_not_counted_twice(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            counter = {'blogzilla_content_created_total': {'type': 'counter', 'help': 'h', 'labels': ['kind'], 'values': [[['reply'], 1000]]}}
+            #folded, but the folding process died before deleting the snapshot
+            for name, snapshot in (('1-1', {'pid': 1, 'started': 1, 'metrics': counter}), ('exited', {'folded': ['1-1'], 'metrics': counter})):
+                with open(os.path.join(directory, f"{name}.json"), 'w') as file:
+                    json.dump(snapshot, file)
+
+            replies = self.value(metrics.content_created, 'reply')
+            counts = [metrics.registry.aggregate()['blogzilla_content_created_total']['values'][('reply',)] for i in range(2)]
+
+            self.assertEqual(counts, [replies + 1000] * 2)
+            self.assertFalse(os.path.exists(os.path.join(directory, '1-1.json')))
+
+
+    def test_unreadable_snapshots_are_skipped(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            with open(os.path.join(directory, '1.json'), 'w') as file:
+                file.write('{"pid": 1, "metr')
+            os.mkdir(os.path.join(directory, '2.json'))
+
+            with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+                snapshots = metrics.registry.snapshots()
+
+        #this process and the exited ones, none yet
+        self.assertEqual([(snapshot['pid'], snapshot['metrics'] if snapshot['pid'] is None else None) for snapshot in snapshots], [(os.getpid(), None), (None, {})])
+        self.assertEqual(stdout.getvalue(), '')
+
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        #the origin doesn't matter, behind a proxy every request is local
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        #without a token the endpoint doesn't exist
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 404)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+
+
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class AuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+
+    #tokens as issued at login, iat seconds ago
+    def get_tokens(self, age=0):
+        refresh = MyTokenObtainPairSerializer.get_token(self.user)
+        access = refresh.access_token
+        if age:
+            refresh['iat'] = access['iat'] = int(timezone.now().timestamp()) - age
+        return str(access), str(refresh)
+
+    def get(self, access):
+        return APIClient().get('/api/user/blog/', HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def refresh(self, refresh):
+        return APIClient().post('/api/auth/token/', {'refresh': refresh}, format='json')
+
+
+    def test_token_of_active_user(self):
+        access, refresh = self.get_tokens()
+        self.assertEqual(self.get(access).status_code, 200)
+
+
+    def test_deactivated_user_is_rejected(self):
+        access, refresh = self.get_tokens()
+        self.assertEqual(self.get(access).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+
+        response = self.get(access)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['code'], 'user_inactive')
+
+
+    def test_deleted_user_is_rejected(self):
+        access, refresh = self.get_tokens()
+        self.assertEqual(self.get(access).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+
+        self.assertEqual(self.get(access).status_code, 401)
+        self.assertEqual(self.refresh(refresh).status_code, 401)
+
+
+    def test_logged_out_everywhere_user_is_rejected(self):
+        access, refresh = self.get_tokens(age=10)
+        self.assertEqual(self.get(access).status_code, 200)
+
+        self.user.logout_everywhere()
+        self.assertEqual(self.get(access).status_code, 401)
+
+
+    def test_logout_everywhere_revokes_the_tokens_issued_before(self):
+        access, refresh = self.get_tokens(age=10)
+        response = APIClient().post('/api/auth/logout-everywhere/', HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(response.status_code, 200)
+
+        #from the cached logout time, then from the last_logout column once the cache is lost
+        for clear in (False, True):
+            if clear:
+                cache.clear()
+            self.assertEqual(self.get(access).status_code, 401)
+            self.assertEqual(self.refresh(refresh).status_code, 401)
+
+        new_access, new_refresh = self.get_tokens()
+        self.assertEqual(self.get(new_access).status_code, 200)
+        response = self.refresh(new_refresh)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(response.json()['access']).status_code, 200)
+
+
+
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class CounterMigrationTests(TestCase):
+
+    def test_comment_liked_before_the_recount_reports_its_likes(self):
+        with self.captureOnCommitCallbacks(execute=True), mute_image_variants():
+            user = User.objects.create_user(email='author@blogzilla.com', password='password')
+            blog = Blog.objects.create(user=user, title='title', content='content', header_img='blog.png', published=True)
+            comment = BlogComments.objects.create(user=user, blog=blog, comment='comment')
+            reply = ReplyComments.objects.create(user=user, parent_blog_comment=comment, comment='reply')
+            LikeComments.objects.create(user=user, parent_blog_comment=comment)
+            LikeComments.objects.create(user=user, parent_reply_comment=reply)
+
+        #counters as the old like signal left them
+        BlogComments.objects.update(likes_no=0, comments_no=0)
+        ReplyComments.objects.update(likes_no=0)
+
+        migration = importlib.import_module('backend.migrations.0011_recount_comment_counters')
+        migration.recount_comment_counters(apps, None)
+
+        comments = APIClient().get(f'/api/blog/{blog.uuid}/comments/').json()['results']
+        self.assertEqual((comments[0]['likes_no'], comments[0]['comments_no']), (1, 1))
+        replies = APIClient().get(f'/api/blog/comments/{comment.uuid}/reply/').json()['results']
+        self.assertEqual(replies[0]['likes_no'], 1)
+
+
+
+#write transactions contending with a second connection holding the write lock of the test database
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0, DB_WRITE_RETRY_DELAY=0.01, DB_WRITE_RETRY_MAX_DELAY=0.05, DB_WRITE_MAX_WAIT=0.3)
+class WriteTransactionTests(TransactionTestCase):
+
+    def setUp(self):
+        connection.ensure_connection()
+        params = connection.get_connection_params()
+        self.other = sqlite3.connect(params['database'], uri=params.get('uri', False), isolation_level=None, check_same_thread=False)
+        self.before = lock_stats.stats()
+
+    def tearDown(self):
+        if self.other.in_transaction:
+            self.other.execute("ROLLBACK")
+        self.other.close()
+
+    def stat(self, name):
+        return lock_stats.stats()[name] - self.before[name]
+
+    def create_user(self):
+        return User.objects.create_user(email='author@blogzilla.com', password='password')
+
+
+    def test_gives_up_after_max_wait(self):
+        self.other.execute("BEGIN IMMEDIATE")
+
+        start = time.monotonic()
+        with self.assertRaises(OperationalError):
+            write_transaction(self.create_user)()
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.stat('failed'), 1)
+        self.assertGreater(self.stat('retries'), 0)
+        self.other.execute("ROLLBACK")
+        self.assertFalse(User.objects.exists())
+
+
+    def test_retries_until_the_lock_is_released(self):
+        self.other.execute("BEGIN IMMEDIATE")
+        release = threading.Timer(0.1, self.other.execute, ("ROLLBACK",))
+        release.start()
+
+        user = write_transaction(self.create_user)()
+        release.join()
+
+        self.assertTrue(User.objects.filter(pk=user.pk).exists())
+        self.assertEqual((self.stat('transactions'), self.stat('contended'), self.stat('failed')), (1, 1, 0))
+        self.assertGreater(self.stat('wait_seconds'), 0)
+
+
+    def test_backoff_doubles_up_to_the_max_delay(self):
+        errors = iter([OperationalError('database is locked')] * 4)
+
+        def write():
+            error = next(errors, None)
+            if error is not None:
+                raise error
+            return 'done'
+
+        with mock.patch('backend.db.transaction.time.sleep') as sleep, \
+                mock.patch('backend.db.transaction.random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual(write_transaction(write)(), 'done')
+
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.01, 0.02, 0.04, 0.05])
+        self.assertEqual(self.stat('retries'), 4)
+
+
+    def test_busy_timeout_is_cut_to_the_time_left(self):
+        self.other.execute("BEGIN IMMEDIATE")
+
+        with mock.patch.object(connection, 'limit_busy_timeout', wraps=connection.limit_busy_timeout) as limit:
+            with self.assertRaises(OperationalError):
+                write_transaction(self.create_user)()
+
+        #one limit per attempt, shrinking to the deadline, then the timeout of SQLITE_PRAGMAS is restored
+        left = [call.args[0] for call in limit.call_args_list[:-1]]
+        self.assertEqual(len(left), self.stat('retries') + 1)
+        self.assertLessEqual(left[0], 0.3)
+        self.assertEqual(left, sorted(left, reverse=True))
+        self.assertEqual(limit.call_args_list[-1].args, ())
+        self.assertEqual(connection.busy_timeout, settings.SQLITE_PRAGMAS['busy_timeout'])
+
+
+    def test_other_errors_are_not_retried(self):
+        write = mock.Mock(side_effect=OperationalError('no such table: missing'))
+
+        with self.assertRaises(OperationalError):
+            write_transaction(write)()
+
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(self.stat('retries'), 0)
+
+
+    def test_passwords_are_hashed_outside_the_write_transaction(self):
+        in_transaction = []
+        def hash(*args, **kwargs):
+            in_transaction.append(connection.in_atomic_block)
+            return hashers.make_password(*args, **kwargs)
+
+        with mock.patch('django.contrib.auth.base_user.make_password', side_effect=hash):
+            response = APIClient().post('/api/auth/signup/', {'email': 'author@blogzilla.com', 'password': 'password'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        User.objects.filter(email='author@blogzilla.com').update(is_verified=True)
+        with mock.patch.object(User, 'check_password', autospec=True, side_effect=lambda user, password: in_transaction.append(connection.in_atomic_block) or True):
+            response = APIClient().post('/api/auth/login/', {'email': 'author@blogzilla.com', 'password': 'password'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(in_transaction, [False, False])
+
+
+
+#content addressed media storage and collect_media, on a temporary MEDIA_ROOT
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class MediaStorageTests(TestCase):
+
+    def setUp(self):
+        use_temp_media(self)
+        self.user = User.objects.create_user(email='author@blogzilla.com', password='password')
+
+    #a blob last modified a day ago
+    def save(self, name, content=b'image'):
+        name = default_storage.save(name, ContentFile(content))
+        os.utime(default_storage.path(name), (time.time() - 24*60*60,) * 2)
+        return name
+
+    def collect(self):
+        call_command('collect_media', stdout=StringIO())
+
+
+    def test_same_content_is_stored_once(self):
+        name = self.save('blog_header_img/first.PNG')
+        self.assertRegex(name, r'^blog_header_img/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+
+        self.assertEqual(default_storage.save('blog_header_img/second.png', ContentFile(b'image')), name)
+        self.assertNotEqual(default_storage.save('blog_header_img/third.png', ContentFile(b'other image')), name)
+
+        directory = os.path.dirname(default_storage.path(name))
+        self.assertEqual(os.listdir(directory), [os.path.basename(name)])
+        #saved again, the blob is as new as the upload using it
+        self.assertGreater(os.path.getmtime(default_storage.path(name)), time.time() - 60)
+
+
+    def test_unreferenced_old_blobs_are_collected(self):
+        header = self.save('blog_header_img/header.png', b'header')
+        variant = self.save('blog_header_img/variants/header-thumb.webp', b'variant')
+        orphan = self.save('blog_header_img/orphan.png', b'orphan')
+        young = default_storage.save('blog_header_img/young.png', ContentFile(b'young'))
+        Blog.objects.create(
+            user=self.user, title='title', content='content', header_img=header,
+            header_img_variants={'src': header, 'thumb': {'width': 1, 'height': 1, 'webp': variant}},
+        )
+
+        self.collect()
+
+        self.assertFalse(default_storage.exists(orphan))
+        for name in (header, variant, young):
+            self.assertTrue(default_storage.exists(name))
+
+
+    def test_blob_referenced_during_collection_is_kept(self):
+        header = self.save('blog_header_img/header.png', b'header')
+        variant = self.save('blog_header_img/variants/header-thumb.webp', b'variant')
+
+        #the rows are committed after the references were counted
+        def count_references(command):
+            references = collections.Counter()
+            Blog.objects.create(
+                user=self.user, title='title', content='content', header_img=header,
+                header_img_variants={'src': header, 'thumb': {'width': 1, 'height': 1, 'webp': variant}},
+            )
+            return references
+
+        with mock.patch('backend.management.commands.collect_media.Command.count_references', count_references):
+            self.collect()
+
+        self.assertTrue(default_storage.exists(header))
+        self.assertTrue(default_storage.exists(variant))
+
+
+
+#images are validated by ImageUploadHandler while the request body is streamed
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class ImageUploadTests(TestCase):
+
+    def setUp(self):
+        use_temp_media(self)
+        self.user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {MyTokenObtainPairSerializer.get_token(self.user).access_token}')
+
+    def upload(self, header_img):
+        with mock.patch.object(ImageUploadHandler, 'reject', autospec=True, side_effect=ImageUploadHandler.reject) as self.reject:
+            return self.client.post('/api/blog/', {'title': 'title', 'content': 'content', 'tags': ['tag'], 'header_img': header_img})
+
+    #aborted by the upload handler, not by the validation of the serializer
+    def assertRejected(self, response, message):
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['header_img'], [message])
+        self.assertEqual(self.reject.call_count, 1)
+        self.assertFalse(Blog.objects.exists())
+
+
+    def test_image_is_accepted(self):
+        response = self.upload(image_file())
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(self.reject.called)
+        self.assertTrue(default_storage.exists(Blog.objects.get().header_img.name))
+
+
+    def test_oversized_file_is_rejected(self):
+        content = image_bytes() + bytes(IMG_MAX_SIZE)
+        #the rest of the body is drained, without being kept, so that the 400 reaches the client
+        with mock.patch('django.http.multipartparser.exhaust', wraps=multipartparser.exhaust) as exhaust:
+            response = self.upload(SimpleUploadedFile('header.png', content, content_type='image/png'))
+        self.assertRejected(response, f'Image size should be less than {IMG_MAX_SIZE/(1024*1024)} MB.')
+        self.assertTrue(exhaust.called)
+
+
+    def test_non_image_renamed_to_png_is_rejected(self):
+        response = self.upload(SimpleUploadedFile('header.png', b'<html>not an image</html>' * 100, content_type='image/png'))
+        self.assertRejected(response, 'Only jpg, jpeg, png files are allowed.')
+
+
+    def test_decompression_bomb_is_rejected(self):
+        #a small png whose header declares 100000x100000 pixels
+        content = bytearray(image_bytes(size=(1, 1)))
+        ihdr = bytes(content[12:16]) + (100000).to_bytes(4, 'big') * 2 + bytes(content[24:29])
+        content[12:33] = ihdr + zlib.crc32(ihdr).to_bytes(4, 'big')
+
+        response = self.upload(SimpleUploadedFile('header.png', bytes(content), content_type='image/png'))
+        self.assertRejected(response, 'Image dimensions are too large.')
+
+
+
+#media files served by backend.views.serve_media
+@override_settings(MEDIA_CACHE_MAX_AGE=3600, MEDIA_SENDFILE='', MEDIA_SENDFILE_PREFIX='/protected-media/')
+class ServeMediaTests(TestCase):
+
+    def setUp(self):
+        self.root = use_temp_media(self)
+        self.content = b'0123456789'
+        self.name = default_storage.save('blog_header_img/header.png', ContentFile(self.content))
+        self.url = f'/media/{self.name}'
+        self.etag = f'"{os.path.splitext(os.path.basename(self.name))[0]}"'
+
+    def get(self, url=None, **headers):
+        response = self.client.get(url or self.url, **headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+
+    def test_full_file(self):
+        response, content = self.get()
+        self.assertEqual((response.status_code, content), (200, self.content))
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+
+    def test_file_without_content_hashed_name(self):
+        with open(os.path.join(self.root, 'blog_header_img', 'plain.png'), 'wb') as file:
+            file.write(self.content)
+
+        response, content = self.get('/media/blog_header_img/plain.png')
+        self.assertEqual((response.status_code, content), (200, self.content))
+        self.assertRegex(response['ETag'], r'^"\d+-10"$')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+
+
+    def test_missing_file(self):
+        self.assertEqual(self.client.get('/media/blog_header_img/missing.png').status_code, 404)
+        self.assertEqual(self.client.get('/media/blog_header_img').status_code, 404)
+        #safe_join raises SuspiciousFileOperation for paths out of MEDIA_ROOT
+        self.assertEqual(self.client.get('/media/blog_header_img/%2E%2E/%2E%2E/manage.py').status_code, 400)
+
+
+    def test_partial_requests(self):
+        for header, expected, content_range in (
+            ('bytes=2-5', b'2345', 'bytes 2-5/10'),
+            ('bytes=7-', b'789', 'bytes 7-9/10'),
+            ('bytes=-3', b'789', 'bytes 7-9/10'),
+            ('bytes=8-100', b'89', 'bytes 8-9/10'),
+        ):
+            response, content = self.get(HTTP_RANGE=header)
+            self.assertEqual((response.status_code, content), (206, expected), header)
+            self.assertEqual(response['Content-Range'], content_range)
+            self.assertEqual(response['Content-Length'], str(len(expected)))
+
+        #several ranges and invalid ranges are answered with the whole file
+        for header in ('bytes=0-1,4-5', 'bytes=5-2'):
+            response, content = self.get(HTTP_RANGE=header)
+            self.assertEqual((response.status_code, content), (200, self.content), header)
+
+
+    def test_unsatisfiable_range(self):
+        response, content = self.get(HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+
+    def test_if_range(self):
+        response, content = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=self.etag)
+        self.assertEqual((response.status_code, content), (206, b'2345'))
+
+        response, content = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=response['Last-Modified'])
+        self.assertEqual((response.status_code, content), (206, b'2345'))
+
+        #the file changed, the whole new file is served
+        for if_range in ('"outdated"', f'W/{self.etag}', 'Thu, 01 Jan 1970 00:00:00 GMT'):
+            response, content = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=if_range)
+            self.assertEqual((response.status_code, content), (200, self.content), if_range)
+
+
+    def test_conditional_requests(self):
+        for if_none_match in (self.etag, f'W/{self.etag}', f'"other", {self.etag}', '*'):
+            response, content = self.get(HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual((response.status_code, content), (304, b''), if_none_match)
+            self.assertEqual(response['ETag'], self.etag)
+
+        response, content = self.get(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+        last_modified = self.get()[0]['Last-Modified']
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=last_modified)[0].status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:00:00 GMT')[0].status_code, 200)
+        #If-None-Match takes precedence
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=last_modified)[0].status_code, 200)
+
+
+    def test_sendfile(self):
+        with override_settings(MEDIA_SENDFILE='x-accel-redirect'):
+            response, content = self.get(HTTP_RANGE='bytes=2-5')
+            self.assertEqual((response.status_code, content), (200, b''))
+            self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.name}')
+            self.assertEqual(response['ETag'], self.etag)
+
+            #the path is sent url encoded, nginx decodes it
+            with open(os.path.join(default_storage.location, 'blog_header_img', 'my header?%.png'), 'wb') as file:
+                file.write(self.content)
+            response, content = self.get('/media/blog_header_img/my%20header%3F%25.png')
+            self.assertEqual(response['X-Accel-Redirect'], '/protected-media/blog_header_img/my%20header%3F%25.png')
+
+        with override_settings(MEDIA_SENDFILE='x-sendfile'):
+            response, content = self.get()
+            self.assertEqual((response.status_code, content), (200, b''))
+            self.assertEqual(response['X-Sendfile'], default_storage.path(self.name))
+
+
+
+#variants of uploaded images, rendered by backend.images
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0, IMAGE_VARIANTS={'thumb': 320, 'medium': 960}, IMAGE_QUALITY=80)
+class ImageVariantsTests(TestCase):
+
+    def setUp(self):
+        use_temp_media(self)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+
+    #a published blog whose header image is rendered once the transaction commits
+    def create_blog(self, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Blog.objects.create(
+                user=self.user, title='title', content='content', published=True,
+                header_img=default_storage.save('blog_header_img/header.png', ContentFile(content)),
+            )
+
+    def open(self, name):
+        with default_storage.open(name) as file:
+            image = Image.open(file)
+            image.load()
+        return image
+
+
+    def test_variants_are_rendered(self):
+        blog = self.create_blog(image_bytes(size=(1200, 600), format='JPEG'))
+        blog.refresh_from_db()
+
+        variants = blog.header_img_variants
+        self.assertEqual(variants['src'], blog.header_img.name)
+        self.assertEqual((blog.header_img_width, blog.header_img_height), (1200, 600))
+
+        for label, size in (('thumb', (320, 160)), ('medium', (960, 480))):
+            self.assertEqual((variants[label]['width'], variants[label]['height']), size)
+            self.assertEqual(set(variants[label]), {'width', 'height', 'webp', 'jpeg'})
+            for ext, format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                self.assertTrue(variants[label][ext].startswith('blog_header_img/variants/'))
+                image = self.open(variants[label][ext])
+                self.assertEqual((image.format, image.size), (format, size))
+
+
+    def test_small_and_transparent_images(self):
+        buffer = BytesIO()
+        Image.new('RGBA', (200, 100), (0, 0, 255, 128)).save(buffer, format='PNG')
+        blog = self.create_blog(buffer.getvalue())
+        blog.refresh_from_db()
+
+        #never upscaled, transparent images fall back to png
+        for label in ('thumb', 'medium'):
+            variant = blog.header_img_variants[label]
+            self.assertEqual((variant['width'], variant['height']), (200, 100))
+            self.assertEqual(set(variant), {'width', 'height', 'webp', 'png'})
+            image = self.open(variant['png'])
+            self.assertEqual((image.format, image.mode), ('PNG', 'RGBA'))
+
+        #both sizes hold the same bytes, so the same blob
+        self.assertEqual(blog.header_img_variants['thumb']['webp'], blog.header_img_variants['medium']['webp'])
+
+
+    def test_original_is_served_when_rendering_fails(self):
+        before = image_pool.stats()['failed']
+        with mock.patch('backend.images.open_image', side_effect=OSError("cannot identify image file")), \
+                self.assertLogs('backend.images', 'WARNING') as logs:
+            blog = self.create_blog(image_bytes())
+
+        self.assertIn(f'variants of backend.Blog {blog.pk} header_img not rendered', logs.output[0])
+
+        self.assertEqual(image_pool.stats()['failed'], before + 1)
+        blog.refresh_from_db()
+        self.assertEqual(blog.header_img_variants, {})
+
+        response = APIClient().get(f'/api/blog/{blog.uuid}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['header_img_variants'], {})
+        self.assertTrue(response.json()['header_img'].endswith(blog.header_img.url))
+        self.assertEqual(self.client.get(blog.header_img.url).status_code, 200)
+
+
+
+#placeholders of images: blurhash and dominant color, see https://github.com/woltapp/blurhash for the format
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class ImagePlaceholderTests(TestCase):
+
+    #blurhash of an image of the color (200, 30, 60)
+    SOLID_BLURHASH = 'L5M^#R|yfQ|y|yo1fQo1fQfQfQfQ'
+
+    def test_blurhash_of_a_solid_color(self):
+        #4x3 components ('L') and the color as DC ('M^#R'). Sampled on 32 pixels the odd cosines don't sum to 0, so the odd
+        #components keep a small value like with the reference encoder, the even ones are 0 ('fQ')
+        image = Image.new('RGB', (120, 80), (200, 30, 60))
+        self.assertEqual(blurhash(image), self.SOLID_BLURHASH)
+
+
+    def test_blurhash_of_a_vertical_edge(self):
+        #32x32, the size the image is sampled at
+        image = Image.new('RGB', (32, 32), (0, 0, 0))
+        image.paste((255, 255, 255), (16, 0, 32, 32))
+        hash = blurhash(image)
+
+        self.assertEqual(len(hash), 28)
+        #the average of black and white in linear light, #bcbcbc
+        self.assertEqual(hash[2:6], 'Lqe9')
+        #the first horizontal component holds the edge, the vertical even one is 0 as the picture doesn't change vertically
+        self.assertNotEqual(hash[6:8], 'fQ')
+        self.assertEqual(hash[20:], 'fQ' * 4)
+
+
+    def test_dominant_color(self):
+        self.assertEqual(dominant_color(Image.new('RGB', (50, 50), (200, 30, 60))), '#c81e3c')
+
+        image = Image.new('RGB', (100, 100), (20, 120, 220))
+        image.paste((250, 200, 10), (0, 0, 100, 30))
+        self.assertEqual(dominant_color(image), '#1478dc')
+
+
+    def test_dimensions_and_placeholders_are_stored(self):
+        use_temp_media(self)
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            blog = Blog.objects.create(
+                user=user, title='title', content='content', published=True,
+                header_img=default_storage.save('blog_header_img/header.png', ContentFile(image_bytes(size=(120, 80)))),
+            )
+
+        data = APIClient().get(f'/api/blog/{blog.uuid}').json()
+        self.assertEqual((data['header_img_width'], data['header_img_height']), (120, 80))
+        self.assertEqual(data['header_img_color'], '#c81e3c')
+        self.assertEqual(data['header_img_blurhash'], self.SOLID_BLURHASH)
+
+
+
+#sliding window throttle at 3 requests a minute, on a fake clock
+class SlidingWindowThrottleTests(SimpleTestCase):
+
+    class Throttle(AnonSlidingRateThrottle):
+        rate = '3/min'
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.1')
+        self.request.user = AnonymousUser()
+
+    def allow(self, now):
+        throttle = self.Throttle()
+        throttle.timer = lambda: now
+        return throttle.allow_request(self.request, None), throttle
+
+
+    def test_requests_over_the_rate_are_denied(self):
+        self.assertEqual([self.allow(1 + i)[0] for i in range(4)], [True, True, True, False])
+
+        allowed, throttle = self.allow(10)
+        self.assertFalse(allowed)
+        self.assertEqual(throttle.wait(), 50)
+        #another client isn't throttled
+        self.request.META['REMOTE_ADDR'] = '10.0.0.2'
+        self.assertTrue(self.allow(10)[0])
+
+
+    def test_window_boundary(self):
+        self.assertEqual([self.allow(59)[0] for i in range(3)], [True, True, True])
+
+        #the previous window still counts fully at the start of the next one, and fades out over it
+        self.assertFalse(self.allow(60)[0])
+        self.assertFalse(self.allow(75)[0])
+        self.assertTrue(self.allow(100)[0])
+        #two windows later none of them count anymore
+        self.assertEqual([self.allow(180)[0] for i in range(4)], [True, True, True, False])
+
+
+    def test_denied_requests_are_not_counted(self):
+        #a client retrying every second for 3 minutes
+        allowed = collections.Counter()
+        for now in range(180):
+            if self.allow(now)[0]:
+                allowed[now // 60] += 1
+
+        self.assertEqual(allowed[0], 3)
+        self.assertGreater(allowed[1], 0)
+        self.assertGreater(allowed[2], 0)
+        #never more than 3 over a whole minute
+        self.assertLessEqual(allowed[1] + allowed[2], 6)
+
+
+
+#published_at of blogs and the new posts digests based on it
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', EMAIL_WORKERS=0, IMAGE_WORKERS=0,
+                   DIGEST_INTERVAL=24*60*60, DIGEST_LOOKBACK=7*24*60*60, DIGEST_CHUNK_SIZE=1)
+class DigestTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True)
+            self.follower = User.objects.create_user(email='follower@blogzilla.com', password='password', is_verified=True, first_name='Ada')
+            self.unverified = User.objects.create_user(email='unverified@blogzilla.com', password='password')
+            self.author.user_profile.followers.add(self.follower, self.unverified)
+        mail.outbox = []
+
+    def create_blog(self, title, **kwargs):
+        with mute_image_variants():
+            return Blog.objects.create(user=self.author, title=title, content='content', header_img='blog.png', **kwargs)
+
+    def send_digests(self):
+        mail.outbox = []
+        call_command('send_digests', stdout=StringIO())
+        return {message.to[0]: message.body for message in mail.outbox}
+
+
+    def test_published_at_is_set_on_every_path(self):
+        draft = self.create_blog('draft')
+        self.assertIsNone(draft.published_at)
+
+        draft.published = True
+        draft.save(update_fields=['published'])
+        draft.refresh_from_db()
+        self.assertIsNotNone(draft.published_at)
+
+        first_published = draft.published_at
+        Blog.objects.filter(pk=draft.pk).update(published=False)
+        Blog.objects.filter(pk=draft.pk).update(published=True)
+        draft.refresh_from_db()
+        #the first publication is kept
+        self.assertEqual(draft.published_at, first_published)
+
+        updated, bulk_updated = self.create_blog('updated'), self.create_blog('bulk updated')
+        Blog.objects.filter(pk=updated.pk).update(published=True)
+        bulk_updated.published = True
+        Blog.objects.bulk_update([bulk_updated], ['published'])
+
+        for blog in (updated, bulk_updated):
+            blog.refresh_from_db()
+            self.assertIsNotNone(blog.published_at)
+
+
+    def test_digest_of_new_posts(self):
+        self.create_blog('new post', published=True)
+        self.create_blog('draft')
+        self.create_blog('old post', published=True, published_at=timezone.now() - timezone.timedelta(days=8))
+
+        digests = self.send_digests()
+        self.assertEqual(list(digests), ['follower@blogzilla.com'])
+        self.assertIn('Hello Ada.', digests['follower@blogzilla.com'])
+        self.assertIn('- new post', digests['follower@blogzilla.com'])
+        self.assertNotIn('draft', digests['follower@blogzilla.com'])
+        self.assertNotIn('old post', digests['follower@blogzilla.com'])
+
+        #one digest per DIGEST_INTERVAL
+        self.create_blog('newer post', published=True)
+        self.assertEqual(self.send_digests(), {})
+
+        #the next one only has the posts published since the last one
+        UserProfile.objects.filter(user=self.follower).update(last_digest_at=timezone.now() - timezone.timedelta(days=1, seconds=1))
+        Blog.objects.filter(title='new post').update(published_at=timezone.now() - timezone.timedelta(days=2))
+        digest = self.send_digests()['follower@blogzilla.com']
+        self.assertIn('- newer post', digest)
+        self.assertNotIn('- new post', digest)
+
+
+    def test_blog_published_by_update_is_in_the_digest(self):
+        blog = self.create_blog('published later')
+        Blog.objects.filter(pk=blog.pk).update(published=True)
+
+        self.assertIn('- published later', self.send_digests()['follower@blogzilla.com'])
+        self.assertEqual(EmailOutbox.objects.filter(subject="New posts from authors you follow", status='sent').count(), 1)
+
+
+
+#compact_tokens deleting expired tokens of the simplejwt blacklist app
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class CompactTokensTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user(email='author@blogzilla.com', password='password')
+        now = timezone.now()
+
+        #3 expired tokens and 2 live ones, 2 and 1 of them blacklisted
+        self.expired, self.live = [], []
+        for i, expires_at in enumerate([now - timezone.timedelta(days=1)] * 3 + [now + timezone.timedelta(days=1)] * 2):
+            token = OutstandingToken.objects.create(user=user, jti=f'jti-{i}', token=f'token-{i}', expires_at=expires_at)
+            (self.expired if expires_at < now else self.live).append(token.pk)
+        for pk in (self.expired[0], self.expired[1], self.live[0]):
+            BlacklistedToken.objects.create(token_id=pk)
+
+    def compact(self, *args):
+        output = StringIO()
+        call_command('compact_tokens', '--pause=0', *args, stdout=output)
+        return output.getvalue()
+
+
+    def test_expired_tokens_are_deleted(self):
+        output = self.compact('--batch-size=2')
+
+        self.assertIn('deleted 3 expired tokens in 2 batches', output)
+        self.assertEqual(sorted(OutstandingToken.objects.values_list('pk', flat=True)), self.live)
+        self.assertEqual(list(BlacklistedToken.objects.values_list('token_id', flat=True)), [self.live[0]])
+
+
+    def test_stats_and_max_batches(self):
+        self.assertIn('outstanding: 5, expired: 3, blacklisted: 3', self.compact('--stats'))
+        self.assertEqual(OutstandingToken.objects.count(), 5)
+
+        self.compact('--batch-size=2', '--max-batches=1')
+        self.assertEqual(OutstandingToken.objects.count(), 3)
+        self.assertIn('outstanding: 3, expired: 1', self.compact('--stats'))
+
+
+    @override_settings(EMAIL_OUTBOX_RETENTION=timezone.timedelta(days=7))
+    def test_old_sent_mails_are_deleted(self):
+        now = timezone.now()
+        mails = {}
+        for name, status, sent_at in [
+            ('old', 'sent', now - timezone.timedelta(days=8)),
+            ('older', 'sent', now - timezone.timedelta(days=30)),
+            ('recent', 'sent', now - timezone.timedelta(days=1)),
+            ('pending', 'pending', None),
+            ('failed', 'failed', None),
+        ]:
+            mails[name] = EmailOutbox.objects.create(to_email='reader@blogzilla.com', subject=name, message='', status=status, sent_at=sent_at).pk
+
+        output = self.compact('--batch-size=1')
+
+        self.assertIn('deleted 2 sent mails in 2 batches', output)
+        self.assertEqual(set(EmailOutbox.objects.filter(pk__in=mails.values()).values_list('subject', flat=True)), {'recent', 'pending', 'failed'})
+
+
+
+#login through MyTokenObtainPairSerializer
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class LoginTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user(email='author@blogzilla.com', password='password', is_verified=True, first_name='Ada')
+
+        self.failed = mock.Mock()
+        user_login_failed.connect(self.failed)
+        self.addCleanup(user_login_failed.disconnect, self.failed)
+
+    def login(self, email='author@blogzilla.com', password='password'):
+        return APIClient().post('/api/auth/login/', {'email': email, 'password': password}, format='json')
+
+    #rejected with the error of a wrong password, whatever the reason
+    def assertNoActiveAccount(self, response, email='author@blogzilla.com'):
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['detail'], MyTokenObtainPairSerializer.default_error_messages['no_active_account'])
+        self.assertFalse(OutstandingToken.objects.exists())
+        self.assertEqual(self.failed.call_count, 1)
+        self.assertEqual(self.failed.call_args.kwargs['credentials'], {'email': email})
+
+
+    def test_login(self):
+        response = self.login()
+        self.assertEqual(response.status_code, 200)
+
+        access = AccessToken(response.json()['access'])
+        self.assertEqual((access['email'], access['uuid'], access['first_name']), (self.user.email, str(self.user.uuid), 'Ada'))
+        self.assertTrue(access['is_verified'])
+        self.assertEqual(APIClient().get('/api/user/blog/', HTTP_AUTHORIZATION=f"Bearer {response.json()['access']}").status_code, 200)
+
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+        self.assertTrue(OutstandingToken.objects.filter(user=self.user, jti=RefreshToken(response.json()['refresh'])['jti']).exists())
+
+
+    def test_wrong_password(self):
+        self.assertNoActiveAccount(self.login(password='wrong password'))
+
+
+    def test_unknown_email(self):
+        #rejected without hashing the password
+        with mock.patch.object(User, 'check_password') as check_password:
+            response = self.login(email='nobody@blogzilla.com')
+        self.assertNoActiveAccount(response, email='nobody@blogzilla.com')
+        self.assertFalse(check_password.called)
+
+
+    def test_unverified_user(self):
+        User.objects.filter(pk=self.user.pk).update(is_verified=False)
+
+        #only told with the right password
+        self.assertNoActiveAccount(self.login(password='wrong password'))
+
+        response = self.login()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['email'], ['Email is not verified.'])
+        self.assertFalse(OutstandingToken.objects.exists())
+
+
+    def test_inactive_user(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertNoActiveAccount(self.login())
+
+
+
+#CommitBatch of real transactions, committed and rolled back
+@override_settings(EMAIL_WORKERS=0, IMAGE_WORKERS=0)
+class CommitBatchTests(TransactionTestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def record(self, items):
+        self.calls.append(items)
+
+
+    def test_items_are_batched_until_commit(self):
+        with transaction.atomic():
+            defer_call(self.record, 1)
+            defer_call(self.record, 2)
+            defer_call(self.record, 1)
+            self.assertEqual(self.calls, [])
+
+        self.assertEqual(self.calls, [[1, 2]])
+
+        #autocommit
+        defer_call(self.record, 3)
+        self.assertEqual(self.calls, [[1, 2], [3]])
+
+
+    def test_rolled_back_batch_is_not_reused(self):
+        try:
+            with transaction.atomic():
+                defer_call(self.record, 'rolled back')
+                raise ValueError
+        except ValueError:
+            pass
+
+        with transaction.atomic():
+            defer_call(self.record, 'committed')
+
+        self.assertEqual(self.calls, [['committed']])
+
+
+    def test_savepoints_have_their_own_batch(self):
+        with transaction.atomic():
+            defer_call(self.record, 'outer')
+            try:
+                with transaction.atomic():
+                    defer_call(self.record, 'rolled back')
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction.atomic():
+                defer_call(self.record, 'inner')
+            defer_call(self.record, 'outer again')
+
+        self.assertEqual(sorted(self.calls), [['inner'], ['outer', 'outer again']])
+
+
+
+#email and image worker pools of a forked process and on a full queue
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', EMAIL_WORKERS=1, EMAIL_QUEUE_SIZE=1,
+                   EMAIL_QUEUE_TIMEOUT=0.01, EMAIL_IDLE_TIMEOUT=1, IMAGE_WORKERS=0)
+class EmailWorkerPoolTests(TestCase):
+
+    def setUp(self):
+        self.pool = EmailWorkerPool()
+        self.addCleanup(self.pool.shutdown)
+
+
+    def test_pool_restarts_after_fork(self):
+        self.pool.start()
+        threads, queue = self.pool.threads, self.pool.queue
+        self.addCleanup(queue.put, None)
+        self.pool.sent = self.pool.failed = self.pool.sent_inline = 3
+
+        #the parent's threads don't exist in a forked child
+        with mock.patch('backend.utils.os.getpid', return_value=os.getpid() + 1):
+            self.assertEqual(self.pool.stats()['workers'], 0)
+            self.pool.start()
+            self.addCleanup(self.pool.queue.put, None)
+
+            self.assertIsNot(self.pool.queue, queue)
+            self.assertTrue(self.pool.threads[0].is_alive())
+            self.assertNotIn(self.pool.threads[0], threads)
+            self.assertEqual(self.pool.stats()['workers'], 1)
+            #the counts of the parent aren't reported again by the child
+            self.assertEqual([self.pool.stats()[stat] for stat in ('sent', 'failed', 'sent_inline')], [0, 0, 0])
+
+
+    @override_settings(IMAGE_WORKERS=1)
+    def test_image_pool_restarts_after_fork(self):
+        pool = ImageWorkerPool()
+        pool.start()
+        self.addCleanup(pool.executor.shutdown)
+        executor = pool.executor
+        pool.queued = pool.rendered = pool.failed = 3
+
+        with mock.patch('backend.images.os.getpid', return_value=os.getpid() + 1):
+            self.assertEqual(pool.stats()['workers'], 0)
+            pool.start()
+            self.addCleanup(pool.executor.shutdown)
+
+            self.assertIsNot(pool.executor, executor)
+            self.assertEqual(pool.stats(), {'workers': 1, 'queue_size': 0, 'rendered': 0, 'failed': 0, 'rendered_inline': 0})
+
+
+    def test_mail_is_sent_in_the_request_when_the_queue_is_full(self):
+        release = threading.Event()
+        deliver = self.pool.deliver
+
+        #the worker is stuck on its first batch
+        def stuck_deliver(outbox_ids, connection=None):
+            if threading.current_thread() is threading.main_thread():
+                return deliver(outbox_ids, connection)
+            release.wait(5)
+            return True
+
+        self.addCleanup(release.set)
+        with mock.patch.object(self.pool, 'deliver', side_effect=stuck_deliver):
+            self.pool.submit([-1])
+            while self.pool.queue.qsize():
+                time.sleep(0.01)
+            self.pool.submit([-2])
+
+            email = EmailOutbox.objects.create(to_email='user@blogzilla.com', subject='subject', message='message')
+            self.pool.submit([email.pk])
+
+            release.set()
+            self.pool.queue.join()
+
+        self.assertEqual(self.pool.stats()['sent_inline'], 1)
+        self.assertEqual([message.to for message in mail.outbox], [['user@blogzilla.com']])
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'sent')
+
+
+    @override_settings(IMAGE_WORKERS=1, IMAGE_QUEUE_SIZE=1, IMAGE_QUEUE_TIMEOUT=0.01)
+    def test_image_is_rendered_in_the_request_when_the_queue_is_full(self):
+        pool = ImageWorkerPool()
+        self.addCleanup(pool.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        rendered = []
+
+        #the worker is stuck on the first image
+        def generate_variants(*job):
+            in_request = threading.current_thread() is threading.main_thread()
+            if not in_request:
+                release.wait(5)
+            rendered.append((job[1], in_request))
+
+        with mock.patch('backend.images.generate_variants', side_effect=generate_variants):
+            pool.submit([('backend.Blog', 1, 'header_img'), ('backend.Blog', 2, 'header_img')])
+            release.set()
+            pool.shutdown()
+
+        self.assertEqual(rendered, [(2, True), (1, False)])
+        self.assertEqual([pool.stats()[stat] for stat in ('queue_size', 'rendered', 'rendered_inline')], [0, 2, 1])
+
+
+
+#pragmas of SQLITE_PRAGMAS on the connections of backend.db.sqlite3
+@skipUnless(connection.vendor == 'sqlite', "sqlite pragmas")
+class SqlitePragmaTests(SimpleTestCase):
+
+    def test_pragmas_of_a_new_connection(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': os.path.join(directory, 'db.sqlite3')}, alias='pragmas')
+            try:
+                with wrapper.cursor() as cursor:
+                    values = {}
+                    for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'temp_store'):
+                        cursor.execute(f"PRAGMA {pragma}")
+                        values[pragma] = cursor.fetchone()[0]
+            finally:
+                wrapper.close()
+
+        #synchronous normal is 1, temp_store memory is 2
+        self.assertEqual(values, {
+            'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': settings.SQLITE_PRAGMAS['busy_timeout'], 'temp_store': 2,
+        })
+
+
+    def test_busy_timeout_limit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': os.path.join(directory, 'db.sqlite3')}, alias='pragmas')
+
+            def busy_timeout():
+                return wrapper.connection.execute("PRAGMA busy_timeout").fetchone()[0]
+
+            try:
+                wrapper.limit_busy_timeout(0.25)
+                self.assertEqual(busy_timeout(), 250)
+                #never raised over the configured timeout, nor under 0
+                wrapper.limit_busy_timeout(3600)
+                self.assertEqual(busy_timeout(), settings.SQLITE_PRAGMAS['busy_timeout'])
+                wrapper.limit_busy_timeout(-1)
+                self.assertEqual(busy_timeout(), 0)
+                wrapper.limit_busy_timeout()
+                self.assertEqual(busy_timeout(), settings.SQLITE_PRAGMAS['busy_timeout'])
+            finally:
+                wrapper.close()
@@ -1,16 +1,25 @@
-from django.db import models
+from django.db import models, transaction, close_old_connections
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.apps import apps
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.utils import timezone
 
 
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
+from backend.db.transaction import write_transaction
 from six import text_type
 
+import os
 import uuid
-from threading import Thread
+import atexit
+from collections import defaultdict
+from queue import Queue, Full, Empty
+from threading import Thread, Lock, local
+from weakref import WeakValueDictionary
 
 
 
@@ -24,24 +33,269 @@ class BaseModel(models.Model):
         abstract = True
 
 
+#side effects of signals, coalesced per transaction and run once it commits
+class CommitBatch:
+    '''
+    Effects registered under the same savepoints share one on_commit callback, so they are dropped together when that
+    savepoint or the transaction rolls back. Counter deltas are applied as one UPDATE per (model, field, delta) and every
+    batched function is called once with all of the items collected for it.
+    '''
+
+    def __init__(self, immediate=False):
+        self.immediate = immediate
+        self.done = False
+        self.counters = defaultdict(int)
+        self.calls = {}
+
+    def __call__(self):
+        self.done = True
+
+        updates = defaultdict(list)
+        for (model, field, pk), delta in self.counters.items():
+            if delta:
+                updates[(model, field, delta)].append(pk)
+
+        if updates:
+            self.update_counters(updates)
+
+        for func, items in self.calls.items():
+            func(list(items))
+
+
+    #runs after the commit, in its own write transaction retried while the database is locked
+    @staticmethod
+    @write_transaction
+    def update_counters(updates):
+        for (model, field, delta), pks in updates.items():
+            #counters never go below 0
+            model._base_manager.filter(pk__in=pks).update(**{field: Greatest(F(field) + delta, 0)})
+
+
+#pending CommitBatch of every (database, savepoints) of the thread. Only the on_commit callback holds a batch, so it drops
+#out of here as soon as it ran or its savepoint or transaction rolled back
+commit_batches = local()
+
+
+#returns the CommitBatch of the current transaction and savepoint, registering a new one if needed
+def get_commit_batch(using=None):
+    connection = transaction.get_connection(using)
+
+    #autocommit: nothing to wait for, the batch runs right away
+    if not connection.in_atomic_block:
+        return CommitBatch(immediate=True)
+
+    batches = getattr(commit_batches, 'batches', None)
+    if batches is None:
+        batches = commit_batches.batches = WeakValueDictionary()
+
+    #keys are reused, every outermost transaction is (alias, ()) and savepoint ids repeat across transactions. A batch left
+    #under a key is never a stale one: once run on commit it is done, and once its transaction or savepoint rolls back the
+    #on_commit callbacks holding it are discarded, so it drops out of the WeakValueDictionary
+    key = (connection.alias, tuple(connection.savepoint_ids))
+    batch = batches.get(key)
+    if batch is None or batch.done:
+        batch = CommitBatch()
+        transaction.on_commit(batch, using)
+        batches[key] = batch
+
+    return batch
+
+
+#adds delta to an integer field of a row once the transaction commits
+def defer_counter(model, pk, field, delta):
+    batch = get_commit_batch()
+    batch.counters[(model, field, pk)] += delta
+
+    if batch.immediate:
+        batch()
+
+
+#calls func once with the list of all the items deferred to it once the transaction commits
+def defer_call(func, item):
+    batch = get_commit_batch()
+    batch.calls.setdefault(func, {})[item] = None
+
+    if batch.immediate:
+        batch()
+
+
+#sends due mails of the EmailOutbox
+def deliver_outbox(batch_size=100, ids=None, connection=None):
+    '''
+    i/p -> max mails to send, optional outbox ids to restrict to, optional open email connection
+    o/p -> (sent, failed). Mails are sent over one connection, failed ones are retried later with exponential backoff
+    '''
+
+    EmailOutbox = apps.get_model('backend', 'EmailOutbox')
+    emails = EmailOutbox.objects.claim(batch_size, ids, settings.EMAIL_OUTBOX_LEASE)
+    if not emails:
+        return 0, 0
+
+    own_connection = connection is None
+    if own_connection:
+        connection = get_connection()
+        open_connection(connection)
+
+    sent = []
+    failed = 0
+    for email in emails:
+        try:
+            connection.send_messages([EmailMessage(email.subject, email.message, settings.EMAIL_HOST_USER, [email.to_email])])
+            sent.append(email.pk)
+
+        except Exception as e:
+            print(e)
+            failed += 1
+            attempts = email.attempts + 1
+            retry_delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+
+            EmailOutbox.objects.filter(pk=email.pk).update(
+                status='failed' if attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS else 'pending',
+                attempts=attempts,
+                last_error=str(e),
+                next_attempt_at=timezone.now() + timezone.timedelta(seconds=retry_delay),
+                claim=None,
+            )
+
+            #the connection may be broken, start a new one for the remaining mails
+            connection.close()
+            open_connection(connection)
+
+    if sent:
+        EmailOutbox.objects.filter(pk__in=sent).update(status='sent', sent_at=timezone.now(), claim=None)
+
+    if own_connection:
+        connection.close()
+
+    return len(sent), failed
+
+
+#opens an email connection up front, so that send_messages keeps it open between mails
+def open_connection(connection):
+    try:
+        connection.open()
+    except Exception as e:
+        print(e)
+
+
 #for sending emails
-class SendEmail(Thread):
+class EmailWorkerPool:
     '''
-    Using threads to send mails
+    Fixed number of worker threads delivering outbox mails from a bounded queue of lists of outbox ids. Each worker keeps one smtp
+    connection open and reuses it across mails, closing it after EMAIL_IDLE_TIMEOUT seconds without mail. When the queue is full
+    the caller waits up to EMAIL_QUEUE_TIMEOUT seconds and then delivers the mail itself, so a burst slows requests down instead
+    of piling up. With EMAIL_WORKERS = 0 every mail is delivered in the caller's thread.
     '''
-    
-    def __init__(self, subject, message, *receiver):
 
-        self.recipient_list = [emails for emails in receiver]
-        
-        self.subject = subject.capitalize()
-        self.message = message
-        self.sender = settings.EMAIL_HOST_USER
+    def __init__(self):
+        self.lock = Lock()
+        self.pid = None
+        self.queue = None
+        self.threads = []
+        self.sent = 0
+        self.failed = 0
+        self.sent_inline = 0
+
+    #workers are started on first use in every process, so forked servers don't share a dead pool
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            #the counts of the parent process are not this process' work
+            self.pid = os.getpid()
+            self.sent = self.failed = self.sent_inline = 0
+            self.queue = Queue(maxsize=settings.EMAIL_QUEUE_SIZE)
+            self.threads = [
+                Thread(target=self.worker, args=(self.queue,), name=f"email-worker-{i}", daemon=True) for i in range(settings.EMAIL_WORKERS)
+            ]
+            for thread in self.threads:
+                thread.start()
+
+        atexit.register(self.shutdown)
+
+
+    def submit(self, outbox_ids):
+        if settings.EMAIL_WORKERS == 0:
+            return self.deliver(outbox_ids)
+
+        self.start()
+        try:
+            self.queue.put(outbox_ids, timeout=settings.EMAIL_QUEUE_TIMEOUT)
+        except Full:
+            self.sent_inline += len(outbox_ids)
+            self.deliver(outbox_ids)
+
+
+    def deliver(self, outbox_ids, connection=None):
+        sent, failed = deliver_outbox(batch_size=len(outbox_ids), ids=outbox_ids, connection=connection)
+
+        with self.lock:
+            self.sent += sent
+            self.failed += failed
+
+        return failed == 0
+
+
+    #serves the queue it was started with, a restarted pool has a new one
+    def worker(self, queue):
+        connection = None
+
+        while True:
+            try:
+                outbox_ids = queue.get(timeout=settings.EMAIL_IDLE_TIMEOUT)
+            except Empty:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                continue
+
+            #None is the shutdown signal
+            if outbox_ids is None:
+                if connection is not None:
+                    connection.close()
+                queue.task_done()
+                return
+
+            if connection is None:
+                connection = get_connection()
+                open_connection(connection)
+
+            try:
+                self.deliver(outbox_ids, connection)
+            except Exception as e:
+                #the mail stays in the outbox for deliver_outbox
+                print(e)
+            finally:
+                close_old_connections()
+                queue.task_done()
+
+
+    #lets the workers drain the queue, then stops them
+    def shutdown(self, timeout=10):
+        if self.pid != os.getpid():
+            return
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+        self.pid = None
+
+
+    def stats(self):
+        return {
+            "workers": len(self.threads) if self.pid == os.getpid() else 0,
+            "queue_size": self.queue.qsize() if self.queue is not None else 0,
+            "queue_max_size": settings.EMAIL_QUEUE_SIZE,
+            "sent": self.sent,
+            "failed": self.failed,
+            "sent_inline": self.sent_inline,
+        }
 
-        Thread.__init__(self)
-        
-    def run(self):
-        send_mail(subject=self.subject, message=self.message, from_email=self.sender, recipient_list=self.recipient_list)
+
+email_pool = EmailWorkerPool()
 
 
 #for generating tokens for email verification
@@ -61,9 +315,12 @@ class EmailSender:
         self.email = email
 
 
-    #for sending email
+    #for sending email. Written to the outbox in the current transaction, mails of a transaction are queued together to the email worker pool once it commits
     def send_email(self, subject, message):
-        SendEmail(subject, message, self.email).start()
+        EmailOutbox = apps.get_model('backend', 'EmailOutbox')
+        email = EmailOutbox.objects.create(to_email=self.email, subject=subject.capitalize(), message=message)
+
+        defer_call(email_pool.submit, email.pk)
 
 
     #for sending link for email verification
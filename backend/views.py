@@ -1,3 +1,161 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, FileResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from django.views.decorators.http import require_safe
 
-# Create your views here.
+import os
+import re
+import mimetypes
+from urllib.parse import quote
+
+from backend import metrics
+
+
+#names written by ContentAddressedStorage: <folder>/<2 hex>/<sha256><ext>
+BLOB_NAME = re.compile(r'(^|/)[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})\.\w+$')
+
+RANGE_HEADER = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+
+#reads length bytes of a file from offset, in chunks
+def read_range(path, offset, length, chunk_size=64*1024):
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+#If-None-Match uses the weak comparison: W/"x" matches "x", and * matches any existing file
+def etag_matches(if_none_match, etag):
+    etags = parse_etags(if_none_match)
+    if '*' in etags:
+        return True
+    return etag.removeprefix('W/') in [tag.removeprefix('W/') for tag in etags]
+
+
+#parses a single range "bytes=start-end", "bytes=start-" or "bytes=-suffix". Returns (start, end) inclusive, None to serve the whole file,
+#raises ValueError when the range starts past the end of the file (416)
+def parse_range(header, size):
+    match = RANGE_HEADER.match(header.strip())
+    if match is None:
+        #malformed or multiple ranges, the whole file is served
+        return None
+
+    start, end = match['start'], match['end']
+    if start == '':
+        if end == '':
+            return None
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    if start > end:
+        #eg. bytes=5-2, an invalid range is ignored like a malformed one
+        return None
+
+    return start, end
+
+
+#serves the files of MEDIA_ROOT
+@require_safe
+def serve_media(request, path):
+    '''
+    1. Content hashed names never change content, they are cached by clients and proxies for a year as immutable
+    2. Conditional requests (If-None-Match, If-Modified-Since) are answered with 304 from a stat of the file
+    3. A single Range is answered with 206, If-Range is honored
+    4. With MEDIA_SENDFILE = "x-accel-redirect" (nginx) or "x-sendfile" (apache, lighttpd) the file is left to the web server,
+       which also handles ranges, so the worker never reads the file
+    '''
+
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (ValueError, OSError):
+        raise Http404("File not found.")
+
+    if not os.path.isfile(full_path):
+        raise Http404("File not found.")
+
+    blob = BLOB_NAME.search(path)
+    etag = quote_etag(blob['digest'] if blob else f"{int(stat.st_mtime)}-{stat.st_size}")
+    last_modified = int(stat.st_mtime)
+
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': "public, max-age=31536000, immutable" if blob else f"public, max-age={settings.MEDIA_CACHE_MAX_AGE}",
+        'Accept-Ranges': 'bytes',
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    if (if_none_match is not None and etag_matches(if_none_match, etag)) or (
+        if_none_match is None and if_modified_since is not None and last_modified <= if_modified_since
+    ):
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+
+    if settings.MEDIA_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+            #nginx decodes the uri, a name with spaces, % or ? would point to another file
+            response['X-Accel-Redirect'] = settings.MEDIA_SENDFILE_PREFIX.rstrip('/') + '/' + quote(path.lstrip('/'))
+        else:
+            response['X-Sendfile'] = full_path
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (if_range is None or if_range in (etag, headers['Last-Modified'])):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{stat.st_size}"
+            return response
+
+    if byte_range is None:
+        #the wsgi server can send it with sendfile()
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(full_path, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = f"bytes {start}-{end}/{stat.st_size}"
+        response['Content-Length'] = end - start + 1
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+#prometheus scrape endpoint
+@require_safe
+def metrics_view(request):
+    '''
+    the metrics of every process (see backend.metrics), in the prometheus text format. Only served with METRICS_TOKEN set, which
+    is required as a bearer token: behind a reverse proxy every request comes from the machine itself
+    '''
+
+    if not settings.METRICS_TOKEN:
+        raise Http404("Metrics are disabled.")
+    if not constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {settings.METRICS_TOKEN}"):
+        return HttpResponseForbidden()
+
+    metrics.registry.flush(force=True)
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')